@@ -44,8 +44,18 @@ class Config(dict):
             self.__get_conf_val('FABNET', 'fabnet_url', 'fabnet_hostname')
             self.__get_conf_val('FABNET', 'parallel_put_count', 'parallel_put_count', int)
             self.__get_conf_val('FABNET', 'parallel_get_count', 'parallel_get_count', int)
+            self.__get_conf_val('FABNET', 'fri_multiplexed', 'fri_multiplexed', int)
+            self.__get_conf_val('FABNET', 'transfer_engine', 'transfer_engine')
+            self.__get_conf_val('FABNET', 'delete_batch_size', 'delete_batch_size', int)
+            self.__get_conf_val('FABNET', 'delete_flush_interval', 'delete_flush_interval', float)
+            self.__get_conf_val('FABNET', 'node_max_calls', 'node_max_calls', int)
             self.__get_conf_val('CACHE', 'data_dir', 'data_dir')
             self.__get_conf_val('CACHE', 'cache_size', 'cache_size', int)
+            self.__get_conf_val('CACHE', 'transactions_log_durability', 'tr_log_durability')
+            self.__get_conf_val('BANDWIDTH', 'upload_limit', 'upload_limit', int)
+            self.__get_conf_val('BANDWIDTH', 'download_limit', 'download_limit', int)
+            self.__get_conf_val('BANDWIDTH', 'class_shares', 'bandwidth_class_shares')
+            self.__get_conf_val('BANDWIDTH', 'schedule', 'bandwidth_schedule')
             self.__get_conf_val('WEBDAV', 'bind_hostname', 'webdav_bind_host')
             self.__get_conf_val('WEBDAV', 'bind_port', 'webdav_bind_port')
             self.__get_conf_val('WEBDAV', 'mount_type', 'mount_type')
@@ -67,11 +77,23 @@ class Config(dict):
                 'fabnet_hostname': 'lb.idepositbox.com',
                 'parallel_put_count': '3',
                 'parallel_get_count': '3',
+                'fri_multiplexed': 0,
+                'transfer_engine': 'threads',
+                'delete_batch_size': 100,
+                'delete_flush_interval': 0.5,
+                'node_max_calls': 0, #max parallel transfers to single node, 0 is unlimited
                 'webdav_bind_host': '127.0.0.1',
                 'webdav_bind_port': '8080',
                 'mount_type': MOUNT_LOCAL,
                 'data_dir': self.__get_default_cache_dir(),
                 'cache_size': 0,
+                'tr_log_durability': 'os',
+                #KB/s, 0 is unlimited. Threads engine applies limits between data blocks
+                #(started data block is transferred at full speed), async engine applies them to every chunk
+                'upload_limit': 0,
+                'download_limit': 0,
+                'bandwidth_class_shares': '100,100,50,25',
+                'bandwidth_schedule': '',
                 'ca_address': 'ca.idepositbox.com'}
 
     def __getattr__(self, attr):
@@ -91,6 +113,7 @@ class Config(dict):
         config.add_section('LOG')
         config.add_section('FABNET')
         config.add_section('CACHE')
+        config.add_section('BANDWIDTH')
         config.add_section('WEBDAV')
         config.add_section('CA')
 
@@ -100,8 +123,18 @@ class Config(dict):
         config.set('CA', 'ca_address', self['ca_address'])
         config.set('FABNET', 'parallel_put_count', self['parallel_put_count'])
         config.set('FABNET', 'parallel_get_count', self['parallel_get_count'])
+        config.set('FABNET', 'fri_multiplexed', self['fri_multiplexed'])
+        config.set('FABNET', 'transfer_engine', self['transfer_engine'])
+        config.set('FABNET', 'delete_batch_size', self['delete_batch_size'])
+        config.set('FABNET', 'delete_flush_interval', self['delete_flush_interval'])
+        config.set('FABNET', 'node_max_calls', self['node_max_calls'])
         config.set('CACHE', 'data_dir', self['data_dir'])
         config.set('CACHE', 'cache_size', self['cache_size'])
+        config.set('CACHE', 'transactions_log_durability', self['tr_log_durability'])
+        config.set('BANDWIDTH', 'upload_limit', self['upload_limit'])
+        config.set('BANDWIDTH', 'download_limit', self['download_limit'])
+        config.set('BANDWIDTH', 'class_shares', self['bandwidth_class_shares'])
+        config.set('BANDWIDTH', 'schedule', self['bandwidth_schedule'])
         config.set('WEBDAV', 'bind_hostname', self['webdav_bind_host'])
         config.set('WEBDAV', 'bind_port', self['webdav_bind_port'])
         config.set('WEBDAV', 'mount_type', self['mount_type'])
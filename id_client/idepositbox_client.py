@@ -28,6 +28,7 @@ from id_client.utils import logger
 from nimbus_client.core.security_manager import FileBasedSecurityManager, AbstractSecurityManager
 from nimbus_client.core.base_safe_object import LockObject
 from nimbus_client.core.nibbler import Nibbler
+from nimbus_client.core.bandwidth import parse_schedule, parse_class_shares
 from nimbus_client.core.events import Event, events_provider
 from nimbus_client.core.utils import TempFile
 from nimbus_client.core.logger import logger as nimbus_logger
@@ -47,6 +48,7 @@ SM_TYPES_MAP = {SPT_TOKEN_BASED: None,
                 SPT_FILE_BASED: FileBasedSecurityManager}
 
 ALLOWED_PWD_CHARS = set(string.letters + string.digits + '@#$%^&+=')
+BANDWIDTH_CONFIG_KEYS = ('upload_limit', 'download_limit', 'bandwidth_class_shares', 'bandwidth_schedule')
 
 IDLock = LockObject()
 IDEventLock = LockObject()
@@ -131,7 +133,12 @@ class IdepositboxClient(object):
             
             self.__nibbler = Nibbler(config.fabnet_hostname, security_provider, \
                                 config.parallel_put_count, config.parallel_get_count, \
-                                config.data_dir, config.cache_size)
+                                config.data_dir, config.cache_size, bool(config.fri_multiplexed), \
+                                config.transfer_engine, delete_batch_size=config.delete_batch_size, \
+                                delete_flush_interval=config.delete_flush_interval, \
+                                tr_log_durability=config.tr_log_durability, \
+                                node_max_calls=int(config.node_max_calls), \
+                                **self.__get_bandwidth_params(config))
 
 
             try:
@@ -201,6 +208,12 @@ class IdepositboxClient(object):
         self.__config.refresh()
         return self.__config.get_config_dict()
 
+    def __get_bandwidth_params(self, config):
+        return {'upload_limit': int(config['upload_limit']) * 1024,
+                'download_limit': int(config['download_limit']) * 1024,
+                'bandwidth_shares': parse_class_shares(config['bandwidth_class_shares']),
+                'bandwidth_schedule': parse_schedule(config['bandwidth_schedule'])}
+
     @IDLock
     def update_config(self, new_config):
         log_level = new_config.get('log_level', self.__config.log_level)
@@ -210,10 +223,19 @@ class IdepositboxClient(object):
             ll_update = True
         else:
             ll_update = False
+        bw_update = [key for key in BANDWIDTH_CONFIG_KEYS if key in new_config]
+        if bw_update:
+            bw_config = dict(self.__config)
+            bw_config.update(new_config)
+            bw_params = self.__get_bandwidth_params(bw_config)
         self.__config.update(new_config)
         self.__config.save()
         if ll_update:
             self.__set_log_level()
+        if bw_update and self.__nibbler:
+            #running transfers are throttled by new limits
+            self.__nibbler.set_bandwidth_limits(bw_params['upload_limit'], bw_params['download_limit'], \
+                    bw_params['bandwidth_shares'], bw_params['bandwidth_schedule'])
 
     @IDLock
     def get_available_media_storages(self):
@@ -16,6 +16,7 @@ from id_client.constants import *
 from id_client.media_storage import AbstractMediaStoragesManager
 from id_client.idepositbox_client import logger, SM_TYPES_MAP
 from nimbus_client.core.exceptions import NoCertFound
+from nimbus_client.core.bandwidth import parse_schedule, parse_class_shares
 
 KB = 1024
 MB = 1024.*KB
@@ -120,7 +121,11 @@ class GetSettingsHandler(UrlHandler):
                 'webdav_bind_host': config.webdav_bind_host,
                 'webdav_bind_port': config.webdav_bind_port,
                 'mount_type': config.mount_type,
-                'log_level': config.log_level.upper()
+                'log_level': config.log_level.upper(),
+                'upload_limit': config.upload_limit,
+                'download_limit': config.download_limit,
+                'bandwidth_class_shares': config.bandwidth_class_shares,
+                'bandwidth_schedule': config.bandwidth_schedule
                 }
         return self.json_source(resp)
 
@@ -181,6 +186,22 @@ class ApplySettingsHandler(UrlHandler):
             if data.get('mount_type') not in (MOUNT_LOCAL, MOUNT_EXPORT):
                 raise Exception('Invalid mount type!')
 
+            for limit_key, limit_name in (('upload_limit', 'upload'), ('download_limit', 'download')):
+                if limit_key not in data:
+                    continue
+                try:
+                    data[limit_key] = int(data[limit_key] or 0)
+                    if data[limit_key] < 0:
+                        raise ValueError()
+                except ValueError:
+                    raise Exception('Invalid %s speed limit! Expecting KB/s value (0 for unlimited)'%limit_name)
+
+            try:
+                parse_class_shares(data.get('bandwidth_class_shares', None))
+                parse_schedule(data.get('bandwidth_schedule', None))
+            except ValueError, err:
+                raise Exception(str(err))
+
             idepositbox_client.update_config(data) 
             
             resp = {'ret_code':0}
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.bandwidth
+@author Konstantin Andrusenko
+@date June 28, 2013
+
+This module contains the implementation of TokenBucket and BandwidthLimiter classes
+"""
+import time
+import threading
+
+from nimbus_client.core.constants import BW_BURST_TIME, BW_CLASS_SHARES
+
+
+def parse_schedule(schedule):
+    """Parse bandwidth schedule string like "09:00-18:00=128/1024; 23:30-06:00=0/0"
+    (<from>-<to>=<upload KB/s>/<download KB/s>, 0 is unlimited).
+    Returns list of (from minute, to minute, upload bytes/s, download bytes/s)
+    """
+    ret_list = []
+    for item in (schedule or '').split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            period, limits = item.split('=')
+            start, end = [int(h)*60 + int(m) for h, m in [t.strip().split(':') for t in period.split('-')]]
+            upload, download = [int(l)*1024 for l in limits.split('/')]
+        except ValueError:
+            raise ValueError('Invalid bandwidth schedule item "%s"'%item)
+        if not (0 <= start < 24*60 and 0 <= end < 24*60) or upload < 0 or download < 0:
+            raise ValueError('Invalid bandwidth schedule item "%s"'%item)
+        ret_list.append((start, end, upload, download))
+    return ret_list
+
+
+def parse_class_shares(shares):
+    """Parse comma separated percents of direction limit for priority classes
+    (interactive read, interactive write, background sync, prefetch)
+    """
+    ret_map = dict(BW_CLASS_SHARES)
+    if not shares:
+        return ret_map
+    try:
+        percents = [float(p) for p in shares.split(',')]
+    except ValueError:
+        raise ValueError('Invalid bandwidth class shares "%s"'%shares)
+    for priority, percent in zip(sorted(ret_map.keys()), percents):
+        if not (0 < percent <= 100):
+            raise ValueError('Invalid bandwidth class shares "%s"'%shares)
+        ret_map[priority] = percent / 100.
+    return ret_map
+
+
+class TokenBucket:
+    """Token bucket of @rate bytes per second (rate <= 0 means no limit).
+    Tokens are reserved before data is transferred and transfer waits while
+    bucket is in debt (see reserve and delay methods)
+    """
+    def __init__(self, rate=0, burst_time=BW_BURST_TIME):
+        self.__rate = 0
+        self.__burst_time = burst_time
+        self.__tokens = 0
+        self.__last_ts = time.time()
+        self.__lock = threading.Lock()
+        self.set_rate(rate)
+
+    def __refill(self):
+        now = time.time()
+        if self.__rate > 0:
+            self.__tokens = min(self.__tokens + (now - self.__last_ts) * self.__rate, \
+                    self.__rate * self.__burst_time)
+        self.__last_ts = now
+
+    def get_rate(self):
+        return self.__rate
+
+    def set_rate(self, rate):
+        self.__lock.acquire()
+        try:
+            self.__refill()
+            self.__rate = max(rate, 0)
+            if self.__rate <= 0:
+                self.__tokens = 0 #debt of limited transfers is not kept for unlimited ones
+            self.__tokens = min(self.__tokens, self.__rate * self.__burst_time)
+        finally:
+            self.__lock.release()
+
+    def reserve(self, size):
+        """Take @size tokens. Returns seconds to wait before transfer of @size bytes"""
+        self.__lock.acquire()
+        try:
+            if self.__rate <= 0:
+                return 0
+            self.__refill()
+            self.__tokens -= size
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / float(self.__rate)
+        finally:
+            self.__lock.release()
+
+    def delay(self):
+        """Return seconds while bucket is in debt (0 if transfer can be started now)"""
+        self.__lock.acquire()
+        try:
+            if self.__rate <= 0:
+                return 0
+            self.__refill()
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / float(self.__rate)
+        finally:
+            self.__lock.release()
+
+
+class BandwidthLimiter:
+    """Separate upload and download limits (bytes per second, 0 is unlimited).
+    Every priority class is limited by its share of direction limit also.
+    Limits of schedule period covering current local time are used instead of default limits.
+    Workers check admit() before data block transfer and defer the job for returned time,
+    every chunk is reserved by reserve() before transfer. Async engine sends (or receives next) chunk
+    after returned time, worker threads do not wait (limit is applied by deferring of next data block)
+    """
+    def __init__(self, upload_rate=0, download_rate=0, class_shares=None, schedule=None):
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        for is_upload in (True, False):
+            self.__buckets[is_upload] = TokenBucket()
+            for priority in BW_CLASS_SHARES:
+                self.__buckets[(is_upload, priority)] = TokenBucket()
+        self.__active_limits = None
+        self.set_limits(upload_rate, download_rate, class_shares, schedule)
+
+    def set_limits(self, upload_rate, download_rate, class_shares=None, schedule=None):
+        self.__lock.acquire()
+        try:
+            self.__limits = (upload_rate, download_rate)
+            self.__class_shares = dict(BW_CLASS_SHARES)
+            self.__class_shares.update(class_shares or {})
+            self.__schedule = list(schedule or [])
+            self.__active_limits = None
+        finally:
+            self.__lock.release()
+        self.__apply_limits()
+
+    def get_limits(self):
+        """Return (upload rate, download rate) used now"""
+        self.__apply_limits()
+        return self.__buckets[True].get_rate(), self.__buckets[False].get_rate()
+
+    def __current_limits(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, upload_rate, download_rate in self.__schedule:
+            if start <= end:
+                in_period = start <= minute < end
+            else:
+                in_period = minute >= start or minute < end
+            if in_period:
+                return upload_rate, download_rate
+        return self.__limits
+
+    def __apply_limits(self):
+        self.__lock.acquire()
+        try:
+            limits = self.__current_limits()
+            if limits == self.__active_limits:
+                return
+            self.__active_limits = limits
+
+            for is_upload, rate in ((True, limits[0]), (False, limits[1])):
+                self.__buckets[is_upload].set_rate(rate)
+                for priority, share in self.__class_shares.items():
+                    if (is_upload, priority) in self.__buckets:
+                        self.__buckets[(is_upload, priority)].set_rate(rate * share)
+        finally:
+            self.__lock.release()
+
+    def admit(self, is_upload, priority):
+        """Return seconds to wait before transfer start (0 if transfer can be started now)"""
+        self.__apply_limits()
+        delay = self.__buckets[is_upload].delay()
+        class_bucket = self.__buckets.get((is_upload, priority), None)
+        if class_bucket:
+            delay = max(delay, class_bucket.delay())
+        return delay
+
+    def reserve(self, is_upload, priority, size):
+        """Reserve @size bytes of chunk. Returns seconds to wait before chunk transfer"""
+        self.__apply_limits()
+        delay = self.__buckets[is_upload].reserve(size)
+        class_bucket = self.__buckets.get((is_upload, priority), None)
+        if class_bucket:
+            delay = max(delay, class_bucket.reserve(size))
+        return delay
+
+    def chunk_callback(self, is_upload, priority):
+        """Return on_chunk function for fabnet gateway (it returns seconds to wait before chunk transfer)"""
+        return lambda size: self.reserve(is_upload, priority, size)
@@ -1,4 +1,5 @@
 RC_NO_DATA = 324
+RC_RANGE_MISMATCH = 325 #ranged ClientPutData offset does not match size of data saved by node
 
 DEFAULT_REPLICA_COUNT = 2
 FRI_PORT = 1987
@@ -9,6 +10,52 @@ FILE_ITER_BLOCK_SIZE = 1024*1024
 
 FG_ERROR_TIMEOUT = 5
 
+#data blocks transfer engines
+TE_THREADS = 'threads'
+TE_ASYNC = 'async'
+
+#max data blocks transfers processed concurrently by async transfer engine
+ASYNC_MAX_IN_FLIGHT = 256
+
+#remote data blocks are removed by batches (single ClientDeleteData call)
+DELETE_BATCH_SIZE = 100
+DELETE_FLUSH_INTERVAL = 0.5 #seconds
+
+#data block keys reserved by single PutKeysInfo call
+KEYS_RESERVATION_BATCH = 32
+#seconds after which reserved key is not used
+KEYS_RESERVATION_TTL = 300
+
+#hedged data block reads (request to next replica is sent if response is not received in time)
+HEDGED_READS = True
+HEDGE_PERCENTILE = 0.95 #percentile of node response latency used as hedge delay
+HEDGE_DEFAULT_DELAY = 1 #seconds (node has no latency statistic yet)
+HEDGED_READ_TIMEOUT = 60 #seconds, socket read timeout of GetDataBlock request (stuck cancelled request releases its thread and node call slot)
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 10
+
+#resumable data blocks transfers
+RESUME_RANGE_SIZE = 8*1024*1024 #larger data blocks are uploaded by ranges, transferred offsets are logged
+
+#data blocks locations (GetKeysInfo responses) cache
+KEYS_INFO_CACHE_SIZE = 10000
+KEYS_INFO_CACHE_TTL = 300 #seconds
+
+#nodes monitor
+NODE_STATS_SAMPLES = 50
+NODE_ERROR_WINDOW = 60 #seconds
+NODE_ERROR_PENALTY = 5 #seconds added to node score for every recent error
+
+#nodes health (circuit breaker opens after NODE_BREAKER_ERRORS consecutive failed calls)
+NODE_BREAKER_ERRORS = 5
+NODE_BREAKER_OPEN_TIME = 1 #seconds, doubled on every failed probe call
+NODE_BREAKER_MAX_OPEN_TIME = 60
+NODE_MAX_CONCURRENCY = 0 #max parallel transfers to single node (0 - limited by transfer engine concurrency only)
+
+#failed transfers are requeued after exponential backoff delay (FG_ERROR_TIMEOUT is max delay)
+RETRY_MIN_DELAY = 0.1 #seconds
+GET_MAX_RETRIES = 3
+
 #security provider types
 SPT_TOKEN_BASED = 'token'
 SPT_FILE_BASED = 'file'
@@ -25,7 +72,28 @@ ASYNC_WAIT_TIMEOUT = 0.1
 
 #data block constants
 BUF_LEN = 1024
+DB_READ_BUF_LEN = 1024*1024 #data block read buffer (multiple of cipher block size)
+DB_LOCKS_SHARDS = 16 #count of independently locked partitions in data blocks locks manager
 READ_TRY_COUNT = 30
 READ_SLEEP_TIME = 1
 
 JOURNAL_SYNC_CHECK_TIME = 5
+
+#transactions log durability levels
+TR_LOG_DURABILITY_LAZY = 'lazy' #records are buffered and written by TR_LOG_BUFFER_SIZE batches
+TR_LOG_DURABILITY_OS = 'os' #records are written to OS before append returns
+TR_LOG_DURABILITY_FSYNC = 'fsync' #records are synced to disk before append returns
+TR_LOG_BUFFER_SIZE = 64*1024
+
+#transfer priority classes (lower value is served first)
+TP_INTERACTIVE_READ = 0
+TP_INTERACTIVE_WRITE = 1
+TP_BACKGROUND_SYNC = 2
+TP_PREFETCH = 3
+TRANSFER_CLASS_DELAY = 10 #seconds, queued job is served before jobs of next priority class queued later than this
+TRANSFER_SIZE_RATE = 8*1024*1024 #bytes per second, converts block size to queue delay (shortest job first)
+
+#bandwidth shaping
+BW_BURST_TIME = 1 #seconds, token bucket capacity is rate * BW_BURST_TIME
+BW_CLASS_SHARES = {TP_INTERACTIVE_READ: 1.0, TP_INTERACTIVE_WRITE: 1.0, \
+            TP_BACKGROUND_SYNC: 0.5, TP_PREFETCH: 0.25} #max part of direction limit used by priority class
@@ -11,18 +11,19 @@ Copyright (C) 2013 Konstantin Andrusenko
 This module contains the implementation of DataBlock class
 """
 import os
-import time
 import copy
+import mmap
 import shutil
 import hashlib
 import threading
 
 from nimbus_client.core.exceptions import TimeoutException, IOException
-from nimbus_client.core.constants import BUF_LEN, READ_TRY_COUNT, READ_SLEEP_TIME
+from nimbus_client.core.constants import BUF_LEN, READ_TRY_COUNT, READ_SLEEP_TIME, DB_READ_BUF_LEN, \
+            DB_LOCKS_SHARDS
 from nimbus_client.core.logger import logger
 
 
-class DBLocksManager:
+class DBLocksShard:
     def __init__(self):
         self.__locks = {}
         self.__for_call = {}
@@ -80,11 +81,114 @@ class DBLocksManager:
             self.__thrd_lock.release()
 
 
+class DBLocksManager:
+    """Usage counters of data blocks paths.
+    Paths are partitioned by hash into @shards_count independently locked shards,
+    so parallel transfers do not contend on single lock
+    """
+    def __init__(self, shards_count=DB_LOCKS_SHARDS):
+        self.__shards = [DBLocksShard() for i in xrange(shards_count)]
+
+    def __get_shard(self, lock_obj):
+        return self.__shards[hash(lock_obj) % len(self.__shards)]
+
+    def set(self, lock_obj):
+        self.__get_shard(lock_obj).set(lock_obj)
+
+    def release(self, lock_obj):
+        self.__get_shard(lock_obj).release(lock_obj)
+
+    def call_on_unlock(self, lock_obj, call_obj):
+        return self.__get_shard(lock_obj).call_on_unlock(lock_obj, call_obj)
+
+    def locked(self, lock_obj):
+        return self.__get_shard(lock_obj).locked(lock_obj)
+
+    def locks(self):
+        ret_list = []
+        for shard in self.__shards:
+            ret_list += shard.locks()
+        return ret_list
+
+
+class DBProgressNotifier:
+    """Wakes up readers waiting for data that is not written to data block file yet.
+    Paths are partitioned by hash into @shards_count independently locked shards
+    (like in DBLocksManager), data block file size is checked outside of shard lock
+    """
+    def __init__(self, shards_count=DB_LOCKS_SHARDS):
+        self.__shards = [(threading.Lock(), {}) for i in xrange(shards_count)]
+
+    def __get_shard(self, path):
+        return self.__shards[hash(path) % len(self.__shards)]
+
+    def __is_changed(self, path, seek):
+        return not os.path.exists(path) or os.path.getsize(path) > seek
+
+    def wait(self, path, seek, timeout):
+        """Wait while data block file is not longer than @seek bytes.
+        Returns False if nothing is changed in @timeout seconds
+        """
+        lock, waiters = self.__get_shard(path)
+        lock.acquire()
+        try:
+            waiter = waiters.get(path, None)
+            if waiter is None:
+                #[condition, waiters count, notifications count]
+                waiter = waiters[path] = [threading.Condition(lock), 0, 0]
+            waiter[1] += 1
+            notified = waiter[2]
+        finally:
+            lock.release()
+
+        try:
+            if self.__is_changed(path, seek):
+                return True
+
+            lock.acquire()
+            try:
+                #notification received while file size was checked is not lost
+                if waiter[2] == notified:
+                    waiter[0].wait(timeout)
+            finally:
+                lock.release()
+            return self.__is_changed(path, seek)
+        finally:
+            lock.acquire()
+            try:
+                waiter[1] -= 1
+                if not waiter[1]:
+                    del waiters[path]
+            finally:
+                lock.release()
+
+    def notify(self, path, flush_func=None):
+        """Wake up readers of data block. @flush_func is called before notification
+        if somebody waits data block (so buffered data is visible for readers)
+        """
+        lock, waiters = self.__get_shard(path)
+        if path not in waiters:
+            return
+        if flush_func:
+            flush_func()
+
+        lock.acquire()
+        try:
+            waiter = waiters.get(path, None)
+            if waiter is None:
+                return
+            waiter[2] += 1
+            waiter[0].notify_all()
+        finally:
+            lock.release()
+
 
 class DataBlock:
     SECURITY_MANAGER = None
     LOCK_MANAGER = None
-    __lock = threading.RLock()
+    NOTIFIER = DBProgressNotifier()
+    READ_BUF_LEN = DB_READ_BUF_LEN
+    USE_MMAP = True
 
     @classmethod
     def is_locked(cls, path):
@@ -102,10 +206,13 @@ class DataBlock:
     def __init__(self, path, raw_len=None, actsize=False, force_create=False):
         self.__path = path
         self.__checksum = hashlib.sha1()
+        self.__lazy_checksum = False
         self.__f_obj = None
+        self.__mmap = None
         self.__encdec = None
         self.__seek = 0
         self.__rest_str = ''
+        self.__rest_pos = 0
         self.__locked = False
         self.__raw_len = raw_len
 
@@ -144,11 +251,9 @@ class DataBlock:
         return self.get_actual_size() == self.__expected_len
 
     def get_progress(self):
-        self.__lock.acquire()
-        try:
-            return self.__seek, self.__expected_len
-        finally:
-            self.__lock.release()
+        #seek is changed by thread that reads/writes data block only,
+        #so progress is accounted without locking
+        return self.__seek, self.__expected_len
 
     def __del__(self):
         self.close()
@@ -157,8 +262,28 @@ class DataBlock:
         return DataBlock(self.__path, self.__raw_len)
 
     def checksum(self):
+        if self.__lazy_checksum:
+            self.__calculate_checksum()
         return self.__checksum.hexdigest()
 
+    def __calculate_checksum(self):
+        """Checksum of data block that is restored for appending is calculated
+        from file (data block prefix is not read while restoring)
+        """
+        self.flush()
+        checksum = hashlib.sha1()
+        f_obj = open(self.__path, 'rb')
+        try:
+            while True:
+                data = f_obj.read(self.READ_BUF_LEN)
+                if not data:
+                    break
+                checksum.update(data)
+        finally:
+            f_obj.close()
+        self.__checksum = checksum
+        self.__lazy_checksum = False
+
     def get_name(self):
         return os.path.basename(self.__path)
 
@@ -169,6 +294,7 @@ class DataBlock:
         self.close()
         if os.path.exists(self.__path):
             os.remove(self.__path)
+            self.NOTIFIER.notify(self.__path)
 
     def write(self, data, finalize=False, encrypt=True):
         """Encode (if security manager is setuped) and write to file
@@ -181,15 +307,13 @@ class DataBlock:
         if encrypt and self.__encdec:
             data = self.__encdec.encrypt(data, finalize)
 
-        self.__checksum.update(data)
+        if not self.__lazy_checksum:
+            self.__checksum.update(data)
 
         self.__f_obj.write(data)
-        self.__lock.acquire()
-        try:
-            self.__seek += len(data)
-        finally:
-            self.__lock.release()
+        self.__seek += len(data)
 
+        self.NOTIFIER.notify(self.__path, self.flush)
         return data
 
     def finalize(self):
@@ -198,13 +322,30 @@ class DataBlock:
 
     def reopen(self):
         self.__close()
-        self.__lock.acquire()
-        try:
-            self.__seek = 0
-            self.__expected_len = self.get_actual_size()
-        finally:
-            self.__lock.release()
+        self.__seek = 0
+        self.__expected_len = self.get_actual_size()
         self.__checksum = hashlib.sha1()
+        self.__lazy_checksum = False
+
+    def seek_raw(self, offset):
+        """Continue reading of encrypted data from @offset.
+        Checksum is calculated from file in this case
+        """
+        self.__close()
+        self.__seek = offset
+        self.__lazy_checksum = True
+
+    def truncate_raw(self, offset):
+        """Continue writing of encrypted data (received from backend) from @offset,
+        data after @offset is removed from data block
+        """
+        self.__close()
+        self.__f_obj = open(self.__path, 'r+b')
+        self.__f_obj.truncate(offset)
+        self.__f_obj.seek(offset)
+        self.__seek = offset
+        self.__checksum = hashlib.sha1()
+        self.__lazy_checksum = offset > 0
 
     def flush(self):
         if self.__f_obj:
@@ -218,67 +359,147 @@ class DataBlock:
             self.__locked = False
 
 
-    def read_raw(self, rlen=None):
-        ret_str = ''
+    def read_raw(self, rlen=None, partial=False, as_view=False):
+        """Read encrypted data from data block file.
+        If @partial is True, data that is already in file is returned
+        without waiting for @rlen bytes.
+        If @as_view is True, data of full data block is returned as buffer
+        object of memory mapped file (without copying). Data block owns the map,
+        so buffer is valid until data block is closed (TypeError is raised on access after close)
+        """
         try:
             if rlen is None:
+                parts = []
                 while True:
-                    buf = self.__read_buf(BUF_LEN)
+                    buf = self.__read_buf(self.READ_BUF_LEN)
                     if not buf:
                         break
-                    ret_str += buf
+                    parts.append(str(buf))
+                ret_str = ''.join(parts)
             else:
-                ret_str = self.__read_buf(rlen)
+                ret_str = self.__read_buf(rlen, partial)
 
             if ret_str:
                 self.__checksum.update(ret_str)
         except IOError, err:
             raise IOException("Can't read data block! Details: %s"%err)
 
+        if ret_str and not as_view:
+            return str(ret_str)
         return ret_str
 
     def read(self, rlen=None):
-        ret_str = self.__rest_str
-        self.__rest_str = ''
-        while True:
-            if rlen and len(ret_str) >= rlen:
-                self.__rest_str = ret_str[rlen:]
-                ret_str = ret_str[:rlen]
+        data = self.__pop_rest(rlen)
+        parts = [data]
+        parts_len = len(data)
+        while rlen is None or parts_len < rlen:
+            data = self.read_raw(self.READ_BUF_LEN, partial=True, as_view=True)
+            if not data:
                 break
 
-            data = self.read_raw(BUF_LEN)
+            if self.__encdec:
+                data = self.__encdec.decrypt(data)
+            self.__rest_str = str(data)
+            self.__rest_pos = 0
+            data = self.__pop_rest(None if rlen is None else rlen - parts_len)
+            parts.append(data)
+            parts_len += len(data)
+
+        return ''.join(parts)
+
+    def readinto(self, buf):
+        """Read decrypted data into writable buffer (bytearray or memoryview).
+        Data is copied into @buf directly from mapped file (or from decryptor output),
+        decrypted data that does not fit into @buf is returned by next read call.
+        Returns number of bytes read (0 at the end of data block)
+        """
+        view = memoryview(buf)
+        buf_len = len(view)
+        data = self.__pop_rest(buf_len)
+        view[:len(data)] = data
+        pos = len(data)
+        while pos < buf_len:
+            #decryptor expects encrypted header in first read buffer
+            raw_len = self.READ_BUF_LEN if self.__encdec else min(self.READ_BUF_LEN, buf_len - pos)
+            data = self.read_raw(raw_len, partial=True, as_view=True)
             if not data:
                 break
 
-            data = self.__encdec.decrypt(data)
-            ret_str += data
-
-        return ret_str
+            if self.__encdec:
+                data = self.__encdec.decrypt(data)
+            data_len = min(len(data), buf_len - pos)
+            view[pos:pos+data_len] = buffer(data, 0, data_len)
+            if data_len < len(data):
+                self.__rest_str = str(data)
+                self.__rest_pos = data_len
+            pos += data_len
+        return pos
+
+    def __pop_rest(self, rlen):
+        """Return decrypted data that is not returned by previous read() call"""
+        rest_len = len(self.__rest_str)
+        start = self.__rest_pos
+        end = rest_len if rlen is None else min(start + rlen, rest_len)
+        data = self.__rest_str[start:end]
+        if end >= rest_len:
+            self.__rest_str = ''
+            end = 0
+        self.__rest_pos = end
+        return data
 
     def __close(self):
+        self.__unmap()
         if self.__f_obj and (not self.__f_obj.closed):
+            is_written = 'r' not in self.__f_obj.mode or '+' in self.__f_obj.mode
             self.__f_obj.close()
             self.__f_obj = None
+            if is_written:
+                self.NOTIFIER.notify(self.__path)
+
+    def __unmap(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+
+    def __map_file(self):
+        """Map full data block file into memory for reading"""
+        if not (self.USE_MMAP and self.__expected_len and self.full()):
+            return False
+        f_obj = open(self.__path, 'rb')
+        try:
+            self.__mmap = mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError), err:
+            logger.debug('Data block %s can not be mapped: %s'%(self.get_name(), err))
+            return False
+        finally:
+            f_obj.close()
+        return True
 
     def __open_file(self, open_flags):
+        self.__unmap()
         self.__f_obj = open(self.__path, open_flags)
         if 'r+' in open_flags:
             if self.get_actual_size():
-                logger.debug('rewrite data block %s for appending...'%self.get_name())
-                self.__restore_db() 
+                self.__restore_for_append()
 
     def __is_closed(self):
         return ((not self.__f_obj) or self.__f_obj.closed)
 
-    def __read_buf(self, read_buf_len):
+    def __read_buf(self, read_buf_len, partial=False):
         if self.__expected_len is None:
             raise RuntimeError('Unknown data block size for %s!'%self.get_name())
         if self.__expected_len <= self.__get_seek():
             return None
 
+        if self.__mmap or (self.__is_closed() and self.__map_file()):
+            ret_data = buffer(self.__mmap, self.__seek, read_buf_len)
+            self.__seek += len(ret_data)
+            return ret_data
+
         ret_data = ''
         remained_read_len = read_buf_len
-        for i in xrange(READ_TRY_COUNT):
+        idle_tries = 0
+        while True:
             if self.__is_closed():
                 self.__open_file('rb')
                 self.__f_obj.seek(self.__get_seek())
@@ -286,34 +507,53 @@ class DataBlock:
             data = self.__f_obj.read(remained_read_len)
             read_data_len = len(data)
 
-            self.__lock.acquire()
-            try:
-                self.__seek += read_data_len
-            finally:
-                self.__lock.release()
+            self.__seek += read_data_len
 
             ret_data += data
             remained_read_len -= read_data_len
 
-            if remained_read_len:
-                self.__f_obj.close()
-                if self.__expected_len <= self.__get_seek():
-                    break
-                else:
-                    time.sleep(READ_SLEEP_TIME)    
-            else:
+            if not remained_read_len:
                 break
-        else:
-            raise TimeoutException('read data block timeouted at %s'%self.__path)
+
+            self.__f_obj.close()
+            if self.__expected_len <= self.__get_seek():
+                break
+            elif partial and ret_data:
+                break
+
+            #wait for data from writer (timeout is raised if nothing is written for a long time)
+            if read_data_len:
+                idle_tries = 0
+            if not self.NOTIFIER.wait(self.__path, self.__get_seek(), READ_SLEEP_TIME):
+                idle_tries += 1
+                if idle_tries >= READ_TRY_COUNT:
+                    raise TimeoutException('read data block timeouted at %s'%self.__path)
 
         return ret_data
 
     def __get_seek(self):
-        self.__lock.acquire()
-        try:
-            return self.__seek
-        finally:
-            self.__lock.release()
+        return self.__seek
+
+    def __restore_for_append(self):
+        """Continue writing at the end of data block. Encryption state is restored
+        from last cipher blocks, so data block is not rewritten
+        """
+        data_len = self.get_actual_size()
+        if self.__encdec:
+            seek = self.__encdec.restore(self.__f_obj, data_len)
+        else:
+            seek = data_len
+
+        if seek is None:
+            logger.debug('rewrite data block %s for appending...'%self.get_name())
+            self.__f_obj.seek(0)
+            self.__restore_db()
+            return
+
+        self.__f_obj.truncate(seek)
+        self.__f_obj.seek(seek)
+        self.__seek = seek
+        self.__lazy_checksum = True
 
     def __restore_db(self):
         cdb = DataBlock(self.__path, actsize=True)
@@ -49,6 +49,38 @@ class EncDecProvider:
             return encrypted
 
 
+    def restore(self, f_obj, data_len):
+        """Restore encryption state for appending to @data_len bytes of encrypted data in @f_obj.
+        Last cipher blocks (which can contain padding) are decrypted and will be encrypted again
+        by next encrypt() call. Returns file position from which encrypted data should be written
+        or None if encryption state can not be restored
+        """
+        f_obj.seek(0)
+        header_size = f_obj.read(2)
+        if len(header_size) < 2:
+            return None
+        enc_data_len = struct.unpack('<H', header_size)[0]
+        data_start = enc_data_len + 2
+        block_size = self.__cipher_class.BLOCK_SIZE
+        cipher_len = data_len - data_start
+        if cipher_len < 0 or cipher_len % block_size:
+            return None
+
+        header = f_obj.read(enc_data_len)
+        tail_len = min(cipher_len, 2 * block_size)
+        tail_start = data_len - tail_len
+        prev_block = None
+        if tail_start > data_start:
+            f_obj.seek(tail_start - block_size)
+            prev_block = f_obj.read(block_size)
+        f_obj.seek(tail_start)
+        tail = f_obj.read(tail_len)
+
+        self.__cipher = self.__cipher_class(header)
+        rest = self.__cipher.restore(prev_block, tail)
+        self.__processed_len = tail_start - data_start + len(rest)
+        return tail_start
+
     def decrypt(self, data):
         data_len = len(data)
         self.__processed_len += data_len
@@ -58,8 +90,8 @@ class EncDecProvider:
             if data_len < enc_data_len+2:
                 raise Exception('Unexpected encrypted header size: %s < %s'%(data_len, enc_data_len+2))
 
-            header = data[2:2+enc_data_len]
-            data = data[enc_data_len+2:]
+            header = str(data[2:2+enc_data_len])
+            data = buffer(data, enc_data_len+2)
 
             self.__cipher = self.__cipher_class(header)
             data_len = len(data)
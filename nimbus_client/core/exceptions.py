@@ -77,3 +77,8 @@ class NoCertFound(NimbusException):
 
 class NoFreeIdentificator(NimbusException):
     pass
+
+class NodeUnavailableException(NimbusException):
+    def __init__(self, msg, retry_after=0):
+        NimbusException.__init__(self, msg)
+        self.retry_after = retry_after
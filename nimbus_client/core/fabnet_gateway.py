@@ -10,143 +10,759 @@ Copyright (C) 2012 Konstantin Andrusenko
 
 This module contains the implementation of gateway API for talking with fabnet
 """
+import sys
+import time
+import types
 import hashlib
+import threading
+from Queue import Queue, Empty
 from nimbus_client.core.fri.fri_base import FabnetPacketRequest, RamBasedBinaryData, FriBinaryData
 from nimbus_client.core.fri.fri_client import FriClient
+from nimbus_client.core.fri.mux_client import FriMuxClient
+from nimbus_client.core.fri.async_client import AsyncFriClient, AsyncSocketChunks
+from nimbus_client.core.fri.event_loop import Return, Future
 from nimbus_client.core.fri.socket_processor import SocketProcessor
-from nimbus_client.core.fri.constants import FRI_CLIENT_TIMEOUT
+from nimbus_client.core.fri.connections_pool import FriConnectionsPool
+from nimbus_client.core.fri.constants import FRI_CLIENT_TIMEOUT, FRI_CLIENT_READ_TIMEOUT
 
 from nimbus_client.core.data_block import DataBlock
-from nimbus_client.core.constants import RC_NO_DATA, DEFAULT_REPLICA_COUNT, FRI_PORT, FILE_ITER_BLOCK_SIZE
+from nimbus_client.core.keys_reservation import KeysReservationPool
+from nimbus_client.core.nodes_monitor import NodesMonitor
+from nimbus_client.core.nodes_health import NodesHealth
+from nimbus_client.core.keys_info_cache import KeysInfoCache
+from nimbus_client.core.constants import RC_NO_DATA, DEFAULT_REPLICA_COUNT, FRI_PORT, FILE_ITER_BLOCK_SIZE, \
+            HEDGED_READS, HEDGED_READ_TIMEOUT, RC_RANGE_MISMATCH, RESUME_RANGE_SIZE, NODE_MAX_CONCURRENCY
+from nimbus_client.core.exceptions import NodeUnavailableException
 from nimbus_client.core.logger import logger
 
 class ChunkedBinaryData(FriBinaryData):
-    @classmethod
-    def prepare(cls, data_block, chunk_size):
-        if isinstance(data_block, DataBlock):
-            return cls(data_block, chunk_size)
-        else:
-            return RamBasedBinaryData(data_block)
-
-    def __init__(self, data_block, chunk_size):
+    """Data block sent by chunks. @on_chunk(size) is called for every read chunk
+    and returns seconds to wait before the chunk is sent. Reader thread sleeps if @blocking_wait is True,
+    otherwise delay is returned by chunk_delay() to sender (async socket processor waits it by loop timer)
+    """
+    def __init__(self, data_block, chunk_size, on_chunk=None, length=None, blocking_wait=True):
         self.__chunk_size = chunk_size
         self.__data_block = data_block
+        self.__on_chunk = on_chunk
+        self.__length = length #bytes from current data block seek (None - up to the end of data block)
+        self.__rest = length
+        self.__blocking_wait = blocking_wait
+        self.__delay = 0
+
+    def __reserve(self, size):
+        if not self.__on_chunk:
+            return
+        delay = self.__on_chunk(size) or 0
+        if self.__blocking_wait:
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            self.__delay = delay
+
+    def chunk_delay(self):
+        delay = self.__delay
+        self.__delay = 0
+        return delay
 
     def chunks_count(self):
-        f_size = self.__data_block.get_actual_size()
+        if self.__length is None:
+            f_size = self.__data_block.get_actual_size()
+        else:
+            f_size = self.__length
         cnt = f_size / self.__chunk_size
         if f_size % self.__chunk_size != 0:
             cnt += 1
         return cnt
 
     def get_next_chunk(self):
-        return self.__data_block.read_raw(self.__chunk_size)
+        rlen = self.__chunk_size
+        if self.__rest is not None:
+            if self.__rest <= 0:
+                return None
+            rlen = min(rlen, self.__rest)
+        chunk = self.__data_block.read_raw(rlen, as_view=True)
+        if chunk:
+            if self.__rest is not None:
+                self.__rest -= len(chunk)
+            self.__reserve(len(chunk))
+        return chunk
 
     def data(self):
-        return self.__data_block.read_raw()
+        if self.__length is not None:
+            return FriBinaryData.data(self)
+        data = self.__data_block.read_raw()
+        if data:
+            self.__reserve(len(data))
+        return data
 
 
 
-class FabnetGateway:
-    @classmethod
-    def force_close_all_connections(cls):
-        SocketProcessor.force_close_flag.set()
+def close_response(resp):
+    """Close binary stream of response (peer stops sending chunks)"""
+    if resp.binary_data:
+        resp.binary_data.close()
 
-    @classmethod
-    def init_socket_processor(cls):
-        SocketProcessor.force_close_flag.clear()
 
-    def __init__(self, fabnet_hostname, security_manager):
+class HedgedRead:
+    """GetDataBlock requests sent to data block replicas in parallel.
+    wait() returns (result, error) of first finished request.
+    Results received after cancel() call are dropped by @drop_result(result) (response is closed by default).
+    Requests are not interrupted by cancel(), so they should be made with finite read timeout
+    """
+    def __init__(self, drop_result=None):
+        self.__drop_result = drop_result or (lambda result: close_response(result[-1]))
+        self.__results = Queue()
+        self.__lock = threading.Lock()
+        self.__cancelled = False
+        self.__in_flight = 0
+
+    def in_flight(self):
+        return self.__in_flight
+
+    def start(self, func, *args):
+        self.__in_flight += 1
+        thrd = threading.Thread(target=self.__run, args=(func, args))
+        thrd.setDaemon(True)
+        thrd.start()
+
+    def call(self, func, *args):
+        """Make request in caller thread (no other request can be hedged while it is in flight)"""
+        self.__in_flight += 1
+        self.__run(func, args)
+
+    def __run(self, func, args):
+        result = err = None
+        try:
+            result = func(*args)
+        except Exception, err:
+            logger.error('[HedgedRead] %s'%err)
+            logger.traceback_debug()
+
+        self.__lock.acquire()
+        try:
+            cancelled = self.__cancelled
+            if not cancelled:
+                self.__results.put((result, err))
+        finally:
+            self.__lock.release()
+
+        if cancelled and result:
+            self.__drop_result(result)
+
+    def wait(self, timeout=None):
+        """Return (result, error) of first finished request or None if it is not finished in @timeout seconds"""
+        try:
+            done = self.__results.get(timeout=timeout)
+        except Empty:
+            return None
+        self.__in_flight -= 1
+        return done
+
+    def cancel(self):
+        self.__lock.acquire()
+        try:
+            self.__cancelled = True
+            results = []
+            while not self.__results.empty():
+                results.append(self.__results.get()[0])
+        finally:
+            self.__lock.release()
+
+        for result in results:
+            if result:
+                self.__drop_result(result)
+
+
+def get_failed_keys(resp):
+    """Return keys that are not removed by multi-key ClientDeleteData call.
+    None is returned if node does not support multi-key delete
+    """
+    if resp.ret_code != 0 or not resp.ret_parameters.has_key('failed_keys'):
+        logger.debug('Multi-key ClientDeleteData failed: %s'%resp.ret_message)
+        return None
+
+    failed_keys = resp.ret_parameters['failed_keys']
+    if failed_keys:
+        logger.error('ClientDeleteData error for keys: %s'%', '.join(failed_keys))
+    return failed_keys
+
+
+def get_reserved_keys(resp):
+    """Return list of (key, node_address) from PutKeysInfo response.
+    Nodes that do not support batched reservation return single key_info
+    """
+    if resp.ret_code != 0:
+        raise Exception('Key info error: %s'%resp.ret_message)
+
+    if resp.ret_parameters.has_key('keys_info'):
+        return [tuple(key_info) for key_info in resp.ret_parameters['keys_info']]
+    if resp.ret_parameters.has_key('key_info'):
+        return [tuple(resp.ret_parameters['key_info'])]
+    raise Exception('Invalid PutKeysInfo response! key_info is expected')
+
+
+def check_put_response(resp, data_block):
+    """Return primary key of saved data block"""
+    if resp.ret_code != 0:
+        raise Exception('ClientPutData error: %s'%resp.ret_message)
+
+    if not resp.ret_parameters.has_key('key'):
+        raise Exception('put data block error: no data key found in response message "%s"'%resp)
+
+    checksum = resp.ret_parameters['checksum']
+    if isinstance(data_block, DataBlock):
+        db_checksum = data_block.checksum()
+    else:
+        db_checksum = hashlib.sha1(data_block).hexdigest()
+
+    if checksum != db_checksum:
+        raise Exception('Invalid data block checksum!')
+    return resp.ret_parameters['key']
+
+
+def is_node_failure(resp):
+    return resp.ret_code not in (0, RC_NO_DATA, RC_RANGE_MISMATCH)
+
+
+def get_range_offset(resp):
+    """Return size of data saved by node from ranged ClientPutData response.
+    None is returned if node does not support ranged uploads (range is saved as whole data block)
+    """
+    return resp.ret_parameters.get('offset', None)
+
+
+def get_skipped_len(resp, offset):
+    """Return count of bytes that should be skipped in GetDataBlock response stream.
+    Nodes that do not support ranged reads send data block from the beginning
+    """
+    if offset and not resp.ret_parameters.has_key('offset'):
+        return offset
+    return 0
+
+
+def crossed_range(offset, data_len, range_size):
+    """Returns True if range boundary is reached by writing @data_len bytes at @offset"""
+    return bool(range_size) and (offset / range_size) != ((offset + data_len) / range_size)
+
+
+def raise_unavailable(primary_key, retry_delays):
+    raise NodeUnavailableException('All replicas of data block %s are unavailable'%primary_key, \
+            min(retry_delays))
+
+
+def complete(coro):
+    """Run coroutine of blocking gateway in current thread.
+    Blocking calls return results instead of futures, so yielded value is sent back to coroutine
+    (yielded coroutines are completed in place). Returns value of Return
+    """
+    value = exc_info = None
+    while True:
+        try:
+            if exc_info:
+                yielded = coro.throw(*exc_info)
+            else:
+                yielded = coro.send(value)
+        except Return, ret:
+            return ret.value
+        except StopIteration:
+            return None
+
+        value, exc_info = yielded, None
+        if isinstance(yielded, types.GeneratorType):
+            try:
+                value = complete(yielded)
+            except Exception:
+                value, exc_info = None, sys.exc_info()
+
+
+class AbstractFabnetGateway:
+    """Transfer logic shared by blocking and asynchronous gateways.
+    Methods with underscore prefix are coroutines, their I/O points are
+    _call (node call), _next_chunk (receiving of binary data chunk) and _wait (bandwidth delay)
+    """
+    WAIT_RESERVED_KEYS = True
+
+    def __init__(self, fabnet_hostname, security_manager, range_size=RESUME_RANGE_SIZE, \
+            max_node_calls=NODE_MAX_CONCURRENCY):
         if ':' not in fabnet_hostname:
             fabnet_hostname += ':%s'%FRI_PORT
         self.fabnet_hostname = fabnet_hostname
         self.security_manager = security_manager
+        self.range_size = range_size
+        self.no_ranges_nodes = set() #nodes that do not support ranged uploads
+        self.nodes_monitor = NodesMonitor()
+        self.nodes_health = NodesHealth(max_concurrency=max_node_calls)
+        self.keys_info_cache = KeysInfoCache()
+        self.fri_client = None
+        self.keys_fri_client = None #client for keys reservation (fri_client is used if None)
+        self.blocking_wait = True #bandwidth delay of sent chunk is waited by chunk reader (see ChunkedBinaryData)
+        self.keys_pool = KeysReservationPool(self._reserve_keys)
 
-        cert = self.security_manager.get_client_cert()
-        ckey = self.security_manager.get_client_cert_key()
-        self.fri_client = FriClient(bool(ckey), cert, ckey)
+    def _call(self, node_addr, packet, read_timeout=FRI_CLIENT_READ_TIMEOUT):
+        """Call node. Returns response (or future of response)"""
+        pass
 
-    def put(self, data_block, key=None, replica_count=DEFAULT_REPLICA_COUNT, wait_writes_count=2, allow_rewrite=True):
-        packet = FabnetPacketRequest(method='PutKeysInfo', parameters={'key': key}, sync=True)
-        resp = self.fri_client.call_sync(self.fabnet_hostname, packet, FRI_CLIENT_TIMEOUT)
-        if resp.ret_code != 0:
-            raise Exception('Key info error: %s'%resp.ret_message)
+    def _next_chunk(self, binary_data):
+        """Returns next chunk (or future of chunk) of response binary data"""
+        pass
 
-        if not resp.ret_parameters.has_key('key_info'):
-            raise Exception('Invalid PutKeysInfo response! key_info is expected')
+    def _wait(self, delay):
+        """Wait @delay seconds (or returns future)"""
+        pass
 
-        key_info = resp.ret_parameters['key_info']
-        key, node_addr = key_info
+    def _throttle(self, on_chunk, size):
+        """Account chunk by @on_chunk and wait returned delay"""
+        delay = on_chunk(size) if on_chunk else 0
+        if delay > 0:
+            yield self._wait(delay)
 
-        params = {'key':key, 'replica_count':replica_count, \
-                    'wait_writes_count': wait_writes_count}
-        packet = FabnetPacketRequest(method='ClientPutData', parameters=params, \
-                        binary_data=ChunkedBinaryData.prepare(data_block, FILE_ITER_BLOCK_SIZE), sync=True)
+    def _binary_data(self, data_block, on_chunk, length=None):
+        return ChunkedBinaryData(data_block, FILE_ITER_BLOCK_SIZE, on_chunk, length, self.blocking_wait)
 
-        resp = self.fri_client.call_sync(node_addr, packet, FRI_CLIENT_TIMEOUT)
-        try:
-            if resp.ret_code != 0:
-                raise Exception('ClientPutData error: %s'%resp.ret_message)
+    def _reserve_keys(self, count):
+        packet = FabnetPacketRequest(method='PutKeysInfo', parameters={'key': None, 'count': count}, sync=True)
+        fri_client = self.keys_fri_client or self.fri_client
+        resp = fri_client.call_sync(self.fabnet_hostname, packet, FRI_CLIENT_TIMEOUT)
+        return get_reserved_keys(resp)
 
-            if not resp.ret_parameters.has_key('key'):
-                raise Exception('put data block error: no data key found in response message "%s"'%resp)
+    def _put(self, data_block, key=None, replica_count=DEFAULT_REPLICA_COUNT, wait_writes_count=2, allow_rewrite=True, \
+            on_chunk=None, range_info=None, on_range=None):
+        reserved = None
+        offset = 0
+        if range_info:
+            key, node_addr, offset = range_info
+            reserved = (key, node_addr)
+        elif key is None:
+            reserved = self.keys_pool.get(wait=self.WAIT_RESERVED_KEYS, accept=self.nodes_health.is_available)
 
-            primary_key = resp.ret_parameters['key']
-            checksum = resp.ret_parameters['checksum']
-            if isinstance(data_block, DataBlock):
-                db_checksum = data_block.checksum()
-            else:
-                db_checksum = hashlib.sha1(data_block).hexdigest()
+        if reserved:
+            key, node_addr = reserved
+        else:
+            packet = FabnetPacketRequest(method='PutKeysInfo', parameters={'key': key}, sync=True)
+            resp = yield self._call(self.fabnet_hostname, packet)
+            key, node_addr = get_reserved_keys(resp)[0]
 
-            if checksum != db_checksum:
-                raise Exception('Invalid data block checksum!')
+        params = {'key':key, 'replica_count':replica_count, \
+                    'wait_writes_count': wait_writes_count}
+        if self.__is_ranged(data_block, node_addr):
+            resp = yield self._put_ranges(data_block, node_addr, params, offset, on_chunk, on_range)
+        elif isinstance(data_block, DataBlock):
+            packet = FabnetPacketRequest(method='ClientPutData', parameters=params, \
+                        binary_data=self._binary_data(data_block, on_chunk), sync=True)
+            resp = yield self._call_node(node_addr, packet)
+        else:
+            yield self._throttle(on_chunk, len(data_block))
+            packet = FabnetPacketRequest(method='ClientPutData', parameters=params, \
+                        binary_data=RamBasedBinaryData(data_block), sync=True)
+            resp = yield self._call_node(node_addr, packet)
+
+        try:
+            primary_key = check_put_response(resp, data_block)
         except Exception, err:
             logger.error('[put] %s'%err)
-            logger.traceback_debug()            
+            logger.traceback_debug()
             if not allow_rewrite:
-                self.remove(key, replica_count)
+                yield self._remove(key, replica_count)
+                if on_range:
+                    on_range(None, None, 0)
             raise err
 
-        return primary_key
+        raise Return(primary_key)
 
-    def remove(self, key, replica_count=DEFAULT_REPLICA_COUNT):
+    def __is_ranged(self, data_block, node_addr):
+        return isinstance(data_block, DataBlock) and self.range_size and node_addr not in self.no_ranges_nodes \
+                and data_block.get_actual_size() > self.range_size
+
+    def _call_node(self, node_addr, packet):
+        self.nodes_health.acquire(node_addr)
+        resp = None
+        try:
+            resp = yield self._call(node_addr, packet)
+        finally:
+            self.nodes_health.release(node_addr, resp is None or is_node_failure(resp))
+        raise Return(resp)
+
+    def _put_ranges(self, data_block, node_addr, params, offset, on_chunk, on_range):
+        """Send data block from @offset by ranges. Returns response for last range.
+        Node responds with size of saved data (RC_RANGE_MISMATCH if it is not equal to range offset)
+        """
+        size = data_block.get_actual_size()
+        while True:
+            length = min(self.range_size, size - offset)
+            is_last = offset + length >= size
+            r_params = dict(params)
+            r_params.update({'offset': offset, 'is_last': is_last})
+            data_block.seek_raw(offset)
+            packet = FabnetPacketRequest(method='ClientPutData', parameters=r_params, \
+                    binary_data=self._binary_data(data_block, on_chunk, length), sync=True)
+            resp = yield self._call_node(node_addr, packet)
+            if resp.ret_code not in (0, RC_RANGE_MISMATCH) or (is_last and resp.ret_code == 0):
+                raise Return(resp)
+
+            node_offset = get_range_offset(resp)
+            if node_offset is None:
+                logger.debug('Node %s does not support ranged uploads, sending whole data block...'%node_addr)
+                self.no_ranges_nodes.add(node_addr)
+                data_block.seek_raw(0)
+                packet = FabnetPacketRequest(method='ClientPutData', parameters=params, \
+                        binary_data=self._binary_data(data_block, on_chunk), sync=True)
+                resp = yield self._call_node(node_addr, packet)
+                raise Return(resp)
+
+            if resp.ret_code == RC_RANGE_MISMATCH:
+                if node_offset >= size:
+                    raise Exception('ClientPutData error: invalid saved data size %s for key %s'%(node_offset, params['key']))
+                logger.info('Node %s has %s bytes of %s, continue upload from this offset'%\
+                        (node_addr, node_offset, params['key']))
+            offset = node_offset
+            if on_range:
+                on_range(params['key'], node_addr, offset)
+
+    def _remove(self, key, replica_count=DEFAULT_REPLICA_COUNT):
+        self.keys_info_cache.invalidate(key)
         params = {'key':key, 'replica_count':replica_count}
         packet = FabnetPacketRequest(method='ClientDeleteData', parameters=params, sync=True)
-        resp = self.fri_client.call_sync(self.fabnet_hostname, packet, FRI_CLIENT_TIMEOUT)
+        resp = yield self._call(self.fabnet_hostname, packet)
         if resp.ret_code != 0:
             logger.error('ClientDeleteData error: %s'%resp.ret_message)
-            return False
-        return True
+            raise Return(False)
+        raise Return(True)
+
+    def _remove_keys(self, keys, replica_count=DEFAULT_REPLICA_COUNT):
+        """Remove data blocks by single ClientDeleteData call.
+        Nodes that do not support multi-key delete are called for every key.
+        Returns list of keys that are not removed
+        """
+        failed_keys = None
+        if len(keys) > 1:
+            for key in keys:
+                self.keys_info_cache.invalidate(key)
+            params = {'keys': keys, 'replica_count': replica_count}
+            packet = FabnetPacketRequest(method='ClientDeleteData', parameters=params, sync=True)
+            resp = yield self._call(self.fabnet_hostname, packet)
+            failed_keys = get_failed_keys(resp)
+
+        if failed_keys is None:
+            failed_keys = []
+            for key in keys:
+                is_removed = yield self._remove(key, replica_count)
+                if not is_removed:
+                    failed_keys.append(key)
+        raise Return(failed_keys)
+
+    def _get(self, primary_key, replica_count, data_block, on_chunk=None, on_range=None):
+        keys_info = self.keys_info_cache.get(primary_key, replica_count)
+        if keys_info is not None:
+            is_read = yield self._get_from_replicas(primary_key, keys_info, data_block, on_chunk, on_range)
+            if is_read:
+                raise Return(data_block)
+            #cached locations can be outdated
+            self.keys_info_cache.invalidate(primary_key)
 
-    def get(self, primary_key, replica_count, data_block):
         packet = FabnetPacketRequest(method='GetKeysInfo', parameters={'key': primary_key, 'replica_count': replica_count}, sync=True)
-        resp = self.fri_client.call_sync(self.fabnet_hostname, packet, FRI_CLIENT_TIMEOUT)
+        resp = yield self._call(self.fabnet_hostname, packet)
         if resp.ret_code != 0:
             raise Exception('Get keys info error: %s'%resp.ret_message)
 
         keys_info = resp.ret_parameters['keys_info']
-        for key, is_replica, node_addr in keys_info:
-            params = {'key': key, 'is_replica': is_replica}
-            packet = FabnetPacketRequest(method='GetDataBlock', parameters=params, sync=True)
-            resp = self.fri_client.call_sync(node_addr, packet, FRI_CLIENT_TIMEOUT)
-
-            if resp.ret_code == RC_NO_DATA:
-                logger.error('No data found for key %s on node %s'%(key, node_addr))
-            elif resp.ret_code != 0:
-                logger.error('Get data block error for key %s from node %s: %s'%(key, node_addr, resp.ret_message))
-            elif resp.ret_code == 0:
-                exp_checksum = resp.ret_parameters['checksum']
-                while True:
-                    chunk = resp.binary_data.get_next_chunk()
-                    if not chunk:
-                        break
-                    data_block.write(chunk, encrypt=False)
-
-                if exp_checksum != data_block.checksum():
-                    logger.error('Currupted data block for key %s from node %s'%(primary_key, node_addr))
+        self.keys_info_cache.put(primary_key, replica_count, keys_info)
+        is_read = yield self._get_from_replicas(primary_key, keys_info, data_block, on_chunk, on_range)
+        if is_read:
+            raise Return(data_block)
+        raise Return(None)
+
+    def _get_from_replicas(self, primary_key, keys_info, data_block, on_chunk=None, on_range=None):
+        """Replicas are requested one by one (best known replica first) until data block is received.
+        Replicas on unavailable nodes are skipped, NodeUnavailableException is raised if all of them are skipped
+        """
+        retry_delays = []
+        for key, is_replica, node_addr in self.sort_replicas(keys_info):
+            if not self.acquire_replica(node_addr, retry_delays):
+                continue
+
+            data_block.flush()
+            offset = data_block.get_actual_size()
+            key, node_addr, resp = yield self._fetch_data_block(key, is_replica, node_addr, offset)
+            is_read = yield self._read_data_block(primary_key, key, node_addr, resp, data_block, offset, on_chunk, on_range)
+            if is_read:
+                raise Return(True)
+
+        if len(retry_delays) == len(keys_info):
+            raise_unavailable(primary_key, retry_delays)
+        raise Return(False)
+
+    def sort_replicas(self, keys_info):
+        """Available nodes first, better nodes first"""
+        keys_info = self.nodes_monitor.sort_nodes(keys_info, lambda key_info: key_info[2])
+        return self.nodes_health.sort_nodes(keys_info, lambda key_info: key_info[2])
+
+    def acquire_replica(self, node_addr, retry_delays):
+        """Returns False if node is unavailable now (its retry delay is appended to @retry_delays)"""
+        try:
+            self.nodes_health.acquire(node_addr)
+        except NodeUnavailableException, err:
+            logger.debug('%s, skipping it...'%err)
+            retry_delays.append(err.retry_after)
+            return False
+        return True
+
+    def _fetch_data_block(self, key, is_replica, node_addr, offset, read_timeout=FRI_CLIENT_READ_TIMEOUT):
+        """Request data block from node acquired by acquire_replica method.
+        If data block is found, node call slot is held until response is read or dropped
+        """
+        params = {'key': key, 'is_replica': is_replica}
+        if offset:
+            params['offset'] = offset
+        packet = FabnetPacketRequest(method='GetDataBlock', parameters=params, sync=True)
+        t0 = time.time()
+        resp = None
+        try:
+            resp = yield self._call(node_addr, packet, read_timeout)
+        finally:
+            if resp is None or resp.ret_code != 0:
+                self.nodes_health.release(node_addr, resp is None or is_node_failure(resp))
+        if resp.ret_code == 0:
+            self.nodes_monitor.add_response(node_addr, time.time() - t0)
+        elif resp.ret_code != RC_NO_DATA:
+            self.nodes_monitor.add_error(node_addr)
+        raise Return((key, node_addr, resp))
+
+    def drop_data_block(self, result):
+        """Close response of fetched data block that is not read"""
+        key, node_addr, resp = result
+        close_response(resp)
+        if resp.ret_code == 0:
+            self.nodes_health.release(node_addr, False)
+
+    def _read_data_block(self, primary_key, key, node_addr, resp, data_block, offset, on_chunk, on_range):
+        """Write received data block from @offset. Returns False if data block is not received"""
+        if resp.ret_code == RC_NO_DATA:
+            logger.error('No data found for key %s on node %s'%(key, node_addr))
+            self.keys_info_cache.invalidate(primary_key)
+            raise Return(False)
+        if resp.ret_code != 0:
+            logger.error('Get data block error for key %s from node %s: %s'%(key, node_addr, resp.ret_message))
+            raise Return(False)
+
+        is_failed = True
+        try:
+            is_read = yield self.__write_data_block(primary_key, node_addr, resp, data_block, offset, on_chunk, on_range)
+            is_failed = False
+        finally:
+            self.nodes_health.release(node_addr, is_failed)
+        raise Return(is_read)
+
+    def __write_data_block(self, primary_key, node_addr, resp, data_block, offset, on_chunk, on_range):
+        if data_block.get_actual_size() < offset:
+            #received data is dropped (corrupted data block)
+            close_response(resp)
+            raise Return(False)
+
+        exp_checksum = resp.ret_parameters['checksum']
+        skip_len = get_skipped_len(resp, offset)
+        data_block.truncate_raw(offset)
+        t0 = time.time()
+        size = 0
+        while resp.binary_data:
+            chunk = yield self._next_chunk(resp.binary_data)
+            if not chunk:
+                break
+            if skip_len:
+                if len(chunk) <= skip_len:
+                    skip_len -= len(chunk)
                     continue
-                return data_block
+                chunk = chunk[skip_len:]
+                skip_len = 0
+            data_block.write(chunk, encrypt=False)
+            #next chunk is received after bandwidth delay
+            yield self._throttle(on_chunk, len(chunk))
+            if on_range and crossed_range(offset + size, len(chunk), self.range_size):
+                data_block.flush()
+                on_range(offset + size + len(chunk))
+            size += len(chunk)
+        self.nodes_monitor.add_transfer(node_addr, size, time.time() - t0)
+
+        if exp_checksum != data_block.checksum():
+            logger.error('Currupted data block for key %s from node %s'%(primary_key, node_addr))
+            self.nodes_monitor.add_error(node_addr)
+            self.keys_info_cache.invalidate(primary_key)
+            data_block.truncate_raw(0)
+            if on_range:
+                on_range(0)
+            raise Return(False)
+        raise Return(True)
+
+
+class FabnetGateway(AbstractFabnetGateway):
+    @classmethod
+    def force_close_all_connections(cls):
+        SocketProcessor.force_close_flag.set()
 
+    @classmethod
+    def init_socket_processor(cls):
+        SocketProcessor.force_close_flag.clear()
+
+    def __init__(self, fabnet_hostname, security_manager, multiplexed=False, hedged_reads=HEDGED_READS, \
+            range_size=RESUME_RANGE_SIZE, max_node_calls=NODE_MAX_CONCURRENCY, hedged_read_timeout=HEDGED_READ_TIMEOUT):
+        AbstractFabnetGateway.__init__(self, fabnet_hostname, security_manager, range_size, max_node_calls)
+        self.hedged_reads = hedged_reads
+        self.hedged_read_timeout = hedged_read_timeout
+
+        cert = self.security_manager.get_client_cert()
+        ckey = self.security_manager.get_client_cert_key()
+        self.connections_pool = FriConnectionsPool()
+        if multiplexed:
+            self.fri_client = FriMuxClient(bool(ckey), cert, ckey, self.connections_pool)
+            #chunks are read under connection send lock, so channel waits after sending
+            self.blocking_wait = False
+        else:
+            self.fri_client = FriClient(bool(ckey), cert, ckey, self.connections_pool)
+
+    def close(self):
+        self.keys_pool.stop()
+        if isinstance(self.fri_client, FriMuxClient):
+            self.fri_client.close()
+        self.connections_pool.close_all()
+
+    def _call(self, node_addr, packet, read_timeout=FRI_CLIENT_READ_TIMEOUT):
+        return self.fri_client.call_sync(node_addr, packet, FRI_CLIENT_TIMEOUT, read_timeout)
+
+    def _next_chunk(self, binary_data):
+        return binary_data.get_next_chunk()
+
+    def _wait(self, delay):
+        time.sleep(delay)
+
+    def put(self, data_block, key=None, replica_count=DEFAULT_REPLICA_COUNT, wait_writes_count=2, allow_rewrite=True, \
+            on_chunk=None, range_info=None, on_range=None):
+        """Save data block to fabnet. NodeUnavailableException is raised if
+        target node is unavailable now (nothing is sent to node in this case).
+        @on_chunk(size) is called for every sent chunk of data block.
+        Data blocks larger than range size are sent by ranges, @on_range(key, node_addr, offset)
+        is called for every range saved by node ((None, None, 0) if saved data is dropped).
+        Interrupted put is continued from (key, node_addr, offset) @range_info
+        """
+        return complete(self._put(data_block, key, replica_count, wait_writes_count, allow_rewrite, \
+                on_chunk, range_info, on_range))
+
+    def remove(self, key, replica_count=DEFAULT_REPLICA_COUNT):
+        return complete(self._remove(key, replica_count))
+
+    def remove_keys(self, keys, replica_count=DEFAULT_REPLICA_COUNT):
+        return complete(self._remove_keys(keys, replica_count))
+
+    def get(self, primary_key, replica_count, data_block, on_chunk=None, on_range=None):
+        """Read data block from fabnet. @on_chunk(size) is called for every received chunk.
+        Data already saved in @data_block is not requested again (interrupted read is continued),
+        @on_range(offset) is called when next range of data block is received and flushed
+        """
+        return complete(self._get(primary_key, replica_count, data_block, on_chunk, on_range))
+
+    def __fetch(self, key, is_replica, node_addr, offset):
+        #request of cancelled hedged read is not interrupted, so it is limited by read timeout
+        return complete(self._fetch_data_block(key, is_replica, node_addr, offset, self.hedged_read_timeout))
+
+    def __start_fetch(self, fetches, pending, retry_delays, offset):
+        """Request data block from first available replica from @pending.
+        Returns node address or None if no available replica found
+        """
+        while pending:
+            key, is_replica, node_addr = pending.pop(0)
+            if not self.acquire_replica(node_addr, retry_delays):
+                continue
+
+            if fetches.in_flight() or (self.hedged_reads and pending):
+                fetches.start(self.__fetch, key, is_replica, node_addr, offset)
+            else:
+                fetches.call(self.__fetch, key, is_replica, node_addr, offset)
+            return node_addr
         return None
 
+    def _get_from_replicas(self, primary_key, keys_info, data_block, on_chunk=None, on_range=None):
+        """Best known replica is requested first. In hedged mode next replica is requested
+        if response is not received in time (first received response is used, others are cancelled).
+        Replicas on unavailable nodes are skipped, NodeUnavailableException is raised if all of them are skipped
+        """
+        data_block.flush()
+        offset = data_block.get_actual_size()
+        pending = self.sort_replicas(keys_info)
+        fetches = HedgedRead(self.drop_data_block)
+        last_node = None
+        retry_delays = []
+        try:
+            while pending or fetches.in_flight():
+                if pending and not fetches.in_flight():
+                    last_node = self.__start_fetch(fetches, pending, retry_delays, offset) or last_node
+                    continue
+
+                timeout = None
+                if pending and self.hedged_reads:
+                    timeout = self.nodes_monitor.hedge_delay(last_node)
+                done = fetches.wait(timeout)
+                if done is None:
+                    logger.debug('No response from %s in %.3f seconds, requesting other replica...'%(last_node, timeout))
+                    last_node = self.__start_fetch(fetches, pending, retry_delays, offset) or last_node
+                    continue
+
+                result, err = done
+                if err:
+                    continue
+                key, node_addr, resp = result
+                is_read = yield self._read_data_block(primary_key, key, node_addr, resp, data_block, offset, \
+                        on_chunk, on_range)
+                if is_read:
+                    raise Return(True)
+        finally:
+            fetches.cancel()
+
+        if len(retry_delays) == len(keys_info):
+            raise_unavailable(primary_key, retry_delays)
+        raise Return(False)
+
+
+class AsyncFabnetGateway(AbstractFabnetGateway):
+    """Fabnet gateway for EventLoop. put, get and remove methods are coroutines"""
+    WAIT_RESERVED_KEYS = False
+
+    def __init__(self, loop, fabnet_hostname, security_manager, range_size=RESUME_RANGE_SIZE, \
+            max_node_calls=NODE_MAX_CONCURRENCY):
+        AbstractFabnetGateway.__init__(self, fabnet_hostname, security_manager, range_size, max_node_calls)
+        self.loop = loop
+        self.blocking_wait = False
+
+        cert = self.security_manager.get_client_cert()
+        ckey = self.security_manager.get_client_cert_key()
+        self.connections_pool = FriConnectionsPool()
+        self.fri_client = AsyncFriClient(loop, bool(ckey), cert, ckey, self.connections_pool)
+        #keys are reserved by background thread, so it uses blocking client
+        self.keys_fri_client = FriClient(bool(ckey), cert, ckey)
+
+    def close(self):
+        self.keys_pool.stop()
+        self.connections_pool.close_all()
+
+    def _call(self, node_addr, packet, read_timeout=FRI_CLIENT_READ_TIMEOUT):
+        return self.fri_client.call_sync(node_addr, packet, FRI_CLIENT_TIMEOUT, read_timeout)
+
+    def _next_chunk(self, binary_data):
+        if isinstance(binary_data, AsyncSocketChunks):
+            return binary_data.get_next_chunk()
+        future = Future()
+        future.set_result(binary_data.get_next_chunk())
+        return future
+
+    def _wait(self, delay):
+        return self.loop.sleep(delay)
+
+    def put(self, data_block, key=None, replica_count=DEFAULT_REPLICA_COUNT, wait_writes_count=2, allow_rewrite=True, \
+            on_chunk=None, range_info=None, on_range=None):
+        return self._put(data_block, key, replica_count, wait_writes_count, allow_rewrite, on_chunk, range_info, on_range)
+
+    def remove(self, key, replica_count=DEFAULT_REPLICA_COUNT):
+        return self._remove(key, replica_count)
+
+    def remove_keys(self, keys, replica_count=DEFAULT_REPLICA_COUNT):
+        return self._remove_keys(keys, replica_count)
 
+    def get(self, primary_key, replica_count, data_block, on_chunk=None, on_range=None):
+        return self._get(primary_key, replica_count, data_block, on_chunk, on_range)
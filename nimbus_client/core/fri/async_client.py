@@ -0,0 +1,449 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package fabnet.core.async_client
+@author Konstantin Andrusenko
+@date May 27, 2013
+
+This module contains the implementation of AsyncSocketProcessor and AsyncFriClient classes.
+
+All methods that do network IO are coroutines (see event_loop module),
+so a lot of FRI calls can be processed concurrently by single EventLoop thread.
+"""
+import errno
+import select
+import socket
+import ssl
+
+from constants import BUF_SIZE, RC_ERROR, RC_REQ_CERTIFICATE, FRI_PACKET_INFO_LEN, \
+            RC_REQ_BINARY_CHUNK, FRI_BINARY_WINDOW, FRI_COMPACT_HEADER, \
+            FRI_COMPACT_PROTOCOL_IDENTIFIER, FRI_CLIENT_TIMEOUT, FRI_CLIENT_READ_TIMEOUT
+
+from fri_base import FriBinaryProcessor, FabnetPacketRequest, FabnetPacketResponse, \
+            FriException, FriBinaryData, RamBasedBinaryData, FabnetPacket, can_resend
+from socket_processor import SocketProcessor
+from connections_pool import parse_node_address, tune_socket
+from event_loop import Return
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class AsyncSocketChunks(FriBinaryData):
+    """Binary chunks stream received by AsyncSocketProcessor.
+    get_next_chunk method is a coroutine
+    """
+    def __init__(self, socket_processor, chunks_count, window=0):
+        self.__sock_proc = socket_processor
+        self.__chunks_count = chunks_count
+        self.__window = window
+        self.__granted = 0
+        self.__last_idx = 0
+
+    def chunks_count(self):
+        return self.__chunks_count
+
+    def __grant_chunks(self):
+        in_flight = self.__granted - self.__last_idx
+        if self.__window > 1:
+            if in_flight > self.__window / 2:
+                return
+            cnt = min(self.__window - in_flight, self.__chunks_count - self.__granted)
+        elif in_flight:
+            return
+        else:
+            cnt = 1
+
+        if cnt <= 0:
+            return
+        if self.__window > 1:
+            req = FabnetPacketResponse(ret_code=RC_REQ_BINARY_CHUNK, binary_window=cnt)
+        else:
+            req = FabnetPacketResponse(ret_code=RC_REQ_BINARY_CHUNK)
+        yield self.__sock_proc.write_packet(req)
+        self.__granted += cnt
+
+    def get_next_chunk(self):
+        if self.__last_idx >= self.__chunks_count:
+            raise Return(None)
+        if not self.__sock_proc:
+            raise FriException('Binary data stream is closed')
+
+        try:
+            yield self.__grant_chunks()
+            packet, bin_data = yield self.__sock_proc.read_next_packet()
+            self.__last_idx += 1
+
+            if packet.binary_chunk_idx > packet.binary_chunk_cnt:
+                raise FriException('Chunk index is bigger than chunks count (%s>%s)'% \
+                        (packet.binary_chunk_idx, packet.binary_chunk_cnt))
+
+            if self.__last_idx == self.__chunks_count:
+                self.__detach()
+        except Exception, err:
+            if self.__sock_proc:
+                self.__sock_proc.set_failed()
+                self.__detach()
+            raise err
+
+        raise Return(bin_data)
+
+    def __detach(self):
+        sock_proc = self.__sock_proc
+        self.__sock_proc = None
+        sock_proc.allow_close_socket()
+
+    def close(self):
+        if self.__sock_proc:
+            if self.__last_idx < self.__chunks_count:
+                self.__sock_proc.set_failed()
+            self.__detach()
+
+
+class AsyncSocketProcessor:
+    """Non-blocking analog of SocketProcessor.
+    read_next_packet, recv_packet, write_packet and send_packet methods are coroutines
+    """
+    def __init__(self, loop, sock, cert=None, binary_window=FRI_BINARY_WINDOW, compact_header=FRI_COMPACT_HEADER):
+        self.__loop = loop
+        self.__sock = sock
+        self.__cert = cert
+        self.__timeout = None
+        self.binary_window = binary_window
+        self.__compact_header = compact_header
+        self.__compact_peer = False
+        self.__can_close_socket = False
+        self.__on_release = None
+        self.__is_failed = False
+        self.packets_received = 0
+        sock.setblocking(0)
+
+    def __wait_io(self, err):
+        """Return Future for waiting socket readiness or None if @err is not 'would block' error"""
+        if isinstance(err, ssl.SSLError):
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                return self.__loop.wait_readable(self.__sock, self.__timeout)
+            if err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                return self.__loop.wait_writable(self.__sock, self.__timeout)
+            return None
+        if err.args[0] == errno.EINTR:
+            return self.__loop.sleep(0)
+        if err.args[0] in WOULD_BLOCK:
+            return self.__loop.wait_readable(self.__sock, self.__timeout)
+        return None
+
+    def __recv_into(self, view):
+        size = len(view)
+        received = 0
+        while received < size:
+            if SocketProcessor.force_close_flag.is_set():
+                raise FriException('forcing socket close!')
+            if not self.__sock:
+                raise FriException('Socket is closed')
+
+            try:
+                cnt = self.__sock.recv_into(view[received:], min(size-received, BUF_SIZE))
+            except socket.error, err:
+                future = self.__wait_io(err)
+                if future is None:
+                    raise err
+                yield future
+                continue
+
+            if not cnt:
+                break
+            received += cnt
+        raise Return(received)
+
+    def __send_all(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            if not self.__sock:
+                raise FriException('Socket is closed')
+            try:
+                sent += self.__sock.send(view[sent:sent+BUF_SIZE])
+            except socket.error, err:
+                if isinstance(err, ssl.SSLError):
+                    future = self.__wait_io(err)
+                elif err.args[0] in WOULD_BLOCK:
+                    future = self.__loop.wait_writable(self.__sock, self.__timeout)
+                else:
+                    future = None
+                if future is None:
+                    raise err
+                yield future
+
+    def __send_buffers(self, buffers):
+        for buf in buffers:
+            if buf:
+                yield self.__send_all(buf)
+
+    def read_next_packet(self):
+        p_info = bytearray(FRI_PACKET_INFO_LEN)
+        received = yield self.__recv_into(memoryview(p_info))
+        if not received:
+            raise FriException('empty data block')
+
+        exp_len, header_len = FriBinaryProcessor.get_expected_len(p_info[:received])
+        if exp_len < FRI_PACKET_INFO_LEN:
+            raise FriException('Invalid FRI packet! Packet length %s is too small'%exp_len)
+
+        data = bytearray(exp_len)
+        view = memoryview(data)
+        view[:FRI_PACKET_INFO_LEN] = p_info
+        received += yield self.__recv_into(view[FRI_PACKET_INFO_LEN:])
+
+        packet, bin_data = FriBinaryProcessor.from_binary(view[:received], exp_len, header_len)
+        packet = FabnetPacket.create(packet)
+        if self.__compact_header and not self.__compact_peer:
+            self.__compact_peer = p_info[:4] == FRI_COMPACT_PROTOCOL_IDENTIFIER \
+                    or packet.header_codec == FRI_COMPACT_PROTOCOL_IDENTIFIER
+        self.packets_received += 1
+        raise Return((packet, bin_data))
+
+    def __send_cert(self):
+        req = FabnetPacketRequest(method='crtput', parameters={'certificate': self.__cert})
+        yield self.write_packet(req)
+
+    def recv_packet(self):
+        packet, bin_data = yield self.read_next_packet()
+        if packet.is_response and packet.ret_code == RC_REQ_CERTIFICATE:
+            yield self.__send_cert()
+            packet, bin_data = yield self.read_next_packet()
+
+        cnt = packet.binary_chunk_cnt
+        if cnt > 0 and bin_data:
+            raise FriException('Binary data found in init chunk packet (%s chunks expected)'%cnt)
+
+        if cnt > 0:
+            window = min(packet.binary_window, self.binary_window)
+            packet.binary_data = AsyncSocketChunks(self, cnt, window)
+            self.__can_close_socket = False
+            raise Return(packet)
+
+        if bin_data:
+            packet.binary_data = RamBasedBinaryData(bin_data)
+        self.__can_close_socket = True
+        raise Return(packet)
+
+    def send_packet(self, packet, wait_response=False):
+        if packet.binary_data and packet.binary_data.chunks_count() > 1:
+            packet.binary_chunk_cnt = packet.binary_data.chunks_count()
+            packet.binary_window = self.binary_window
+
+            yield self.write_packet(packet, with_bin=False)
+            packet.binary_window = 0
+
+            if packet.is_request:
+                allow_packet, _ = yield self.read_next_packet()
+                if allow_packet.is_response and allow_packet.ret_code == RC_REQ_CERTIFICATE:
+                    yield self.__send_cert()
+
+            credits = 0
+            for i in xrange(packet.binary_chunk_cnt):
+                if not credits:
+                    resp_packet = yield self.recv_packet()
+                    if resp_packet.ret_code != RC_REQ_BINARY_CHUNK:
+                        raise Return(resp_packet)
+                    credits = max(1, resp_packet.binary_window)
+
+                credits -= 1
+                packet.binary_chunk_idx = i+1
+                buffers = packet.dump_next_chunk_buffers(self.__compact_peer)
+                delay = packet.binary_data.chunk_delay()
+                if delay > 0:
+                    yield self.__loop.sleep(delay)
+                yield self.__send_buffers(buffers)
+
+            packet.binary_chunk_cnt = None
+            packet.binary_chunk_idx = None
+        else:
+            yield self.write_packet(packet)
+            #single chunk is read while packet is dumped, so delay is waited after sending
+            delay = packet.binary_data.chunk_delay() if packet.binary_data else 0
+            if delay > 0:
+                yield self.__loop.sleep(delay)
+
+        if wait_response:
+            resp = yield self.recv_packet()
+            raise Return(resp)
+
+    def write_packet(self, packet, with_bin=True):
+        if self.__compact_peer:
+            buffers = packet.dump_buffers(with_bin, compact=True)
+        elif not self.__compact_header:
+            buffers = packet.dump_buffers(with_bin)
+        else:
+            packet.header_codec = FRI_COMPACT_PROTOCOL_IDENTIFIER
+            try:
+                buffers = packet.dump_buffers(with_bin)
+            finally:
+                packet.header_codec = None
+        yield self.__send_buffers(buffers)
+
+    def allow_close_socket(self):
+        self.__can_close_socket = True
+        if self.__on_release:
+            self.__release()
+
+    def release_socket(self, on_release):
+        """Return socket to its owner after all pending chunks are received"""
+        self.__on_release = on_release
+        if self.__can_close_socket:
+            self.__release()
+
+    def __release(self):
+        on_release = self.__on_release
+        self.__on_release = None
+        self.__can_close_socket = False
+        self.packets_received = 0
+        on_release(self)
+
+    def set_failed(self):
+        self.__is_failed = True
+
+    def set_timeout(self, timeout):
+        self.__timeout = timeout
+
+    def is_reusable(self):
+        return (self.__sock is not None) and (not self.__is_failed)
+
+    def is_alive(self):
+        """Check that idle socket is not closed by remote side"""
+        if not self.is_reusable():
+            return False
+        try:
+            r_list, _, _ = select.select([self.__sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        #idle socket should not be readable (EOF or unexpected data)
+        return not r_list
+
+    def close_socket(self, force=False):
+        if not self.__sock:
+            return
+        self.__loop.remove_reader(self.__sock)
+        self.__loop.remove_writer(self.__sock)
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.__sock.close()
+        self.__sock = None
+
+    def is_closed(self):
+        return self.__sock == None
+
+
+def open_async_connection(loop, node_address, is_ssl, cert, conn_timeout):
+    """Coroutine that opens non-blocking connection to node. Returns AsyncSocketProcessor"""
+    hostname, port = parse_node_address(node_address)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        tune_socket(sock)
+        sock.setblocking(0)
+        ret = sock.connect_ex((hostname, port))
+        if ret not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(ret, errno.errorcode.get(ret, 'connect error'))
+        if ret:
+            yield loop.wait_writable(sock, conn_timeout)
+            ret = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if ret:
+                raise socket.error(ret, errno.errorcode.get(ret, 'connect error'))
+
+        if is_ssl:
+            sock = ssl.wrap_socket(sock, do_handshake_on_connect=False)
+            while True:
+                try:
+                    sock.do_handshake()
+                    break
+                except ssl.SSLError, err:
+                    if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                        yield loop.wait_readable(sock, conn_timeout)
+                    elif err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                        yield loop.wait_writable(sock, conn_timeout)
+                    else:
+                        raise err
+    except Exception, err:
+        sock.close()
+        raise err
+
+    raise Return(AsyncSocketProcessor(loop, sock, cert))
+
+
+class AsyncFriClient:
+    """FRI client for EventLoop. call and call_sync methods are coroutines.
+    Connections pool should not be shared with FriClient (async connections are non-blocking)
+    """
+    def __init__(self, loop, is_ssl=None, cert=None, session_id=None, connections_pool=None):
+        self.loop = loop
+        self.is_ssl = is_ssl
+        self.certificate = cert
+        self.session_id = session_id
+        self.connections_pool = connections_pool
+
+    def __get_connection(self, node_address, conn_timeout):
+        if self.connections_pool:
+            proc = self.connections_pool.get(node_address)
+            if proc:
+                raise Return((proc, True))
+        proc = yield open_async_connection(self.loop, node_address, self.is_ssl, \
+                self.certificate, conn_timeout)
+        raise Return((proc, False))
+
+    def __release_connection(self, node_address, proc, is_failed):
+        if is_failed:
+            proc.set_failed()
+
+        if self.connections_pool:
+            pool = self.connections_pool
+            proc.release_socket(lambda proc: pool.release(node_address, proc))
+        else:
+            proc.release_socket(lambda proc: proc.close_socket())
+
+    def __int_call(self, node_address, packet, conn_timeout, read_timeout=None):
+        if not isinstance(packet, FabnetPacket):
+            raise Exception('FRI request packet should be an object of FabnetPacket')
+
+        packet.session_id = self.session_id
+
+        while True:
+            proc, is_reused = yield self.__get_connection(node_address, conn_timeout)
+            is_failed = True
+            try:
+                proc.set_timeout(read_timeout)
+                resp = yield proc.send_packet(packet, wait_response=True)
+                is_failed = False
+            except (socket.error, FriException), err:
+                self.__release_connection(node_address, proc, is_failed)
+                if is_reused and proc.packets_received == 0 and can_resend(packet):
+                    continue
+                raise err
+            except Exception, err:
+                self.__release_connection(node_address, proc, is_failed)
+                raise err
+
+            self.__release_connection(node_address, proc, is_failed)
+            raise Return(resp)
+
+    def call(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT):
+        try:
+            packet = yield self.__int_call(node_address, packet, timeout, FRI_CLIENT_READ_TIMEOUT)
+        except Exception, err:
+            raise Return((RC_ERROR, '[AsyncFriClient][%s] %s' % (err.__class__.__name__, err)))
+
+        raise Return((packet.ret_code, packet.ret_message))
+
+    def call_sync(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT, read_timeout=FRI_CLIENT_READ_TIMEOUT):
+        try:
+            packet.sync = True
+            packet = yield self.__int_call(node_address, packet, timeout, read_timeout)
+        except Exception, err:
+            raise Return(FabnetPacketResponse(ret_code=RC_ERROR, \
+                    ret_message='[AsyncFriClient][%s] %s' % (err.__class__.__name__, err)))
+
+        raise Return(packet)
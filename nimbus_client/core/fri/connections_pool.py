@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package fabnet.core.connections_pool
+@author Konstantin Andrusenko
+@date May 14, 2013
+
+This module contains the implementation of FriConnectionsPool class.
+"""
+import time
+import socket
+import ssl
+import threading
+
+from constants import FRI_POOL_MAX_IDLE, FRI_POOL_IDLE_TIMEOUT, FRI_SOCKET_BUF_SIZE, \
+            FRI_KEEPALIVE_IDLE, FRI_KEEPALIVE_INTERVAL, FRI_KEEPALIVE_COUNT
+
+from fri_base import FriException
+from socket_processor import SocketProcessor
+
+
+def parse_node_address(node_address):
+    address = node_address.split(':')
+    if len(address) != 2:
+        raise FriException('Node address %s is invalid! ' \
+                    'Address should be in format <hostname>:<port>'%node_address)
+    hostname = address[0]
+    try:
+        port = int(address[1])
+        if not (0 < port <= 65535):
+            raise ValueError()
+    except ValueError:
+        raise FriException('Node address %s is invalid! ' \
+                    'Port should be integer in range 0...65535'%node_address)
+    return hostname, port
+
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt_name, value in (('TCP_KEEPIDLE', FRI_KEEPALIVE_IDLE), \
+                            ('TCP_KEEPINTVL', FRI_KEEPALIVE_INTERVAL), \
+                            ('TCP_KEEPCNT', FRI_KEEPALIVE_COUNT)):
+        opt = getattr(socket, opt_name, None)
+        if opt is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, opt, value)
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, FRI_SOCKET_BUF_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, FRI_SOCKET_BUF_SIZE)
+
+
+def open_connection(node_address, is_ssl, cert, conn_timeout):
+    hostname, port = parse_node_address(node_address)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(sock)
+    sock.settimeout(conn_timeout)
+
+    if is_ssl:
+        sock = ssl.wrap_socket(sock)
+
+    sock.connect((hostname, port))
+
+    return SocketProcessor(sock, cert)
+
+
+class FriConnectionsPool:
+    """Keep-alive connections to fabnet nodes shared by all FriClient callers"""
+    def __init__(self, max_idle=FRI_POOL_MAX_IDLE, idle_timeout=FRI_POOL_IDLE_TIMEOUT):
+        self.__max_idle = max_idle
+        self.__idle_timeout = idle_timeout
+        self.__idle_conns = {}
+        self.__lock = threading.Lock()
+
+    def get(self, node_address):
+        """Return healthy idle connection to node or None if no one found"""
+        while True:
+            self.__lock.acquire()
+            try:
+                conns = self.__idle_conns.get(node_address, None)
+                if not conns:
+                    return None
+                release_time, proc = conns.pop()
+            finally:
+                self.__lock.release()
+
+            if (time.time() - release_time) < self.__idle_timeout and proc.is_alive():
+                return proc
+            proc.close_socket(force=True)
+
+    def release(self, node_address, proc):
+        """Return connection to pool (it will be closed if can not be reused)"""
+        if SocketProcessor.force_close_flag.is_set() or (not proc.is_reusable()):
+            proc.close_socket(force=True)
+            return
+
+        for_close = []
+        self.__lock.acquire()
+        try:
+            conns = self.__idle_conns.setdefault(node_address, [])
+            now = time.time()
+            while conns and (now - conns[0][0]) >= self.__idle_timeout:
+                for_close.append(conns.pop(0)[1])
+
+            if len(conns) >= self.__max_idle:
+                for_close.append(proc)
+            else:
+                conns.append((now, proc))
+        finally:
+            self.__lock.release()
+
+        for conn in for_close:
+            conn.close_socket(force=True)
+
+    def idle_count(self, node_address=None):
+        self.__lock.acquire()
+        try:
+            if node_address:
+                return len(self.__idle_conns.get(node_address, []))
+            return sum([len(conns) for conns in self.__idle_conns.values()])
+        finally:
+            self.__lock.release()
+
+    def close_all(self):
+        self.__lock.acquire()
+        try:
+            idle_conns = self.__idle_conns
+            self.__idle_conns = {}
+        finally:
+            self.__lock.release()
+
+        for conns in idle_conns.values():
+            for _, proc in conns:
+                proc.close_socket(force=True)
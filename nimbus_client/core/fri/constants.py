@@ -12,5 +12,20 @@ FRI_CLIENT_READ_TIMEOUT = None
 
 #fri binary packet constants 
 FRI_PROTOCOL_IDENTIFIER = 'FRI0'
+FRI_COMPACT_PROTOCOL_IDENTIFIER = 'FRI1' #packet with compact binary header
 FRI_PACKET_INFO_LEN = 20
 
+#fri connections pool constants
+FRI_IDEMPOTENT_METHODS = ('GetDataBlock', 'GetKeysInfo') #can be resent over new connection
+FRI_POOL_MAX_IDLE = 4 #max idle connections per node
+FRI_POOL_IDLE_TIMEOUT = 60 #seconds
+FRI_SOCKET_BUF_SIZE = 512*1024
+FRI_KEEPALIVE_IDLE = 30
+FRI_KEEPALIVE_INTERVAL = 10
+FRI_KEEPALIVE_COUNT = 3
+
+#max binary chunks in flight (sliding window). 0 - stop-and-wait transfer
+FRI_BINARY_WINDOW = 8
+
+#use compact binary packet headers if peer supports them
+FRI_COMPACT_HEADER = True
@@ -0,0 +1,445 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package fabnet.core.event_loop
+@author Konstantin Andrusenko
+@date May 27, 2013
+
+This module contains the implementation of EventLoop class and generator based coroutines.
+
+Coroutine is a generator that yields Future objects (or other coroutines) and
+receives their results. Result of coroutine is returned by raising Return(value).
+Sockets are waited by epoll (or poll) if it is supported, select is used otherwise.
+"""
+import sys
+import time
+import errno
+import heapq
+import select
+import socket
+import threading
+import types
+from collections import deque
+
+
+class Return(Exception):
+    """Raise it from coroutine for returning value"""
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Future:
+    def __init__(self):
+        self.__done = False
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+
+    def done(self):
+        return self.__done
+
+    def result(self):
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def exc_info(self):
+        return self.__exc_info
+
+    def set_result(self, value):
+        if self.__done:
+            return
+        self.__result = value
+        self.__finish()
+
+    def set_exception(self, exc, exc_info=None):
+        if self.__done:
+            return
+        if exc_info is None:
+            exc_info = (exc.__class__, exc, None)
+        self.__exc_info = exc_info
+        self.__finish()
+
+    def add_done_callback(self, callback):
+        if self.__done:
+            callback(self)
+        else:
+            self.__callbacks.append(callback)
+
+    def __finish(self):
+        self.__done = True
+        callbacks = self.__callbacks
+        self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class Task(Future):
+    """Future that drives coroutine"""
+    def __init__(self, loop, coro):
+        Future.__init__(self)
+        self.__loop = loop
+        self.__coro = coro
+        loop.call_soon(self.__step, None, None)
+
+    def __step(self, value, exc_info):
+        try:
+            if exc_info:
+                yielded = self.__coro.throw(*exc_info)
+            else:
+                yielded = self.__coro.send(value)
+        except Return, ret:
+            self.set_result(ret.value)
+            return
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception, err:
+            self.set_exception(err, sys.exc_info())
+            return
+
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self.__loop, yielded)
+        if not isinstance(yielded, Future):
+            self.__loop.call_soon(self.__step, None, \
+                    (TypeError, TypeError('Coroutine yielded %r (Future expected)'%(yielded,)), None))
+            return
+        yielded.add_done_callback(self.__wakeup)
+
+    def __wakeup(self, future):
+        exc_info = future.exc_info()
+        if exc_info:
+            self.__loop.call_soon(self.__step, None, exc_info)
+        else:
+            self.__loop.call_soon(self.__step, future.result(), None)
+
+
+class ThreadResult:
+    """Result of coroutine submitted to loop from other thread"""
+    def __init__(self):
+        self.__event = threading.Event()
+        self.__future = None
+
+    def set_future(self, future):
+        self.__future = future
+        self.__event.set()
+
+    def wait(self, timeout=None):
+        self.__event.wait(timeout)
+        if not self.__event.is_set():
+            raise socket.timeout('Coroutine is not finished in %s seconds'%timeout)
+        return self.__future.result()
+
+
+def make_socketpair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sock_w = socket.create_connection(listener.getsockname())
+        sock_r, _ = listener.accept()
+    finally:
+        listener.close()
+    return sock_r, sock_w
+
+
+POLL_READ = 1
+POLL_WRITE = 2
+
+def is_interrupted(err):
+    return getattr(err, 'errno', None) == errno.EINTR or (err.args and err.args[0] == errno.EINTR)
+
+
+class SelectPoller:
+    """Sockets poller based on select (limited by FD_SETSIZE)"""
+    def __init__(self):
+        self.__fds = {}
+
+    def update(self, fd, mask):
+        if mask:
+            self.__fds[fd] = mask
+        else:
+            self.__fds.pop(fd, None)
+
+    def poll(self, timeout):
+        """Return list of (fd, events mask)"""
+        readers = [fd for fd, mask in self.__fds.items() if mask & POLL_READ]
+        writers = [fd for fd, mask in self.__fds.items() if mask & POLL_WRITE]
+        r_list, w_list, x_list = select.select(readers, writers, readers + writers, timeout)
+
+        events = {}
+        for fd in r_list:
+            events[fd] = POLL_READ
+        for fd in w_list:
+            events[fd] = events.get(fd, 0) | POLL_WRITE
+        for fd in x_list:
+            events[fd] = POLL_READ | POLL_WRITE
+        return events.items()
+
+    def close(self):
+        pass
+
+
+class PollPoller:
+    """Sockets poller based on epoll or poll object"""
+    def __init__(self, poll_obj, read_mask, write_mask, error_mask, ms_timeout):
+        self.__poll = poll_obj
+        self.__read_mask = read_mask
+        self.__write_mask = write_mask
+        self.__error_mask = error_mask
+        self.__ms_timeout = ms_timeout #poll timeout is in milliseconds, epoll timeout is in seconds
+        self.__fds = {}
+
+    def update(self, fd, mask):
+        old_mask = self.__fds.get(fd, 0)
+        if not mask:
+            if not old_mask:
+                return
+            del self.__fds[fd]
+            try:
+                self.__poll.unregister(fd)
+            except (IOError, OSError, KeyError):
+                #closed socket is removed from epoll automatically
+                pass
+            return
+
+        self.__fds[fd] = mask
+        events = 0
+        if mask & POLL_READ:
+            events |= self.__read_mask
+        if mask & POLL_WRITE:
+            events |= self.__write_mask
+        #socket with the same fd can be closed (and removed from epoll) while it is registered,
+        #so registration is updated even if mask is not changed
+        if old_mask:
+            try:
+                self.__poll.modify(fd, events)
+                return
+            except (IOError, OSError):
+                pass
+        try:
+            self.__poll.register(fd, events)
+        except (IOError, OSError):
+            #fd is registered already (epoll)
+            self.__poll.modify(fd, events)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = None if self.__ms_timeout else -1
+        elif self.__ms_timeout:
+            timeout = int(timeout * 1000)
+
+        ret_list = []
+        for fd, events in self.__poll.poll(timeout):
+            mask = 0
+            if events & (self.__read_mask | self.__error_mask):
+                mask |= POLL_READ
+            if events & (self.__write_mask | self.__error_mask):
+                mask |= POLL_WRITE
+            ret_list.append((fd, mask))
+        return ret_list
+
+    def close(self):
+        if hasattr(self.__poll, 'close'):
+            self.__poll.close()
+
+
+def make_poller():
+    if hasattr(select, 'epoll'):
+        return PollPoller(select.epoll(), select.EPOLLIN, select.EPOLLOUT, \
+                select.EPOLLERR | select.EPOLLHUP, False)
+    if hasattr(select, 'poll'):
+        return PollPoller(select.poll(), select.POLLIN, select.POLLOUT, \
+                select.POLLERR | select.POLLHUP | select.POLLNVAL, True)
+    return SelectPoller()
+
+
+class EventLoop:
+    """Single thread loop running coroutines and waiting for sockets events"""
+    def __init__(self):
+        self.__ready = deque()
+        self.__timers = []
+        self.__timers_seq = 0
+        self.__readers = {}
+        self.__writers = {}
+        self.__poller = make_poller()
+        self.__stopped = False
+        self.__thread_lock = threading.Lock()
+        self.__thread_calls = []
+        self.__wakeup_r, self.__wakeup_w = make_socketpair()
+        self.__wakeup_r.setblocking(0)
+        self.__wakeup_w.setblocking(0)
+        self.add_reader(self.__wakeup_r, self.__on_wakeup)
+
+    def call_soon(self, callback, *args):
+        self.__ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """Schedule callback call. Returned timer can be cancelled by cancel_timer method"""
+        self.__timers_seq += 1
+        timer = [time.time() + delay, self.__timers_seq, callback, args]
+        heapq.heappush(self.__timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.__thread_lock.acquire()
+        try:
+            self.__thread_calls.append((callback, args))
+        finally:
+            self.__thread_lock.release()
+        try:
+            self.__wakeup_w.send('x')
+        except socket.error:
+            #wakeup byte is already sent
+            pass
+
+    def __on_wakeup(self):
+        try:
+            while self.__wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+        self.__thread_lock.acquire()
+        try:
+            calls = self.__thread_calls
+            self.__thread_calls = []
+        finally:
+            self.__thread_lock.release()
+        self.__ready.extend(calls)
+
+    def __set_handler(self, handlers, fd, handler):
+        if handler:
+            handlers[fd] = handler
+        else:
+            handlers.pop(fd, None)
+
+        mask = 0
+        if fd in self.__readers:
+            mask |= POLL_READ
+        if fd in self.__writers:
+            mask |= POLL_WRITE
+        self.__poller.update(fd, mask)
+
+    def add_reader(self, sock, callback, *args):
+        self.__set_handler(self.__readers, sock.fileno(), (callback, args))
+
+    def remove_reader(self, sock):
+        self.__set_handler(self.__readers, sock.fileno(), None)
+
+    def add_writer(self, sock, callback, *args):
+        self.__set_handler(self.__writers, sock.fileno(), (callback, args))
+
+    def remove_writer(self, sock):
+        self.__set_handler(self.__writers, sock.fileno(), None)
+
+    def __wait_io(self, handlers, sock, timeout):
+        """Return Future that is done when socket is ready (socket.timeout is raised on timeout)"""
+        future = Future()
+        fd = sock.fileno()
+        timer = None
+        def on_ready():
+            self.__set_handler(handlers, fd, None)
+            if timer:
+                self.cancel_timer(timer)
+            future.set_result(None)
+        def on_timeout():
+            self.__set_handler(handlers, fd, None)
+            future.set_exception(socket.timeout('timed out'))
+
+        self.__set_handler(handlers, fd, (on_ready, ()))
+        if timeout is not None:
+            timer = self.call_later(timeout, on_timeout)
+        return future
+
+    def wait_readable(self, sock, timeout=None):
+        return self.__wait_io(self.__readers, sock, timeout)
+
+    def wait_writable(self, sock, timeout=None):
+        return self.__wait_io(self.__writers, sock, timeout)
+
+    def sleep(self, delay):
+        future = Future()
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def spawn(self, coro):
+        """Run coroutine in loop. Should be called from loop thread"""
+        return Task(self, coro)
+
+    def submit(self, coro):
+        """Run coroutine in loop from other thread. Returns ThreadResult object"""
+        result = ThreadResult()
+        def spawn():
+            self.spawn(coro).add_done_callback(result.set_future)
+        self.call_soon_threadsafe(spawn)
+        return result
+
+    def stop(self):
+        self.call_soon_threadsafe(self.__stop)
+
+    def __stop(self):
+        self.__stopped = True
+
+    def run_forever(self):
+        self.__stopped = False
+        while not self.__stopped:
+            self.__run_once()
+
+    def run_until_complete(self, coro):
+        task = self.spawn(coro)
+        task.add_done_callback(lambda f: self.__stop())
+        self.run_forever()
+        return task.result()
+
+    def close(self):
+        self.__poller.close()
+        self.__wakeup_r.close()
+        self.__wakeup_w.close()
+
+    def __run_once(self):
+        timeout = None
+        if self.__ready:
+            timeout = 0
+        elif self.__timers:
+            timeout = max(0, self.__timers[0][0] - time.time())
+
+        self.__poll(timeout)
+
+        now = time.time()
+        while self.__timers and self.__timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.__timers)
+            if callback:
+                self.__ready.append((callback, args))
+
+        for i in xrange(len(self.__ready)):
+            callback, args = self.__ready.popleft()
+            callback(*args)
+
+    def __poll(self, timeout):
+        try:
+            events = self.__poller.poll(timeout)
+        except (select.error, IOError, OSError), err:
+            if is_interrupted(err):
+                return
+            raise
+
+        for fd, mask in events:
+            if mask & POLL_READ:
+                handler = self.__readers.get(fd, None)
+                if handler:
+                    self.__ready.append(handler)
+            if mask & POLL_WRITE:
+                handler = self.__writers.get(fd, None)
+                if handler:
+                    self.__ready.append(handler)
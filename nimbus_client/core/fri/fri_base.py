@@ -15,13 +15,30 @@ import struct
 import zlib
 import json
 
-from constants import RC_OK, FRI_PROTOCOL_IDENTIFIER, FRI_PACKET_INFO_LEN
+from constants import RC_OK, FRI_PROTOCOL_IDENTIFIER, FRI_PACKET_INFO_LEN, \
+            FRI_COMPACT_PROTOCOL_IDENTIFIER, FRI_IDEMPOTENT_METHODS
 
 
 class FriException(Exception):
     pass
 
 
+def can_resend(packet):
+    """Request failed on stale connection can be resent only if processing it twice is harmless
+    (node can receive request before connection is broken)
+    """
+    return packet.method in FRI_IDEMPOTENT_METHODS
+
+
+def to_str(data):
+    """Return binary data (str, memoryview of received packet or buffer of mapped file) as str"""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    if isinstance(data, buffer):
+        return str(data)
+    return data
+
+
 class FriBinaryData:
     def chunks_count(self):
         raise RuntimeError('Not implemented')
@@ -30,15 +47,19 @@ class FriBinaryData:
         """Return next data chunk. None should be returned if EOF"""
         raise RuntimeError('Not implemented')
 
+    def chunk_delay(self):
+        """Return seconds to wait before sending of chunk returned by get_next_chunk"""
+        return 0
+
     def data(self):
         """Return all binary data in one chunk"""
-        data = ''
+        data = []
         while True:
             chunk = self.get_next_chunk()
             if not chunk:
                 break
-            data += chunk
-        return data
+            data.append(to_str(chunk))
+        return ''.join(data)
 
     def close(self):
         pass
@@ -69,10 +90,122 @@ class RamBasedBinaryData(FriBinaryData):
         self.__last_idx += 1
         end = self.__chunk_size * self.__last_idx
 
+        if self.__chunks_count > 1 and type(self.__data) == str:
+            #slice without copying
+            return memoryview(self.__data)[start:end]
         return self.__data[start:end]
 
     def data(self):
-        return self.__data
+        return to_str(self.__data)
+
+
+class CompactHeaderCodec:
+    """Compact binary encoding of FRI packet header (FRI1 protocol)
+
+    Header format: <fixed fields struct><message_id><method><session_id><items map>
+    Fixed fields are flags, lengths of string fields, ret_code and binary chunks fields.
+    Other header items (parameters, ret_parameters, sender, ...) are packed
+    into map encoded by C-accelerated json module
+    """
+    FIXED = struct.Struct('<BBBBiIIH')
+
+    F_REQUEST = 1
+    F_SYNC = 2
+    F_MULTICAST = 4
+    F_RET_CODE = 8
+
+    MAP_ENCODER = json.JSONEncoder(separators=(',', ':'))
+    MAP_DECODER = json.JSONDecoder()
+
+    @classmethod
+    def encode(cls, header_obj):
+        header = dict(header_obj)
+        pop = header.pop
+        flags = 0
+        message_id = cls.__to_bytes(pop('message_id', None))
+        session_id = cls.__to_bytes(pop('session_id', None))
+        method = pop('method', None)
+        if method is not None:
+            method = cls.__to_bytes(method)
+            flags = cls.F_REQUEST
+            if pop('sync', False):
+                flags |= cls.F_SYNC
+            if pop('is_multicast', False):
+                flags |= cls.F_MULTICAST
+            if 'sender' in header and header['sender'] is None:
+                del header['sender']
+        else:
+            method = ''
+
+        ret_code = pop('ret_code', None)
+        if ret_code is None:
+            ret_code = 0
+        else:
+            flags |= cls.F_RET_CODE
+            if header.get('ret_message', None) == '':
+                del header['ret_message']
+
+        try:
+            fixed = cls.FIXED.pack(flags, len(message_id), len(method), len(session_id), ret_code, \
+                        pop('binary_chunk_idx', 0), pop('binary_chunk_cnt', 0), pop('binary_window', 0))
+        except struct.error, err:
+            raise FriException('Header fields can not be packed: %s'%err)
+
+        if not header:
+            return ''.join([fixed, message_id, method, session_id])
+
+        try:
+            items = cls.MAP_ENCODER.encode(header)
+        except Exception, err:
+            raise FriException('Header items can not be packed: %s'%err)
+        return ''.join([fixed, message_id, method, session_id, items])
+
+    @classmethod
+    def decode(cls, data):
+        flags, mid_len, method_len, sid_len, ret_code, chunk_idx, chunk_cnt, window = cls.FIXED.unpack_from(data)
+        pos = cls.FIXED.size
+        items_pos = pos + mid_len + method_len + sid_len
+        if len(data) < items_pos:
+            raise FriException('Unexpected header end')
+
+        if len(data) > items_pos:
+            header = cls.MAP_DECODER.decode(data[items_pos:])
+            if type(header) != dict:
+                raise FriException('Header items should be a map')
+        else:
+            header = {}
+
+        header['message_id'] = data[pos:pos+mid_len] or None
+        pos += mid_len
+        if flags & cls.F_REQUEST:
+            header['method'] = data[pos:pos+method_len]
+            header['sync'] = bool(flags & cls.F_SYNC)
+            if flags & cls.F_MULTICAST:
+                header['is_multicast'] = True
+        pos += method_len
+        if sid_len:
+            header['session_id'] = data[pos:pos+sid_len]
+        if flags & cls.F_RET_CODE:
+            header['ret_code'] = ret_code
+        if chunk_idx:
+            header['binary_chunk_idx'] = chunk_idx
+        if chunk_cnt:
+            header['binary_chunk_cnt'] = chunk_cnt
+        if window:
+            header['binary_window'] = window
+        return header
+
+    @classmethod
+    def __to_bytes(cls, value):
+        if type(value) == str and len(value) < 256:
+            return value
+        if value is None:
+            return ''
+        if type(value) == unicode:
+            value = value.encode('utf8')
+        if type(value) != str or len(value) > 255:
+            raise FriException('Value %r can not be packed into header field'%(value,))
+        return value
 
 
 class FriBinaryProcessor:
@@ -85,11 +218,11 @@ class FriBinaryProcessor:
             raise FriException('Invalid FRI packet! No packet header found')
 
         try:
-            prot, packet_len, header_len = struct.unpack('<4sqq', p_info)
+            prot, packet_len, header_len = struct.unpack_from('<4sqq', p_info)
         except Exception, err:
             raise FriException('Invalid FRI packet! Packet information is corrupted: %s'%err)
 
-        if prot != FRI_PROTOCOL_IDENTIFIER:
+        if prot != FRI_PROTOCOL_IDENTIFIER and prot != FRI_COMPACT_PROTOCOL_IDENTIFIER:
             raise FriException('Invalid FRI packet! Protocol is mismatch')
 
         return packet_len, header_len
@@ -97,6 +230,9 @@ class FriBinaryProcessor:
 
     @classmethod
     def from_binary(cls, data, packet_len, header_len):
+        """Parse FRI packet. Binary part of packet is returned as
+        a slice of @data (memoryview slice if @data is memoryview)
+        """
         if len(data) != int(packet_len):
             raise FriException('Invalid FRI packet! Packet length %s is differ to expected %s'%(len(data), packet_len))
 
@@ -105,32 +241,55 @@ class FriBinaryProcessor:
             raise FriException('Invalid FRI packet! Header length %s is differ to expected %s'%(len(header), header_len))
 
         try:
-            json_header = json.loads(header)
+            if to_str(data[:4]) == FRI_COMPACT_PROTOCOL_IDENTIFIER:
+                json_header = CompactHeaderCodec.decode(to_str(header))
+            else:
+                json_header = json.loads(to_str(header))
         except Exception, err:
             raise FriException('Invalid FRI packet! Header is corrupted: %s'%err)
 
         bin_data = data[header_len+FRI_PACKET_INFO_LEN:]
         if bin_data and cls.NEED_COMPRESSION:
-            bin_data = zlib.decompress(bin_data)
+            bin_data = zlib.decompress(to_str(bin_data))
 
         return json_header, bin_data
 
     @classmethod
-    def to_binary(cls, header_obj, bin_data=''):
+    def to_buffers(cls, header_obj, bin_data='', compact=False):
+        """Form FRI packet as list of buffers [packet info + header, binary data]
+        for sending without joining (binary data is not copied)
+        If @compact is True, header is encoded by CompactHeaderCodec (JSON is used
+        as fallback for headers that can not be packed)
+        """
+        if compact:
+            try:
+                header = CompactHeaderCodec.encode(header_obj)
+                return cls.pack_buffers(FRI_COMPACT_PROTOCOL_IDENTIFIER, header, bin_data)
+            except FriException:
+                pass
+
         try:
             header = json.dumps(header_obj)
         except Exception, err:
             raise FriException('Cant form FRI packet! Header "%s" is corrupted: %s'%(header_obj, err))
 
+        return cls.pack_buffers(FRI_PROTOCOL_IDENTIFIER, header, bin_data)
+
+    @classmethod
+    def pack_buffers(cls, protocol, header, bin_data=''):
         if bin_data and cls.NEED_COMPRESSION:
-            bin_data = zlib.compress(bin_data)
+            bin_data = zlib.compress(to_str(bin_data))
 
         h_len = len(header)
-        packet_data = header + bin_data
-        p_len = len(packet_data) + FRI_PACKET_INFO_LEN
-        p_info = struct.pack('<4sqq', FRI_PROTOCOL_IDENTIFIER, p_len, h_len)
+        p_len = FRI_PACKET_INFO_LEN + h_len + len(bin_data)
+        p_info = struct.pack('<4sqq', protocol, p_len, h_len)
 
-        return p_info + packet_data
+        return [p_info + header, bin_data]
+
+    @classmethod
+    def to_binary(cls, header_obj, bin_data=''):
+        p_header, bin_data = cls.to_buffers(header_obj, bin_data)
+        return p_header + to_str(bin_data)
 
 class FabnetPacket:
     is_request = False
@@ -156,6 +315,9 @@ class FabnetPacket:
             self.binary_data = RamBasedBinaryData(self.binary_data)
         self.binary_chunk_idx = packet.get('binary_chunk_idx', 0)
         self.binary_chunk_cnt = packet.get('binary_chunk_cnt', 0)
+        self.binary_window = packet.get('binary_window', 0)
+        self.header_codec = packet.get('header_codec', None)
+        self.multiplex = packet.get('multiplex', False)
 
     def __del__(self):
         if isinstance(self.binary_data, FriBinaryData):
@@ -168,23 +330,37 @@ class FabnetPacket:
         pass
 
     def dump(self, with_bin=True):
+        p_header, bin_data = self.dump_buffers(with_bin)
+        return p_header + to_str(bin_data)
+
+    def dump_buffers(self, with_bin=True, compact=False):
         header_json = self.to_dict()
         if self.binary_data and with_bin:
             binary_data = self.binary_data.data()
         else:
             binary_data = ''
-        data = FriBinaryProcessor.to_binary(header_json, binary_data)
-        return data
+        return FriBinaryProcessor.to_buffers(header_json, binary_data, compact)
 
     def dump_next_chunk(self):
-        header_json = self.to_dict()
+        buffers = self.dump_next_chunk_buffers()
+        if buffers is None:
+            return None
+        return buffers[0] + to_str(buffers[1])
+
+    def dump_next_chunk_buffers(self, compact=False):
         binary_data = ''
         if self.binary_data:
             binary_data = self.binary_data.get_next_chunk()
         if not binary_data:
             return None
-        data = FriBinaryProcessor.to_binary(header_json, binary_data)
-        return data
+
+        if compact:
+            #chunk receiver needs chunk index only, so other packet fields are not dumped
+            header = CompactHeaderCodec.encode({'message_id': self.message_id, \
+                    'binary_chunk_idx': self.binary_chunk_idx, 'binary_chunk_cnt': self.binary_chunk_cnt})
+            return FriBinaryProcessor.pack_buffers(FRI_COMPACT_PROTOCOL_IDENTIFIER, header, binary_data)
+
+        return FriBinaryProcessor.to_buffers(self.to_dict(), binary_data)
 
     def to_dict(self):
         """This method may be extended in inherited class"""
@@ -196,6 +372,12 @@ class FabnetPacket:
             ret_dict['binary_chunk_idx'] = self.binary_chunk_idx
         if self.binary_chunk_cnt:
             ret_dict['binary_chunk_cnt'] = self.binary_chunk_cnt
+        if self.binary_window:
+            ret_dict['binary_window'] = self.binary_window
+        if self.header_codec:
+            ret_dict['header_codec'] = self.header_codec
+        if self.multiplex:
+            ret_dict['multiplex'] = self.multiplex
 
         return ret_dict
 
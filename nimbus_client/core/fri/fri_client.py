@@ -11,60 +11,61 @@ Copyright (C) 2012 Konstantin Andrusenko
 This module contains the implementation of FriClient class.
 """
 import socket
-import ssl
 
 from constants import RC_ERROR, RC_UNEXPECTED, FRI_CLIENT_TIMEOUT, FRI_CLIENT_READ_TIMEOUT
 
-from fri_base import FabnetPacket, FabnetPacketResponse, FriException
-from socket_processor import SocketProcessor
+from fri_base import FabnetPacket, FabnetPacketResponse, FriException, can_resend
+from connections_pool import open_connection
 
 class FriClient:
     """class for calling asynchronous operation over FRI protocol"""
-    def __init__(self, is_ssl=None, cert=None, session_id=None):
+    def __init__(self, is_ssl=None, cert=None, session_id=None, connections_pool=None):
         self.is_ssl = is_ssl
         self.certificate = cert
         self.session_id = session_id
+        self.connections_pool = connections_pool
 
-    def __int_call(self, node_address, packet, conn_timeout, read_timeout=None):
-        proc = None
-
-        try:
-            address = node_address.split(':')
-            if len(address) != 2:
-                raise FriException('Node address %s is invalid! ' \
-                            'Address should be in format <hostname>:<port>'%node_address)
-            hostname = address[0]
-            try:
-                port = int(address[1])
-                if 0 > port > 65535:
-                    raise ValueError()
-            except ValueError:
-                raise FriException('Node address %s is invalid! ' \
-                            'Port should be integer in range 0...65535'%node_address)
-
-            if not isinstance(packet, FabnetPacket):
-                raise Exception('FRI request packet should be an object of FabnetPacket')
-
-            packet.session_id = self.session_id
+    def __get_connection(self, node_address, conn_timeout):
+        if self.connections_pool:
+            proc = self.connections_pool.get(node_address)
+            if proc:
+                return proc, True
+        return open_connection(node_address, self.is_ssl, self.certificate, conn_timeout), False
 
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(conn_timeout)
+    def __release_connection(self, node_address, proc, is_failed):
+        if is_failed:
+            proc.set_failed()
 
-            if self.is_ssl:
-                sock = ssl.wrap_socket(sock)
+        if self.connections_pool:
+            pool = self.connections_pool
+            proc.release_socket(lambda proc: pool.release(node_address, proc))
+        else:
+            proc.close_socket()
 
-            sock.connect((hostname, port))
+    def __int_call(self, node_address, packet, conn_timeout, read_timeout=None):
+        if not isinstance(packet, FabnetPacket):
+            raise Exception('FRI request packet should be an object of FabnetPacket')
 
-            proc = SocketProcessor(sock, self.certificate)
+        packet.session_id = self.session_id
 
-            sock.settimeout(read_timeout)
+        while True:
+            proc, is_reused = self.__get_connection(node_address, conn_timeout)
+            is_failed = True
+            try:
+                proc.set_timeout(read_timeout)
 
-            resp = proc.send_packet(packet, wait_response=True)
+                resp = proc.send_packet(packet, wait_response=True)
+                is_failed = False
 
-            return resp
-        finally:
-            if proc:
-                proc.close_socket()
+                return resp
+            except (socket.error, FriException), err:
+                #idle connection can be closed by node at any time, 
+                #so idempotent request should be resent over new connection
+                if is_reused and proc.packets_received == 0 and can_resend(packet):
+                    continue
+                raise err
+            finally:
+                self.__release_connection(node_address, proc, is_failed)
 
 
     def call(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT):
@@ -76,10 +77,10 @@ class FriClient:
             return RC_ERROR, '[FriClient][%s] %s' % (err.__class__.__name__, err)
 
 
-    def call_sync(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT):
+    def call_sync(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT, read_timeout=FRI_CLIENT_READ_TIMEOUT):
         try:
             packet.sync = True
-            packet = self.__int_call(node_address, packet, timeout, FRI_CLIENT_READ_TIMEOUT)
+            packet = self.__int_call(node_address, packet, timeout, read_timeout)
 
             return packet
         except Exception, err:
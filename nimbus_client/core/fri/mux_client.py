@@ -0,0 +1,382 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package fabnet.core.mux_client
+@author Konstantin Andrusenko
+@date May 20, 2013
+
+This module contains the implementation of FriMuxConnection and FriMuxClient classes.
+
+Multiplexed mode is negotiated by 'multiplex' flag of first call over connection.
+If node returns the flag in response, both sides switch connection to multiplexed mode
+after the call is finished. In multiplexed mode every packet (including binary chunks and
+chunk requests) is routed to its call by message_id, so concurrent calls and their binary
+chunks streams are interleaved over single connection.
+Calls made while first call is not finished are sent by FriClient (they do not wait for negotiation).
+"""
+import time
+import socket
+import threading
+import Queue
+
+from constants import RC_ERROR, RC_REQ_CERTIFICATE, RC_REQ_BINARY_CHUNK, \
+            FRI_CLIENT_TIMEOUT, FRI_CLIENT_READ_TIMEOUT
+
+from fri_base import FabnetPacket, FabnetPacketRequest, FabnetPacketResponse, \
+            FriException, RamBasedBinaryData, can_resend
+from socket_processor import SocketBasedChunks
+from fri_client import FriClient
+from connections_pool import open_connection
+from nimbus_client.core.logger import logger
+
+
+class MuxChannel:
+    """Packets stream of single call over multiplexed connection.
+    Implements SocketProcessor methods used by SocketBasedChunks and FRI calls.
+    """
+    def __init__(self, connection, message_id, timeout=None):
+        self.__conn = connection
+        self.__queue = Queue.Queue()
+        self.__timeout = timeout
+        self.message_id = message_id
+        self.packets_received = 0
+
+    def put(self, item):
+        """Route received (packet, bin_data) to channel. None means connection is closed"""
+        self.__queue.put(item)
+
+    def read_next_packet(self):
+        try:
+            item = self.__queue.get(timeout=self.__timeout)
+        except Queue.Empty:
+            raise FriException('Timeout occured while waiting response of %s'%self.message_id)
+        if item is None:
+            raise FriException('Multiplexed connection is closed')
+        self.packets_received += 1
+        return item
+
+    def recv_packet(self):
+        packet, bin_data = self.read_next_packet()
+
+        cnt = packet.binary_chunk_cnt
+        if cnt > 0:
+            window = min(packet.binary_window, self.__conn.binary_window)
+            packet.binary_data = SocketBasedChunks(self, cnt, window)
+        elif bin_data:
+            packet.binary_data = RamBasedBinaryData(bin_data)
+        return packet
+
+    def send_packet(self, packet, wait_response=False):
+        packet.message_id = self.message_id
+        if packet.binary_data and packet.binary_data.chunks_count() > 1:
+            packet.binary_chunk_cnt = packet.binary_data.chunks_count()
+            packet.binary_window = self.__conn.binary_window
+            self.__conn.write_packet(packet, with_bin=False)
+            packet.binary_window = 0
+
+            if packet.is_request:
+                self.read_next_packet()
+
+            credits = 0
+            for i in xrange(packet.binary_chunk_cnt):
+                if not credits:
+                    resp_packet = self.recv_packet()
+                    if resp_packet.ret_code != RC_REQ_BINARY_CHUNK:
+                        return resp_packet
+                    credits = max(1, resp_packet.binary_window)
+
+                credits -= 1
+                packet.binary_chunk_idx = i+1
+                self.__conn.write_next_chunk(packet)
+                delay = packet.binary_data.chunk_delay()
+                if delay > 0:
+                    time.sleep(delay)
+
+            packet.binary_chunk_cnt = None
+            packet.binary_chunk_idx = None
+        else:
+            self.__conn.write_packet(packet)
+            delay = packet.binary_data.chunk_delay() if packet.binary_data else 0
+            if delay > 0:
+                time.sleep(delay)
+
+        if wait_response:
+            return self.recv_packet()
+
+    def set_failed(self):
+        """Binary stream is broken, so peer should stop sending chunks"""
+        try:
+            self.__conn.write_packet(FabnetPacketResponse(message_id=self.message_id, \
+                    ret_code=RC_ERROR, ret_message='Binary stream is closed by receiver'))
+        except (socket.error, FriException):
+            #connection is broken, so it will be closed by reader thread
+            pass
+
+    def allow_close_socket(self):
+        self.close()
+
+    def close(self):
+        self.__conn.close_channel(self.message_id)
+
+
+class FriMuxConnection(threading.Thread):
+    """Multiplexed FRI connection. Received packets are routed to channels by message_id.
+    Requests without opened channel are passed to on_request(channel) callback (node side).
+    """
+    def __init__(self, sock_proc, cert=None, on_request=None, on_close=None):
+        threading.Thread.__init__(self)
+        self.__proc = sock_proc
+        self.__cert = cert
+        self.__on_request = on_request
+        self.__on_close = on_close
+        self.__channels = {}
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__closed = False
+        self.binary_window = sock_proc.binary_window
+        self.setDaemon(True)
+
+    def is_closed(self):
+        return self.__closed
+
+    def open_channel(self, message_id, timeout=None):
+        self.__lock.acquire()
+        try:
+            if self.__closed:
+                raise FriException('Multiplexed connection is closed')
+            channel = MuxChannel(self, message_id, timeout)
+            self.__channels[message_id] = channel
+            return channel
+        finally:
+            self.__lock.release()
+
+    def close_channel(self, message_id):
+        self.__lock.acquire()
+        try:
+            self.__channels.pop(message_id, None)
+        finally:
+            self.__lock.release()
+
+    def channels_count(self):
+        return len(self.__channels)
+
+    def write_packet(self, packet, with_bin=True):
+        self.__send_lock.acquire()
+        try:
+            self.__proc.write_packet(packet, with_bin)
+        finally:
+            self.__send_lock.release()
+
+    def write_next_chunk(self, packet):
+        self.__send_lock.acquire()
+        try:
+            self.__proc.write_next_chunk(packet)
+        finally:
+            self.__send_lock.release()
+
+    def run(self):
+        self.__proc.set_timeout(None)
+        try:
+            while True:
+                packet, bin_data = self.__proc.read_next_packet()
+                if packet.is_response and packet.ret_code == RC_REQ_CERTIFICATE:
+                    self.write_packet(FabnetPacketRequest(method='crtput', \
+                            parameters={'certificate': self.__cert}))
+                    continue
+
+                channel = self.__channels.get(packet.message_id, None)
+                if channel:
+                    channel.put((packet, bin_data))
+                elif packet.is_request and self.__on_request:
+                    channel = self.open_channel(packet.message_id)
+                    channel.put((packet, bin_data))
+                    self.__on_request(channel)
+                #else: packet of closed channel (cancelled binary stream), skip it
+        except (socket.error, FriException):
+            pass
+        except Exception, err:
+            logger.error('[FriMuxConnection] %s'%err)
+            logger.traceback_debug()
+        finally:
+            self.close()
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            if self.__closed:
+                return
+            self.__closed = True
+            channels = self.__channels.values()
+            self.__channels = {}
+        finally:
+            self.__lock.release()
+
+        self.__proc.close_socket(force=True)
+        for channel in channels:
+            channel.put(None)
+        if self.__on_close:
+            self.__on_close(self)
+
+
+class FriMuxClient:
+    """FRI client multiplexing concurrent calls over single connection per node.
+    Nodes that do not support multiplexed mode are called by FriClient
+    """
+    def __init__(self, is_ssl=None, cert=None, session_id=None, connections_pool=None):
+        self.is_ssl = is_ssl
+        self.certificate = cert
+        self.session_id = session_id
+        self.connections_pool = connections_pool
+        self.__fri_client = FriClient(is_ssl, cert, session_id, connections_pool)
+        self.__connections = {}
+        self.__negotiating = set()
+        self.__legacy_nodes = set()
+        self.__lock = threading.Lock()
+
+    def __get_connection(self, node_address):
+        """Return multiplexed connection to node.
+        None is returned if connection should be negotiated by caller.
+        False is returned if node should be called by FriClient
+        (legacy node or negotiation is in progress - it is finished after
+        binary stream of first call is received, so concurrent calls do not wait it)
+        """
+        self.__lock.acquire()
+        try:
+            conn = self.__connections.get(node_address, None)
+            if conn and not conn.is_closed():
+                return conn
+            if node_address in self.__legacy_nodes or node_address in self.__negotiating:
+                return False
+            self.__negotiating.add(node_address)
+            return None
+        finally:
+            self.__lock.release()
+
+    def __negotiated(self, node_address, conn=None, is_legacy=False):
+        self.__lock.acquire()
+        try:
+            self.__negotiating.discard(node_address)
+            if conn:
+                self.__connections[node_address] = conn
+            if is_legacy:
+                self.__legacy_nodes.add(node_address)
+        finally:
+            self.__lock.release()
+
+    def __on_conn_close(self, conn):
+        self.__lock.acquire()
+        try:
+            for node_address, n_conn in self.__connections.items():
+                if n_conn == conn:
+                    del self.__connections[node_address]
+        finally:
+            self.__lock.release()
+
+    def __start_mux(self, node_address, proc):
+        if not proc.is_reusable():
+            proc.close_socket(force=True)
+            self.__negotiated(node_address)
+            return
+
+        conn = FriMuxConnection(proc, self.certificate, on_close=self.__on_conn_close)
+        self.__negotiated(node_address, conn)
+        conn.start()
+
+    def __negotiate(self, node_address, packet, conn_timeout, read_timeout):
+        """Call node with multiplex flag over new connection"""
+        try:
+            proc = open_connection(node_address, self.is_ssl, self.certificate, conn_timeout)
+        except Exception, err:
+            self.__negotiated(node_address)
+            raise err
+
+        packet.multiplex = True
+        try:
+            proc.set_timeout(read_timeout)
+            resp = proc.send_packet(packet, wait_response=True)
+        except Exception, err:
+            proc.close_socket(force=True)
+            self.__negotiated(node_address)
+            raise err
+        finally:
+            packet.multiplex = False
+
+        if resp.multiplex:
+            #connection is switched to multiplexed mode after binary stream of response is received
+            proc.release_socket(lambda proc: self.__start_mux(node_address, proc))
+        else:
+            self.__negotiated(node_address, is_legacy=True)
+            if self.connections_pool:
+                pool = self.connections_pool
+                proc.release_socket(lambda proc: pool.release(node_address, proc))
+            else:
+                proc.close_socket()
+        return resp
+
+    def __int_call(self, node_address, packet, conn_timeout, read_timeout=None):
+        """Call node over multiplexed connection.
+        None is returned if node should be called by FriClient
+        """
+        if not isinstance(packet, FabnetPacket):
+            raise Exception('FRI request packet should be an object of FabnetPacket')
+
+        packet.session_id = self.session_id
+        while True:
+            conn = self.__get_connection(node_address)
+            if conn is None:
+                return self.__negotiate(node_address, packet, conn_timeout, read_timeout)
+            if conn is False:
+                return None
+
+            try:
+                channel = conn.open_channel(packet.message_id, read_timeout)
+            except FriException:
+                continue
+
+            try:
+                resp = channel.send_packet(packet, wait_response=True)
+            except (socket.error, FriException), err:
+                channel.close()
+                #connection can be closed by node before call is processed
+                if conn.is_closed() and channel.packets_received == 0 and can_resend(packet):
+                    continue
+                raise err
+
+            if not resp.binary_chunk_cnt:
+                channel.close()
+            return resp
+
+    def call(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT):
+        try:
+            resp = self.__int_call(node_address, packet, timeout, FRI_CLIENT_READ_TIMEOUT)
+            if resp is None:
+                return self.__fri_client.call(node_address, packet, timeout)
+
+            return resp.ret_code, resp.ret_message
+        except Exception, err:
+            return RC_ERROR, '[FriMuxClient][%s] %s' % (err.__class__.__name__, err)
+
+    def call_sync(self, node_address, packet, timeout=FRI_CLIENT_TIMEOUT, read_timeout=FRI_CLIENT_READ_TIMEOUT):
+        try:
+            packet.sync = True
+            resp = self.__int_call(node_address, packet, timeout, read_timeout)
+            if resp is None:
+                return self.__fri_client.call_sync(node_address, packet, timeout, read_timeout)
+
+            return resp
+        except Exception, err:
+            return FabnetPacketResponse(ret_code=RC_ERROR, ret_message='[FriMuxClient][%s] %s' % (err.__class__.__name__, err))
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            connections = self.__connections.values()
+            self.__connections = {}
+        finally:
+            self.__lock.release()
+
+        for conn in connections:
+            conn.close()
@@ -11,99 +11,155 @@ Copyright (C) 2012 Konstantin Andrusenko
 This module contains the implementation of SocketBasedChunks and  SocketProcessor classes.
 """
 import socket
+import select
 import threading
 
-from constants import BUF_SIZE, RC_REQ_CERTIFICATE, FRI_PACKET_INFO_LEN, RC_REQ_BINARY_CHUNK
+from constants import BUF_SIZE, RC_REQ_CERTIFICATE, FRI_PACKET_INFO_LEN, RC_REQ_BINARY_CHUNK, \
+            FRI_BINARY_WINDOW, FRI_COMPACT_HEADER, FRI_COMPACT_PROTOCOL_IDENTIFIER
+TCP_CORK = getattr(socket, 'TCP_CORK', None)
+
 from fri_base import FriBinaryProcessor, FabnetPacketRequest, FabnetPacketResponse, \
             FriException, FriBinaryData, RamBasedBinaryData, FabnetPacket
 
 
 class SocketBasedChunks(FriBinaryData):
-    def __init__(self, socket_processor, chunks_count):
+    def __init__(self, socket_processor, chunks_count, window=0):
         self.__sock_proc = socket_processor
         self.__chunks_count = chunks_count
+        self.__window = window #max chunks in flight (0 - stop-and-wait)
+        self.__granted = 0
         self.__last_idx = 0
 
     def chunks_count(self):
         return self.__chunks_count
 
+    def __grant_chunks(self):
+        """Request next chunks from sender.
+        In stop-and-wait mode every chunk is requested separately (without binary_window field,
+        so old nodes understand it). In windowed mode credits are granted in batches
+        when half of window is consumed.
+        """
+        in_flight = self.__granted - self.__last_idx
+        if self.__window > 1:
+            if in_flight > self.__window / 2:
+                return
+            cnt = min(self.__window - in_flight, self.__chunks_count - self.__granted)
+        elif in_flight:
+            return
+        else:
+            cnt = 1
+
+        if cnt <= 0:
+            return
+        if self.__window > 1:
+            req = FabnetPacketResponse(ret_code=RC_REQ_BINARY_CHUNK, binary_window=cnt)
+        else:
+            req = FabnetPacketResponse(ret_code=RC_REQ_BINARY_CHUNK)
+        self.__sock_proc.send_packet(req)
+        self.__granted += cnt
+
     def get_next_chunk(self):
         if self.__last_idx >= self.__chunks_count:
             return None
+        if not self.__sock_proc:
+            raise FriException('Binary data stream is closed')
 
         try:
-            self.__sock_proc.send_packet(FabnetPacketResponse(ret_code=RC_REQ_BINARY_CHUNK))
+            self.__grant_chunks()
             packet, bin_data = self.__sock_proc.read_next_packet()
             self.__last_idx += 1
 
             if packet.binary_chunk_idx > packet.binary_chunk_cnt:
-                raise FriException('Chunk index is bigger than chunks count (%s>%s)'%(idx, cnt))
+                raise FriException('Chunk index is bigger than chunks count (%s>%s)'% \
+                        (packet.binary_chunk_idx, packet.binary_chunk_cnt))
 
             if self.__last_idx == self.__chunks_count:
-                self.__sock_proc.allow_close_socket()
+                self.__detach()
 
             return bin_data
         except Exception, err:
-            self.__sock_proc.allow_close_socket()
+            self.__sock_proc.set_failed()
+            self.__detach()
             raise err
 
+    def __detach(self):
+        sock_proc = self.__sock_proc
+        self.__sock_proc = None
+        sock_proc.allow_close_socket()
+
     def close(self):
         if self.__sock_proc:
-            self.__sock_proc.allow_close_socket()
+            if self.__last_idx < self.__chunks_count:
+                #binary stream is not fully received, socket can not be reused
+                self.__sock_proc.set_failed()
+            self.__detach()
 
 
 class SocketProcessor:
     force_close_flag = threading.Event()
 
-    def __init__(self, sock, cert=None):
+    def __init__(self, sock, cert=None, binary_window=FRI_BINARY_WINDOW, compact_header=FRI_COMPACT_HEADER):
         self.__sock = sock
-        self.__rest_data = ''
         self.__cert = cert
+        self.binary_window = binary_window #max binary chunks in flight (0 - stop-and-wait)
+        self.__compact_header = compact_header #compact headers are supported by us
+        self.__compact_peer = False #compact headers are supported by peer
         self.__can_close_socket = False #socket can be closed (no pending chunks)
         self.__need_sock_close = False #socket should be closed (after all chunks received)
         self.__send_on_close = None #packet that should be send before close socket (ignore if None)
-
-    def read_next_packet(self):
-        data = ''
-        exp_len = None
-        header_len = 0
-        has_rest = len(self.__rest_data) > 0
-        while True:
+        self.__on_release = None #callback for returning socket to its owner (ignore if None)
+        self.__is_failed = False #socket is in undefined state and can not be reused
+        self.__use_cork = TCP_CORK is not None
+        self.packets_received = 0
+
+    def __recv_into(self, view):
+        """Fill memoryview from socket. Return received bytes count (less if EOF)"""
+        size = len(view)
+        received = 0
+        while received < size:
             if self.force_close_flag.is_set():
                 raise FriException('forcing socket close!')
 
-            if self.__rest_data:
-                data = self.__rest_data
-                self.__rest_data = ''
-            else:
-                received = self.__sock.recv(BUF_SIZE)
-
-                if not received:
-                    break
-
-                data += received
-
-            if exp_len is None:
-                if has_rest and len(data) < FRI_PACKET_INFO_LEN:
-                    continue
-                exp_len, header_len = FriBinaryProcessor.get_expected_len(data)
-            if exp_len and len(data) >= exp_len:
+            sock = self.__sock
+            if sock is None:
+                #socket is closed by other thread
+                raise FriException('Socket is closed')
+            cnt = sock.recv_into(view[received:], min(size-received, BUF_SIZE))
+            if not cnt:
                 break
+            received += cnt
+        return received
 
-        if not data:
+    def read_next_packet(self):
+        """Read next FRI packet from socket.
+        Packet is received into preallocated buffer, so returned binary data is
+        a memoryview of this buffer (no intermediate copies are made)
+        """
+        p_info = bytearray(FRI_PACKET_INFO_LEN)
+        received = self.__recv_into(memoryview(p_info))
+        if not received:
             raise FriException('empty data block')
 
-        if len(data) > exp_len:
-            self.__rest_data = data[exp_len:]
-            data = data[:exp_len]
+        exp_len, header_len = FriBinaryProcessor.get_expected_len(p_info[:received])
+        if exp_len < FRI_PACKET_INFO_LEN:
+            raise FriException('Invalid FRI packet! Packet length %s is too small'%exp_len)
+
+        data = bytearray(exp_len)
+        view = memoryview(data)
+        view[:FRI_PACKET_INFO_LEN] = p_info
+        received += self.__recv_into(view[FRI_PACKET_INFO_LEN:])
 
-        packet, bin_data = FriBinaryProcessor.from_binary(data, exp_len, header_len)
+        packet, bin_data = FriBinaryProcessor.from_binary(view[:received], exp_len, header_len)
         packet = FabnetPacket.create(packet)
+        if self.__compact_header and not self.__compact_peer:
+            self.__compact_peer = p_info[:4] == FRI_COMPACT_PROTOCOL_IDENTIFIER \
+                    or packet.header_codec == FRI_COMPACT_PROTOCOL_IDENTIFIER
+        self.packets_received += 1
         return packet, bin_data
 
     def __send_cert(self):
         req = FabnetPacketRequest(method='crtput', parameters={'certificate': self.__cert})
-        self.__sock.sendall(req.dump())
+        self.__send_buffers(self.__dump(req))
 
     def recv_packet(self, allow_socket_close=True):
         packet, bin_data = self.read_next_packet()
@@ -116,7 +172,9 @@ class SocketProcessor:
             raise FriException('Binary data found in init chunk packet (%s chunks expected)'%cnt)
 
         if cnt > 0:
-            packet.binary_data = SocketBasedChunks(self, cnt)
+            #sender window is negotiated down to our window (old nodes do not send it)
+            window = min(packet.binary_window, self.binary_window)
+            packet.binary_data = SocketBasedChunks(self, cnt, window)
             self.__can_close_socket = False
             return packet
 
@@ -131,38 +189,135 @@ class SocketProcessor:
     def send_packet(self, packet, wait_response=False):
         if packet.binary_data and packet.binary_data.chunks_count() > 1:
             packet.binary_chunk_cnt = packet.binary_data.chunks_count()
+            packet.binary_window = self.binary_window
 
-            self.__sock.sendall(packet.dump(with_bin=False))
+            self.write_packet(packet, with_bin=False)
+            packet.binary_window = 0
 
             if packet.is_request:
                 allow_packet, _ = self.read_next_packet()
                 if allow_packet.is_response and allow_packet.ret_code == RC_REQ_CERTIFICATE:
                     self.__send_cert()
 
+            #every RC_REQ_BINARY_CHUNK packet grants binary_window chunks
+            #(old nodes request chunks one by one without binary_window field)
+            credits = 0
             for i in xrange(packet.binary_chunk_cnt):
-                resp_packet = self.recv_packet()
-                if resp_packet.ret_code != RC_REQ_BINARY_CHUNK:
-                    return resp_packet
+                if not credits:
+                    resp_packet = self.recv_packet()
+                    if resp_packet.ret_code != RC_REQ_BINARY_CHUNK:
+                        return resp_packet
+                    credits = max(1, resp_packet.binary_window)
 
+                credits -= 1
                 packet.binary_chunk_idx = i+1
-                dumped_chunk = packet.dump_next_chunk()
-                self.__sock.sendall(dumped_chunk)
+                self.write_next_chunk(packet)
 
             packet.binary_chunk_cnt = None
             packet.binary_chunk_idx = None
         else:
-            self.__sock.sendall(packet.dump())
+            self.write_packet(packet)
 
         if wait_response:
             return self.recv_packet()
 
+    def write_packet(self, packet, with_bin=True):
+        """Send single packet without binary chunks processing"""
+        self.__send_buffers(self.__dump(packet, with_bin))
+
+    def write_next_chunk(self, packet):
+        """Send packet with next binary chunk of @packet"""
+        self.__send_buffers(packet.dump_next_chunk_buffers(self.__compact_peer))
+
+    def __dump(self, packet, with_bin=True):
+        """Dump packet with compact header if peer supports it.
+        Otherwise JSON header is used with hint that we accept compact headers
+        (nodes that do not support compact headers ignore it)
+        """
+        if self.__compact_peer:
+            return packet.dump_buffers(with_bin, compact=True)
+        if not self.__compact_header:
+            return packet.dump_buffers(with_bin)
+
+        packet.header_codec = FRI_COMPACT_PROTOCOL_IDENTIFIER
+        try:
+            return packet.dump_buffers(with_bin)
+        finally:
+            packet.header_codec = None
+
+    def __send_buffers(self, buffers):
+        """Send packet parts without joining them into one string.
+        Parts are coalesced into full TCP segments using TCP_CORK (if supported)
+        """
+        buffers = [buf for buf in buffers if buf]
+        if len(buffers) == 1:
+            self.__sock.sendall(buffers[0])
+            return
+
+        corked = self.__set_cork(1)
+        for buf in buffers:
+            self.__sock.sendall(buf)
+        if corked:
+            self.__set_cork(0)
+
+    def __set_cork(self, value):
+        if not self.__use_cork:
+            return False
+        try:
+            self.__sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, value)
+        except socket.error:
+            #not TCP socket
+            self.__use_cork = False
+            return False
+        return True
+
 
     def allow_close_socket(self):
         """This method trying close socket from SocketBasedChunks"""
         self.__can_close_socket = True
-        if self.__need_sock_close and self.__sock:
+        if self.__on_release:
+            self.__release()
+        elif self.__need_sock_close and self.__sock:
             self.__close_sock()
 
+    def release_socket(self, on_release):
+        """Return socket to its owner after all pending chunks are received.
+        on_release(socket_processor) is called when socket can be reused.
+        """
+        self.__on_release = on_release
+        if self.__can_close_socket:
+            self.__release()
+
+    def __release(self):
+        on_release = self.__on_release
+        self.__on_release = None
+        self.__can_close_socket = False
+        self.__need_sock_close = False
+        self.__send_on_close = None
+        self.packets_received = 0
+        on_release(self)
+
+    def set_failed(self):
+        self.__is_failed = True
+
+    def set_timeout(self, timeout):
+        if self.__sock:
+            self.__sock.settimeout(timeout)
+
+    def is_reusable(self):
+        return (self.__sock is not None) and (not self.__is_failed)
+
+    def is_alive(self):
+        """Check that idle socket is not closed by remote side"""
+        if not self.is_reusable():
+            return False
+        try:
+            r_list, _, _ = select.select([self.__sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        #idle socket should not be readable (EOF or unexpected data)
+        return not r_list
+
     def close_socket(self, force=False, send_on_close=None):
         self.__need_sock_close = True
         self.__send_on_close = send_on_close
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.keys_info_cache
+@author Konstantin Andrusenko
+@date June 5, 2013
+
+This module contains the implementation of KeysInfoCache class
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from nimbus_client.core.constants import KEYS_INFO_CACHE_SIZE, KEYS_INFO_CACHE_TTL
+
+
+class KeysInfoCache:
+    """LRU cache of data blocks locations (GetKeysInfo responses) by primary key.
+    Cached locations are not used after @ttl seconds
+    """
+    def __init__(self, max_size=KEYS_INFO_CACHE_SIZE, ttl=KEYS_INFO_CACHE_TTL):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, primary_key, replica_count):
+        """Return cached keys_info or None if locations are not cached"""
+        self.__lock.acquire()
+        try:
+            item = self.__items.pop(primary_key, None)
+            if item is None:
+                return None
+            expire_time, cached_replica_count, keys_info = item
+            if expire_time <= time.time() or cached_replica_count < replica_count:
+                return None
+            self.__items[primary_key] = item
+            return keys_info
+        finally:
+            self.__lock.release()
+
+    def put(self, primary_key, replica_count, keys_info):
+        self.__lock.acquire()
+        try:
+            self.__items.pop(primary_key, None)
+            self.__items[primary_key] = (time.time() + self.__ttl, replica_count, keys_info)
+            while len(self.__items) > self.__max_size:
+                self.__items.popitem(last=False)
+        finally:
+            self.__lock.release()
+
+    def invalidate(self, primary_key):
+        self.__lock.acquire()
+        try:
+            self.__items.pop(primary_key, None)
+        finally:
+            self.__lock.release()
+
+    def size(self):
+        return len(self.__items)
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.keys_reservation
+@author Konstantin Andrusenko
+@date May 29, 2013
+
+This module contains the implementation of KeysReservationPool class
+"""
+import time
+import threading
+from collections import deque
+
+from nimbus_client.core.constants import KEYS_RESERVATION_BATCH, KEYS_RESERVATION_TTL
+from nimbus_client.core.logger import logger
+
+
+class KeysReservationPool:
+    """Data block keys reserved in fabnet by batched PutKeysInfo calls.
+    fetch_func(count) should return list of (key, node_address) tuples.
+    Pool is refilled by background thread when it is getting empty.
+    Reservations are not used after @ttl seconds (node can forget them)
+    """
+    def __init__(self, fetch_func, batch_size=KEYS_RESERVATION_BATCH, ttl=KEYS_RESERVATION_TTL):
+        self.__fetch_func = fetch_func
+        self.__batch_size = batch_size
+        self.__low_watermark = batch_size / 4
+        self.__ttl = ttl
+        self.__keys = deque()
+        self.__lock = threading.Lock()
+        self.__fetch_lock = threading.Lock()
+        self.__refill_event = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+
+    def size(self):
+        return len(self.__keys)
+
+    def get(self, wait=True, accept=None):
+        """Return reserved (key, node_address) tuple.
+        If pool is empty keys are fetched in caller thread
+        (or None is returned if @wait is False).
+        Keys for which accept(node_address) is False are kept in pool,
+        None is returned if all reserved keys are not accepted
+        """
+        while True:
+            item = self.__pop(accept)
+            if item:
+                if len(self.__keys) <= self.__low_watermark:
+                    self.__start_refill()
+                return item
+
+            if self.__keys:
+                #reserved keys are not accepted (caller should reserve key by itself)
+                return None
+            if not wait:
+                self.__start_refill()
+                return None
+            self.refill()
+
+    def refill(self):
+        self.__fetch_lock.acquire()
+        try:
+            if len(self.__keys) > self.__low_watermark:
+                #already refilled by other thread
+                return
+
+            keys = self.__fetch_func(self.__batch_size)
+            if not keys:
+                raise Exception('No keys are reserved by PutKeysInfo call')
+
+            expire_time = time.time() + self.__ttl
+            self.__lock.acquire()
+            try:
+                for key, node_address in keys:
+                    self.__keys.append((expire_time, key, node_address))
+            finally:
+                self.__lock.release()
+        finally:
+            self.__fetch_lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__keys.clear()
+        finally:
+            self.__lock.release()
+
+    def stop(self):
+        self.__stopped = True
+        self.__refill_event.set()
+        if self.__thread and self.__thread.is_alive():
+            self.__thread.join()
+        self.clear()
+
+    def __pop(self, accept):
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            while self.__keys and self.__keys[0][0] <= now:
+                self.__keys.popleft()
+
+            if accept:
+                for i, (expire_time, key, node_address) in enumerate(self.__keys):
+                    if expire_time > now and accept(node_address):
+                        del self.__keys[i]
+                        return key, node_address
+                return None
+
+            while self.__keys:
+                expire_time, key, node_address = self.__keys.popleft()
+                if expire_time > now:
+                    return key, node_address
+            return None
+        finally:
+            self.__lock.release()
+
+    def __start_refill(self):
+        if self.__stopped:
+            return
+        if not self.__thread:
+            self.__lock.acquire()
+            try:
+                if not self.__thread:
+                    self.__thread = threading.Thread(target=self.__refill_loop)
+                    self.__thread.setName('KeysReservationThread')
+                    self.__thread.setDaemon(True)
+                    self.__thread.start()
+            finally:
+                self.__lock.release()
+        self.__refill_event.set()
+
+    def __refill_loop(self):
+        while True:
+            self.__refill_event.wait()
+            self.__refill_event.clear()
+            if self.__stopped:
+                break
+
+            try:
+                self.refill()
+            except Exception, err:
+                logger.warning('Keys reservation error: %s'%err)
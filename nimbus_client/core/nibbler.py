@@ -21,14 +21,18 @@ from nimbus_client.core.logger import logger
 from nimbus_client.core.fabnet_gateway import FabnetGateway
 from nimbus_client.core.data_block_cache import DataBlockCache
 from nimbus_client.core.journal import Journal 
-from nimbus_client.core.metadata import DirectoryMD, FileMD
+from nimbus_client.core.metadata import DirectoryMD
 from nimbus_client.core.metadata_file import MetadataFile 
 from nimbus_client.core.transactions_manager import TransactionsManager, Transaction
-from nimbus_client.core.workers_manager import WorkersManager, PutWorker, GetWorker, DeleteWorker 
+from nimbus_client.core.workers_manager import WorkersManager, PutWorker, GetWorker, DeleteWorker, \
+            AsyncWorkersManager, RetryScheduler
 from nimbus_client.core.smart_file_object import SmartFileObject
 from nimbus_client.core.data_block import DataBlock, DBLocksManager
+from nimbus_client.core.bandwidth import BandwidthLimiter
 from nimbus_client.core.utils import to_nimbus_path
 from nimbus_client.core.security_manager import AbstractSecurityManager
+from nimbus_client.core.constants import TE_THREADS, TE_ASYNC, DELETE_BATCH_SIZE, DELETE_FLUSH_INTERVAL, \
+            TR_LOG_DURABILITY_OS, NODE_MAX_CONCURRENCY
 
 
 class InprogressOperation:
@@ -72,13 +76,25 @@ class FSItem:
 
 class Nibbler:
     def __init__(self, fabnet_host, security_provider, parallel_put_count=3, \
-            parallel_get_count=3, cache_dir='/tmp', cache_size=None):
+            parallel_get_count=3, cache_dir='/tmp', cache_size=None, fri_multiplexed=False, \
+            transfer_engine=TE_THREADS, delete_batch_size=DELETE_BATCH_SIZE, \
+            delete_flush_interval=DELETE_FLUSH_INTERVAL, tr_log_durability=TR_LOG_DURABILITY_OS, \
+            upload_limit=0, download_limit=0, bandwidth_shares=None, bandwidth_schedule=None, \
+            node_max_calls=NODE_MAX_CONCURRENCY):
         if not isinstance(security_provider, AbstractSecurityManager):
             raise Exception('Invalid security provider type!')
+        if transfer_engine not in (TE_THREADS, TE_ASYNC):
+            raise Exception('Unsupported transfer engine "%s"'%transfer_engine)
+        self.__transfer_engine = transfer_engine
         self.__parallel_put_count = parallel_put_count
         self.__parallel_get_count = parallel_get_count
+        self.__delete_params = {'batch_size': delete_batch_size, 'flush_interval': delete_flush_interval}
+        self.__tr_log_durability = tr_log_durability
+        self.__node_max_calls = node_max_calls
+        self.bandwidth = BandwidthLimiter(upload_limit, download_limit, bandwidth_shares, bandwidth_schedule)
         self.security_provider = security_provider
-        self.fabnet_gateway = FabnetGateway(fabnet_host, security_provider)
+        self.fabnet_gateway = FabnetGateway(fabnet_host, security_provider, fri_multiplexed, \
+                max_node_calls=node_max_calls)
 
         prikey = self.security_provider.get_prikey()
         self.metadata_key = hashlib.sha1(str(prikey)).hexdigest()
@@ -91,6 +107,8 @@ class Nibbler:
         self.put_manager = None
         self.get_manager = None
         self.delete_manager = None
+        self.async_manager = None
+        self.retry_scheduler = None
 
         DataBlock.SECURITY_MANAGER = self.security_provider
         DataBlock.LOCK_MANAGER = DBLocksManager()
@@ -107,17 +125,31 @@ class Nibbler:
             raise NoJournalFoundException('No journal for key = %s'%self.metadata_key)
 
         self.metadata = MetadataFile(self.db_cache.get_static_cache_path(self.metadata_f_name), self.journal)
-        self.transactions_manager = TransactionsManager(self.metadata, self.db_cache, user_id=self.metadata_key)
+        self.transactions_manager = TransactionsManager(self.metadata, self.db_cache, user_id=self.metadata_key, \
+                log_durability=self.__tr_log_durability)
 
         SmartFileObject.setup_transaction_manager(self.transactions_manager)
 
+        if self.__transfer_engine == TE_ASYNC:
+            self.async_manager = AsyncWorkersManager(self.fabnet_gateway.fabnet_hostname, \
+                    self.security_provider, self.transactions_manager, \
+                    delete_batch_size=self.__delete_params['batch_size'], \
+                    delete_flush_interval=self.__delete_params['flush_interval'], bandwidth=self.bandwidth, \
+                    max_node_calls=self.__node_max_calls)
+            self.async_manager.start()
+            return
+
+        self.retry_scheduler = RetryScheduler()
         self.put_manager = WorkersManager(PutWorker, self.fabnet_gateway, \
-                self.transactions_manager, self.__parallel_put_count)  
+                self.transactions_manager, self.__parallel_put_count, retry_scheduler=self.retry_scheduler, \
+                bandwidth=self.bandwidth)
         self.get_manager = WorkersManager(GetWorker, self.fabnet_gateway, \
-                self.transactions_manager, self.__parallel_get_count)  
+                self.transactions_manager, self.__parallel_get_count, retry_scheduler=self.retry_scheduler, \
+                bandwidth=self.bandwidth)
         self.delete_manager = WorkersManager(DeleteWorker, self.fabnet_gateway, \
-                self.transactions_manager, 2)  
+                self.transactions_manager, 2, **self.__delete_params)
 
+        self.retry_scheduler.start()
         self.put_manager.start()
         self.get_manager.start()
         self.delete_manager.start()
@@ -138,12 +170,17 @@ class Nibbler:
 
     def stop(self):
         self.fabnet_gateway.force_close_all_connections()
+        self.fabnet_gateway.close()
+        if self.retry_scheduler:
+            self.retry_scheduler.stop()
         if self.put_manager:
             self.put_manager.stop()
         if self.get_manager:
             self.get_manager.stop()
         if self.delete_manager:
             self.delete_manager.stop()
+        if self.async_manager:
+            self.async_manager.stop()
         if self.metadata:
             self.metadata.close()
         if self.journal:
@@ -174,15 +211,9 @@ class Nibbler:
         inc_tr_l = []
 
         #try to find uploading files in @path (fully saved into data blocks cache)
-        for is_upload, file_path, status, size, _ in self.transactions_manager.iterate_transactions():
-            if not is_upload:
-                continue
-            if status != Transaction.TS_LOCAL_SAVED:
-                continue
-            base_path, file_name = os.path.split(file_path)
-            if base_path == path:
-                ret_lst.append(self.__make_item_fs(FileMD(name=file_name, size=size)))
-                inc_tr_l.append(file_name)
+        for file_md in self.transactions_manager.listdir_inprogress(path):
+            ret_lst.append(self.__make_item_fs(file_md))
+            inc_tr_l.append(file_md.name)
 
         items = self.metadata.listdir(path)
         for item in items:
@@ -271,26 +302,19 @@ class Nibbler:
             ret_list.append(InprogressOperation(is_upload, file_path, status, size, progress_perc))
         return ret_list
 
+    def set_bandwidth_limits(self, upload_limit, download_limit, class_shares=None, schedule=None):
+        """Change upload/download limits (bytes per second, 0 is unlimited) of running transfers"""
+        self.bandwidth.set_limits(upload_limit, download_limit, class_shares, schedule)
+
     def has_incomlete_operations(self):
-        for _, _, status, _, _ in self.transactions_manager.iterate_transactions():
-            if status not in (Transaction.TS_FINISHED, Transaction.TS_FAILED):
+        for is_upload in (True, False):
+            if self.transactions_manager.get_transfers_progress(is_upload)[0]:
                 return True
         return False
 
     def transactions_progress(self):
-        up_data_sum = 0
-        up_data_all = 0
-        down_data_sum = 0
-        down_data_all = 0
-
-        for is_upload, _, status, size, progress_perc in self.transactions_manager.iterate_transactions():
-            if status not in (Transaction.TS_FINISHED, Transaction.TS_FAILED):
-                if is_upload:
-                    up_data_sum += (size * progress_perc)/100.
-                    up_data_all += size
-                else:
-                    down_data_sum += (size * progress_perc)/100. 
-                    down_data_all += size
+        _, up_data_sum, up_data_all = self.transactions_manager.get_transfers_progress(True)
+        _, down_data_sum, down_data_all = self.transactions_manager.get_transfers_progress(False)
 
         if up_data_all == 0:
             up_perc = 100 #all data is upladed
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.nodes_health
+@author Konstantin Andrusenko
+@date June 10, 2013
+
+This module contains the implementation of NodesHealth class
+"""
+import time
+import random
+import threading
+
+from nimbus_client.core.constants import NODE_BREAKER_ERRORS, NODE_BREAKER_OPEN_TIME, \
+            NODE_BREAKER_MAX_OPEN_TIME, NODE_MAX_CONCURRENCY, RETRY_MIN_DELAY, FG_ERROR_TIMEOUT
+from nimbus_client.core.exceptions import NodeUnavailableException
+from nimbus_client.core.logger import logger
+
+
+def backoff_delay(attempt, min_delay=RETRY_MIN_DELAY, max_delay=FG_ERROR_TIMEOUT):
+    """Exponential backoff delay with jitter for @attempt (starting from 0)"""
+    delay = min(min_delay * (2 ** min(attempt, 30)), max_delay)
+    return random.uniform(delay / 2.0, delay)
+
+
+class NodeHealth:
+    def __init__(self):
+        self.failures = 0 #consecutive failed calls
+        self.opens = 0 #consecutive circuit breaker openings
+        self.open_until = 0
+        self.probing = False
+        self.calls = 0
+
+
+class NodesHealth:
+    """Per-node circuit breaker and concurrency limiter.
+    Calls to node are not allowed while its breaker is open (after @max_errors consecutive failures).
+    When open time is expired single probe call is allowed, next failure opens breaker for twice longer time
+    """
+    def __init__(self, max_errors=NODE_BREAKER_ERRORS, open_time=NODE_BREAKER_OPEN_TIME, \
+            max_open_time=NODE_BREAKER_MAX_OPEN_TIME, max_concurrency=NODE_MAX_CONCURRENCY):
+        self.__max_errors = max_errors
+        self.__open_time = open_time
+        self.__max_open_time = max_open_time
+        self.__max_concurrency = max_concurrency
+        self.__nodes = {}
+        self.__lock = threading.Lock()
+
+    def __get_health(self, node_address):
+        health = self.__nodes.get(node_address, None)
+        if health is None:
+            health = self.__nodes[node_address] = NodeHealth()
+        return health
+
+    def __retry_after(self, health, now):
+        if self.__max_concurrency and health.calls >= self.__max_concurrency:
+            return RETRY_MIN_DELAY
+        if health.open_until > now:
+            return health.open_until - now
+        if health.probing:
+            return RETRY_MIN_DELAY
+        return 0
+
+    def retry_after(self, node_address):
+        """Seconds after which call to node can be allowed (0 if node is available now)"""
+        self.__lock.acquire()
+        try:
+            health = self.__nodes.get(node_address, None)
+            if health is None:
+                return 0
+            return self.__retry_after(health, time.time())
+        finally:
+            self.__lock.release()
+
+    def is_available(self, node_address):
+        return self.retry_after(node_address) == 0
+
+    def acquire(self, node_address):
+        """Take call slot of node. NodeUnavailableException is raised if node breaker
+        is open or node calls limit is reached
+        """
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            health = self.__get_health(node_address)
+            retry_after = self.__retry_after(health, now)
+            if retry_after:
+                raise NodeUnavailableException('Node %s is unavailable'%node_address, retry_after)
+            if health.opens:
+                health.probing = True
+            health.calls += 1
+        finally:
+            self.__lock.release()
+
+    def release(self, node_address, is_failed):
+        self.__lock.acquire()
+        try:
+            health = self.__get_health(node_address)
+            health.calls -= 1
+            health.probing = False
+            if not is_failed:
+                health.failures = health.opens = 0
+                return
+
+            health.failures += 1
+            if health.opens or health.failures >= self.__max_errors:
+                open_time = min(self.__open_time * (2 ** min(health.opens, 30)), self.__max_open_time)
+                health.open_until = time.time() + random.uniform(open_time / 2.0, open_time)
+                health.opens += 1
+                logger.warning('Node %s is unavailable for %.1f seconds (%s failed calls)'%\
+                        (node_address, health.open_until - time.time(), health.failures))
+        finally:
+            self.__lock.release()
+
+    def sort_nodes(self, items, get_address=lambda item: item):
+        """Return items with available nodes first (order of items is not changed otherwise)"""
+        return sorted(items, key=lambda item: not self.is_available(get_address(item)))
+
+    def get_state(self, node_address):
+        """Return (is breaker open, consecutive failures, active calls) of node"""
+        self.__lock.acquire()
+        try:
+            health = self.__nodes.get(node_address, None)
+            if health is None:
+                return False, 0, 0
+            return health.open_until > time.time(), health.failures, health.calls
+        finally:
+            self.__lock.release()
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.nodes_monitor
+@author Konstantin Andrusenko
+@date June 3, 2013
+
+This module contains the implementation of NodesMonitor class
+"""
+import time
+import threading
+from collections import deque
+
+from nimbus_client.core.constants import NODE_STATS_SAMPLES, NODE_ERROR_PENALTY, NODE_ERROR_WINDOW, \
+            HEDGE_PERCENTILE, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY
+
+EWMA_WEIGHT = 0.3
+
+
+class NodeStats:
+    def __init__(self):
+        self.latency = None #EWMA of response latency (seconds)
+        self.throughput = None #EWMA of binary stream throughput (bytes per second)
+        self.samples = deque(maxlen=NODE_STATS_SAMPLES)
+        self.errors = deque(maxlen=NODE_STATS_SAMPLES)
+
+    def add_latency(self, latency):
+        self.samples.append(latency)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_WEIGHT * (latency - self.latency)
+
+    def add_throughput(self, throughput):
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput += EWMA_WEIGHT * (throughput - self.throughput)
+
+    def recent_errors(self, now):
+        return len([err_time for err_time in self.errors if now - err_time < NODE_ERROR_WINDOW])
+
+
+class NodesMonitor:
+    """Per-node latency, throughput and errors tracker.
+    Used for choosing best replica and hedged request delay
+    """
+    def __init__(self):
+        self.__nodes = {}
+        self.__lock = threading.Lock()
+
+    def __get_stats(self, node_address):
+        stats = self.__nodes.get(node_address, None)
+        if stats is None:
+            stats = self.__nodes[node_address] = NodeStats()
+        return stats
+
+    def add_response(self, node_address, latency):
+        self.__lock.acquire()
+        try:
+            self.__get_stats(node_address).add_latency(latency)
+        finally:
+            self.__lock.release()
+
+    def add_transfer(self, node_address, size, duration):
+        if duration <= 0 or not size:
+            return
+        self.__lock.acquire()
+        try:
+            self.__get_stats(node_address).add_throughput(size / duration)
+        finally:
+            self.__lock.release()
+
+    def add_error(self, node_address):
+        self.__lock.acquire()
+        try:
+            self.__get_stats(node_address).errors.append(time.time())
+        finally:
+            self.__lock.release()
+
+    def score(self, node_address):
+        """Expected node response time in seconds (less is better).
+        Unknown nodes have zero score, so they are tried first
+        """
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            stats = self.__nodes.get(node_address, None)
+            if stats is None:
+                return 0
+            return (stats.latency or 0) + stats.recent_errors(now) * NODE_ERROR_PENALTY
+        finally:
+            self.__lock.release()
+
+    def sort_nodes(self, items, get_address=lambda item: item):
+        """Return items sorted by node score (order of equal nodes is not changed)"""
+        return sorted(items, key=lambda item: self.score(get_address(item)))
+
+    def hedge_delay(self, node_address):
+        """Time to wait response from node before request to other replica is sent"""
+        self.__lock.acquire()
+        try:
+            stats = self.__nodes.get(node_address, None)
+            if stats is None or len(stats.samples) < 5:
+                return HEDGE_DEFAULT_DELAY
+            samples = sorted(stats.samples)
+        finally:
+            self.__lock.release()
+
+        delay = samples[min(len(samples)-1, int(len(samples) * HEDGE_PERCENTILE))]
+        return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def get_stats(self, node_address):
+        """Return (latency, throughput, recent errors count) of node"""
+        self.__lock.acquire()
+        try:
+            stats = self.__nodes.get(node_address, None)
+            if stats is None:
+                return None, None, 0
+            return stats.latency, stats.throughput, stats.recent_errors(time.time())
+        finally:
+            self.__lock.release()
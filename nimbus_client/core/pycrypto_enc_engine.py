@@ -25,6 +25,7 @@ EOF_PATTERN = re.compile('%s%s*$'%(INTERRUPT, PAD))
 
 
 class PythonCryptoEngine:
+    BLOCK_SIZE = BLOCK_SIZE
     RAND = Random.new()
     K_CIPHER = None
     __KEY = None
@@ -61,6 +62,8 @@ class PythonCryptoEngine:
             iv = self._get_random(16)
             self.__enc_data = self.K_CIPHER.encrypt(secret+iv)
 
+        self.__secret = secret
+        self.__iv = iv
         self.__cipher = AES.new(secret, AES.MODE_CBC, iv)
         self.__rest_str = ''
         self.__prev_dec_str = ''
@@ -113,16 +116,18 @@ class PythonCryptoEngine:
         return encrypted
     
     def decrypt(self, data, finalize=False):
-        data = self.__rest_str + data
-        self.__rest_str = ''
+        """Decrypt str or buffer object (data of buffer is not copied if it is aligned to cipher block)"""
+        if self.__rest_str:
+            data = self.__rest_str + str(data)
+            self.__rest_str = ''
         data_len = len(data)
         if data_len < BLOCK_SIZE:
-            self.__rest_str = data
+            self.__rest_str = str(data)
             return ''
         rest_len = data_len % BLOCK_SIZE
         if rest_len:
-            self.__rest_str = data[data_len-rest_len:]
-            data = data[:data_len-rest_len]
+            self.__rest_str = str(data[data_len-rest_len:])
+            data = buffer(data, 0, data_len-rest_len)
 
         d_data = self.__cipher.decrypt(data)
         if finalize:
@@ -133,6 +138,20 @@ class PythonCryptoEngine:
 
         return ret_data
 
+    def restore(self, prev_block, tail):
+        """Restore encryption state for appending data after @prev_block cipher block
+        (IV from header is used if it is None). @tail is last cipher blocks that will be
+        encrypted again, so padding is stripped from them. Returns decrypted @tail
+        """
+        iv = prev_block or self.__iv
+        rest = ''
+        if tail:
+            rest = self.__strip_padding(AES.new(self.__secret, AES.MODE_CBC, iv).decrypt(tail))
+        self.__cipher = AES.new(self.__secret, AES.MODE_CBC, iv)
+        self.__rest_str = rest
+        self.__prev_dec_str = ''
+        return rest
+
     def get_encrypted_header(self):
         return self.__enc_data 
 
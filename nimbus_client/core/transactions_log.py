@@ -0,0 +1,481 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.transactions_log
+@author Konstantin Andrusenko
+@date June 18, 2013
+
+This module contains the implementation of TransactionsLog class
+"""
+import os
+import zlib
+import base64
+import struct
+import threading
+
+from nimbus_client.core.constants import TR_LOG_DURABILITY_LAZY, TR_LOG_DURABILITY_OS, \
+                            TR_LOG_DURABILITY_FSYNC, TR_LOG_BUFFER_SIZE
+from nimbus_client.core.logger import logger
+
+#records types
+RT_START = 'ST'
+RT_STATUS = 'US'
+RT_TRANSFER = 'UT'
+RT_RANGE = 'UR'
+
+
+class TransactionsLog:
+    """Binary log of transactions events.
+    Each record is prefixed by payload length and CRC32 of payload. Records appended by
+    concurrent threads are written by single write (group commit), so appenders wait
+    for write (and fsync) of whole batch instead of each other.
+
+    Log is split into segments. Records are appended to active segment file (@path.<number>),
+    snapshot file (@path) contains compacted records of all segments up to number saved in its header.
+    Compaction is made by background thread: active segment is sealed, records of sealed segments
+    are filtered by @compact_func into new snapshot that atomically replaces old one.
+    Legacy text log (at @path) is read transparently (it is rewritten in binary format by truncate call)
+    """
+    MAGIC = 'NTRLOG\x00\x01'
+    SNAPSHOT_STRUCT = '<Q'
+    SNAPSHOT_STRUCT_SIZE = struct.calcsize(SNAPSHOT_STRUCT)
+    RECORD_STRUCT = '<II'
+    RECORD_STRUCT_SIZE = struct.calcsize(RECORD_STRUCT)
+    TYPES_MAP = {RT_START: 1, RT_STATUS: 2, RT_TRANSFER: 3, RT_RANGE: 4}
+
+    def __init__(self, path, durability=TR_LOG_DURABILITY_OS, compact_func=None):
+        if durability not in (TR_LOG_DURABILITY_LAZY, TR_LOG_DURABILITY_OS, TR_LOG_DURABILITY_FSYNC):
+            raise Exception('Unsupported transactions log durability "%s"'%durability)
+        self.__path = path
+        self.__durability = durability
+        self.__compact_func = compact_func
+        self.__f_obj = None
+        self.__segment_num = None
+        self.__cond = threading.Condition(threading.Lock())
+        self.__pending = []
+        self.__pending_len = 0
+        self.__appended = 0
+        self.__committed = 0
+        self.__committing = False
+        self.__commit_error = None #(last record of failed group commit, error)
+
+        self.__compact_lock = threading.Lock()
+        self.__compact_event = threading.Event()
+        self.__compactor = None
+        self.__stopped = False
+
+    def is_closed(self):
+        return self.__f_obj is None
+
+    def close(self):
+        self.__stop_compactor()
+        self.__cond.acquire()
+        try:
+            if self.__f_obj is None:
+                return
+            try:
+                self.__commit(self.__appended)
+            finally:
+                self.__f_obj.close()
+                self.__f_obj = None
+        finally:
+            self.__cond.release()
+
+    def truncate(self):
+        """Remove all records from log (legacy text log is converted to binary log here)"""
+        self.close()
+        self.__compact_lock.acquire()
+        try:
+            self.__cond.acquire()
+            try:
+                self.__create()
+            finally:
+                self.__cond.release()
+        finally:
+            self.__compact_lock.release()
+
+    def __segment_path(self, segment_num):
+        return '%s.%06i'%(self.__path, segment_num)
+
+    def __get_segments(self):
+        """Return sorted list of (segment number, segment path)"""
+        log_dir, log_name = os.path.split(self.__path)
+        segments = []
+        for file_name in os.listdir(log_dir or '.'):
+            if not file_name.startswith(log_name + '.'):
+                continue
+            num = file_name[len(log_name)+1:]
+            if num.isdigit():
+                segments.append((int(num), os.path.join(log_dir, file_name)))
+        return sorted(segments)
+
+    def __get_snapshot_segment(self):
+        """Return number of last segment compacted into snapshot (None if there is no binary snapshot)"""
+        if not os.path.exists(self.__path):
+            return None
+        f_obj = open(self.__path, 'rb')
+        try:
+            header = f_obj.read(len(self.MAGIC) + self.SNAPSHOT_STRUCT_SIZE)
+        finally:
+            f_obj.close()
+        if len(header) != len(self.MAGIC) + self.SNAPSHOT_STRUCT_SIZE or not header.startswith(self.MAGIC):
+            return None
+        return struct.unpack(self.SNAPSHOT_STRUCT, header[len(self.MAGIC):])[0]
+
+    def __write_snapshot(self, last_segment, records):
+        """Replace snapshot file atomically"""
+        tmp_path = self.__path + '.tmp'
+        f_obj = open(tmp_path, 'wb')
+        try:
+            f_obj.write(self.MAGIC + struct.pack(self.SNAPSHOT_STRUCT, last_segment))
+            f_obj.write(''.join([self.__encode_record(record) for record in records]))
+            f_obj.flush()
+            os.fsync(f_obj.fileno())
+        finally:
+            f_obj.close()
+        os.rename(tmp_path, self.__path)
+
+    def __open_segment(self, segment_num):
+        segment_path = self.__segment_path(segment_num)
+        self.__f_obj = open(segment_path, 'ab')
+        if self.__f_obj.tell() == 0:
+            self.__f_obj.write(self.MAGIC)
+            self.__f_obj.flush()
+        self.__segment_num = segment_num
+
+    def __create(self):
+        for _, segment_path in self.__get_segments():
+            os.remove(segment_path)
+        self.__write_snapshot(0, [])
+        self.__open_segment(1)
+
+    def __open(self):
+        snapshot_segment = self.__get_snapshot_segment()
+        if snapshot_segment is None:
+            if os.path.exists(self.__path) and os.path.getsize(self.__path) > 0:
+                #legacy text log can not be appended
+                logger.warning('Legacy transactions log %s is truncated'%self.__path)
+            self.__create()
+            return
+
+        segments = [num for num, _ in self.__get_segments() if num > snapshot_segment]
+        self.__open_segment(max(segments or [snapshot_segment + 1]))
+
+    def start_transaction(self, transaction_id, transaction_type, file_path, replica_count):
+        self.__append((RT_START, transaction_id, transaction_type, file_path, replica_count))
+
+    def update_state(self, transaction_id, status):
+        self.__append((RT_STATUS, transaction_id, status))
+
+    def update_transfer(self, transaction_id, seek, size, local_name, foreign_name):
+        self.__append((RT_TRANSFER, transaction_id, seek, size, local_name, foreign_name))
+
+    def update_range(self, transaction_id, seek, offset, key=None, node_addr=None):
+        """Save transferred offset of data block (and backend key and node of interrupted upload)"""
+        self.__append((RT_RANGE, transaction_id, seek, offset, key, node_addr))
+
+    def request_compaction(self):
+        """Seal active segment and compact sealed segments in background"""
+        self.__cond.acquire()
+        try:
+            if self.__f_obj is None:
+                return
+            while self.__committing:
+                self.__cond.wait()
+            self.__f_obj.write(''.join(self.__pending))
+            self.__f_obj.flush()
+            if self.__durability == TR_LOG_DURABILITY_FSYNC:
+                os.fsync(self.__f_obj.fileno())
+            self.__f_obj.close()
+            self.__pending = []
+            self.__pending_len = 0
+            self.__committed = self.__appended
+            self.__open_segment(self.__segment_num + 1)
+
+            if not self.__compactor:
+                self.__compactor = threading.Thread(target=self.__compaction_loop)
+                self.__compactor.setName('TrLogCompactionThread')
+                self.__compactor.setDaemon(True)
+                self.__compactor.start()
+        finally:
+            self.__cond.release()
+        self.__compact_event.set()
+
+    def __compaction_loop(self):
+        while True:
+            self.__compact_event.wait()
+            self.__compact_event.clear()
+            if self.__stopped:
+                break
+
+            try:
+                self.compact()
+            except Exception, err:
+                logger.error('Transactions log compaction error: %s'%err)
+                logger.traceback_debug()
+
+    def __stop_compactor(self):
+        compactor = self.__compactor
+        if compactor:
+            self.__stopped = True
+            self.__compact_event.set()
+            compactor.join()
+            self.__compactor = None
+            self.__stopped = False
+
+    def compact(self):
+        """Compact sealed segments into snapshot. Appends to active segment are not blocked"""
+        self.__compact_lock.acquire()
+        try:
+            self.__cond.acquire()
+            try:
+                active_segment = self.__segment_num
+            finally:
+                self.__cond.release()
+            if active_segment is None:
+                return
+
+            snapshot_segment = self.__get_snapshot_segment()
+            if snapshot_segment is None:
+                return
+            segments = [(num, path) for num, path in self.__get_segments() if num < active_segment]
+            if not [num for num, _ in segments if num > snapshot_segment]:
+                return
+
+            records = list(self.__iter_file(self.__path, len(self.MAGIC) + self.SNAPSHOT_STRUCT_SIZE))
+            for num, segment_path in segments:
+                if num > snapshot_segment:
+                    records.extend(self.__iter_file(segment_path, len(self.MAGIC)))
+            if self.__compact_func:
+                records = self.__compact_func(records)
+
+            self.__write_snapshot(active_segment - 1, records)
+            for _, segment_path in segments:
+                os.remove(segment_path)
+            logger.debug('transactions log is compacted up to segment %s'%(active_segment - 1))
+        finally:
+            self.__compact_lock.release()
+
+    def flush(self):
+        """Write all buffered records to log file"""
+        self.__cond.acquire()
+        try:
+            self.__commit(self.__appended)
+        finally:
+            self.__cond.release()
+
+    def __pack_str(self, val):
+        if val is None:
+            return struct.pack('<i', -1)
+        val = str(val)
+        return struct.pack('<i', len(val)) + val
+
+    def __unpack_str(self, data, pos):
+        s_len, = struct.unpack('<i', data[pos:pos+4])
+        pos += 4
+        if s_len < 0:
+            return None, pos
+        return data[pos:pos+s_len], pos+s_len
+
+    def __encode_record(self, record):
+        r_type, transaction_id = record[:2]
+        if r_type == RT_START:
+            transaction_type, file_path, replica_count = record[2:]
+            r_body = struct.pack('<BI', transaction_type, replica_count) + self.__pack_str(file_path)
+        elif r_type == RT_STATUS:
+            r_body = struct.pack('<B', record[2])
+        elif r_type == RT_RANGE:
+            seek, offset, key, node_addr = record[2:]
+            r_body = struct.pack('<QQ', seek, offset) + self.__pack_str(key) + self.__pack_str(node_addr)
+        else:
+            seek, size, local_name, foreign_name = record[2:]
+            if size is None:
+                size = -1
+            r_body = struct.pack('<Qq', seek, size) + self.__pack_str(local_name) + self.__pack_str(foreign_name)
+
+        payload = struct.pack('<B', self.TYPES_MAP[r_type]) + self.__pack_str(transaction_id) + r_body
+        return struct.pack(self.RECORD_STRUCT, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def __append(self, record):
+        record = self.__encode_record(record)
+
+        self.__cond.acquire()
+        try:
+            if self.__f_obj is None:
+                self.__open()
+            self.__pending.append(record)
+            self.__pending_len += len(record)
+            self.__appended += 1
+            if self.__durability == TR_LOG_DURABILITY_LAZY and self.__pending_len < TR_LOG_BUFFER_SIZE:
+                return
+            self.__commit(self.__appended)
+        finally:
+            self.__cond.release()
+
+    def __commit(self, record_num):
+        """Wait while records are written up to @record_num.
+        First waiting thread writes all pending records, others wait for it.
+        If write fails, error is raised in every thread waiting for the failed records
+        (they are written again by next commit).
+        Should be called with acquired condition
+        """
+        while self.__committed < record_num:
+            if self.__commit_error and self.__commit_error[0] >= record_num:
+                raise self.__commit_error[1]
+            if self.__committing:
+                self.__cond.wait()
+                continue
+
+            self.__committing = True
+            records = self.__pending
+            last_record = self.__appended
+            self.__pending = []
+            self.__pending_len = 0
+            f_obj = self.__f_obj
+            self.__cond.release()
+            error = None
+            try:
+                pos = os.fstat(f_obj.fileno()).st_size #log file is opened for appending
+                try:
+                    f_obj.write(''.join(records))
+                    f_obj.flush()
+                    if self.__durability == TR_LOG_DURABILITY_FSYNC:
+                        os.fsync(f_obj.fileno())
+                except (IOError, OSError), error:
+                    logger.error('Transactions log write error: %s'%error)
+                    self.__drop_tail(f_obj, pos)
+            finally:
+                self.__cond.acquire()
+                self.__committing = False
+                if error is None:
+                    self.__committed = last_record
+                    self.__commit_error = None
+                else:
+                    self.__pending = records + self.__pending
+                    self.__pending_len += sum(len(record) for record in records)
+                    self.__commit_error = (last_record, error)
+                self.__cond.notify_all()
+
+    def __drop_tail(self, f_obj, pos):
+        """Remove partially written records from log file"""
+        try:
+            f_obj.seek(pos)
+            f_obj.truncate(pos)
+        except (IOError, OSError), err:
+            logger.error('Transactions log is not truncated after write error: %s'%err)
+
+    def iter_records(self):
+        """Iterate records of snapshot and segments (pending records are not iterated, see flush method).
+        Yields tuples:
+            (RT_START, transaction_id, transaction_type, file_path, replica_count)
+            (RT_STATUS, transaction_id, status)
+            (RT_TRANSFER, transaction_id, seek, size, local_name, foreign_name)
+            (RT_RANGE, transaction_id, seek, offset, key, node_addr)
+        """
+        self.__compact_lock.acquire()
+        try:
+            snapshot_segment = self.__get_snapshot_segment()
+            if snapshot_segment is None:
+                #no segments without snapshot
+                if not os.path.exists(self.__path):
+                    return iter([])
+                f_obj = open(self.__path, 'rb')
+                try:
+                    return iter(list(self.__iter_legacy_records(f_obj)))
+                finally:
+                    f_obj.close()
+
+            records = list(self.__iter_file(self.__path, len(self.MAGIC) + self.SNAPSHOT_STRUCT_SIZE))
+            for num, segment_path in self.__get_segments():
+                if num > snapshot_segment:
+                    records.extend(self.__iter_file(segment_path, len(self.MAGIC)))
+            return iter(records)
+        finally:
+            self.__compact_lock.release()
+
+    def __iter_file(self, path, header_len):
+        f_obj = open(path, 'rb')
+        try:
+            f_obj.seek(header_len)
+            while True:
+                header = f_obj.read(self.RECORD_STRUCT_SIZE)
+                if not header:
+                    break
+                payload = None
+                if len(header) == self.RECORD_STRUCT_SIZE:
+                    payload_len, crc = struct.unpack(self.RECORD_STRUCT, header)
+                    payload = f_obj.read(payload_len)
+                    if len(payload) != payload_len or (zlib.crc32(payload) & 0xffffffff) != crc:
+                        payload = None
+                if payload is None:
+                    #not fully written tail of log
+                    logger.warning('Transactions log %s is corrupted at %s, rest records are skipped'%\
+                            (path, f_obj.tell()))
+                    break
+
+                yield self.__parse_record(payload)
+        finally:
+            f_obj.close()
+
+    def __parse_record(self, payload):
+        r_type, = struct.unpack('<B', payload[:1])
+        transaction_id, pos = self.__unpack_str(payload, 1)
+        transaction_id = self.__parse_id(transaction_id)
+        if r_type == self.TYPES_MAP[RT_START]:
+            transaction_type, replica_count = struct.unpack('<BI', payload[pos:pos+5])
+            file_path, pos = self.__unpack_str(payload, pos+5)
+            return RT_START, transaction_id, transaction_type, file_path, replica_count
+        elif r_type == self.TYPES_MAP[RT_STATUS]:
+            status, = struct.unpack('<B', payload[pos:pos+1])
+            return RT_STATUS, transaction_id, status
+        elif r_type == self.TYPES_MAP[RT_TRANSFER]:
+            seek, size = struct.unpack('<Qq', payload[pos:pos+16])
+            local_name, pos = self.__unpack_str(payload, pos+16)
+            foreign_name, pos = self.__unpack_str(payload, pos)
+            if size < 0:
+                size = None
+            return RT_TRANSFER, transaction_id, seek, size, local_name, foreign_name
+        elif r_type == self.TYPES_MAP[RT_RANGE]:
+            seek, offset = struct.unpack('<QQ', payload[pos:pos+16])
+            key, pos = self.__unpack_str(payload, pos+16)
+            node_addr, pos = self.__unpack_str(payload, pos)
+            return RT_RANGE, transaction_id, seek, offset, key, node_addr
+        raise Exception('Unknown transactions log record type: %s'%r_type)
+
+    def __parse_id(self, transaction_id):
+        if transaction_id.isdigit():
+            return int(transaction_id)
+        return transaction_id
+
+    def __iter_legacy_records(self, f_obj):
+        def parse_int(val):
+            if val in [None, 'None']:
+                return None
+            return int(val)
+
+        def parse_str(val):
+            if val in [None, 'None']:
+                return None
+            return val
+
+        for line in f_obj.readlines():
+            parts = line.split()
+            if not parts:
+                continue
+
+            transaction_id = self.__parse_id(parts[0])
+            r_type = parts[1]
+            if r_type == RT_START:
+                yield RT_START, transaction_id, int(parts[2]), base64.b64decode(parts[3]), int(parts[4])
+            elif r_type == RT_STATUS:
+                yield RT_STATUS, transaction_id, int(parts[2])
+            elif r_type == RT_TRANSFER:
+                try:
+                    foreign_name = parse_str(parts[5])
+                except IndexError:
+                    foreign_name = None
+                yield RT_TRANSFER, transaction_id, int(parts[2]), parse_int(parts[3]), \
+                        parse_str(parts[4]), foreign_name
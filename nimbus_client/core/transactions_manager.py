@@ -12,26 +12,58 @@ This module contains the implementation of Transaction and TransactionsManager c
 """
 import os
 import hashlib
-import base64
 import uuid
 import shutil
+import threading
 from datetime import datetime
+from collections import OrderedDict
 from Queue import Queue
 
 from nimbus_client.core.logger import logger
 from nimbus_client.core.events import events_provider
 from nimbus_client.core.data_block import DataBlock
+from nimbus_client.core.transactions_log import TransactionsLog, RT_START, RT_STATUS, RT_TRANSFER, RT_RANGE
+from nimbus_client.core.transfers_queue import TransfersQueue
+from nimbus_client.core.constants import TR_LOG_DURABILITY_OS, TP_INTERACTIVE_READ, \
+                            TP_INTERACTIVE_WRITE, TP_BACKGROUND_SYNC
 from nimbus_client.core.metadata import FileMD, ChunkMD
-from nimbus_client.core.base_safe_object import LockObject
 from nimbus_client.core.exceptions import AlreadyExistsException, \
                             NotDirectoryException, PathException, NoLocalFileFound
 
-GTLock = LockObject()
-TLock = LockObject()
-
 MAX_TR_LOG_ITEMS = 100
 
+
+class TransfersProgress:
+    """Running sums over active (not finished and not failed) transactions:
+    count of transactions, transferred bytes (weighted by transaction progress) and total bytes
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {True: [0, 0, 0], False: [0, 0, 0]}
+
+    def update(self, is_upload, count_delta, done_delta, size_delta):
+        self.__lock.acquire()
+        try:
+            counters = self.__counters[is_upload]
+            counters[0] += count_delta
+            counters[1] += done_delta
+            counters[2] += size_delta
+        finally:
+            self.__lock.release()
+
+    def get(self, is_upload):
+        """Return (active transactions count, transferred bytes, total bytes)"""
+        self.__lock.acquire()
+        try:
+            return tuple(self.__counters[is_upload])
+        finally:
+            self.__lock.release()
+
+
 class Transaction:
+    """Transaction state is guarded by its own lock, so transactions are not blocked by each other.
+    Transaction type, path, replica count and ID are not changed after creation
+    """
     TS_INIT = 0
     TS_LOCAL_SAVED = 1
     TS_FINISHED = 2
@@ -43,7 +75,7 @@ class Transaction:
     TS_MAP = {0: 'INIT', 1: 'LOCAL_SAVED', 2: 'FINISHED', 3: 'FAILED'}
 
     def __init__(self, transaction_type, file_path, replica_count, \
-            transaction_id=None, is_local=False):
+            transaction_id=None, is_local=False, priority=None):
         if transaction_type not in (self.TT_UPLOAD, self.TT_DOWNLOAD):
             raise RuntimeError('Unknown transaction type: %s'%transaction_type)
         self.__start_dt = datetime.now()
@@ -52,7 +84,17 @@ class Transaction:
         self.__status = Transaction.TS_INIT
         self.__file_path = file_path
         self.__data_blocks_info = {}
+        self.__ranges = {} #seek -> (transferred offset, backend key, node address) of interrupted transfer
         self.__is_local = is_local
+        self.__lock = threading.RLock()
+        self.__total_size = 0
+        self.__done_size = 0 #size of transferred data (finished data blocks and transferred parts of others)
+        self.__in_flight = {} #seek -> transferred size of data block that is not finished
+        self.__progress_counters = None
+        self.__progress_contrib = (0, 0, 0)
+        if priority is None:
+            priority = TP_INTERACTIVE_WRITE if transaction_type == self.TT_UPLOAD else TP_INTERACTIVE_READ
+        self.__priority = priority
         if transaction_id:
             self.__transaction_id = transaction_id
         else:
@@ -66,91 +108,96 @@ class Transaction:
     def get_start_datetime(self):
         return self.__start_dt
 
-    @TLock
     def get_replica_count(self):
         return self.__replica_count
     
-    @TLock
     def get_id(self):
         return self.__transaction_id
 
-    @TLock
     def get_file_path(self):
         return self.__file_path
 
-    @TLock
     def get_transaction_type(self):
         return self.__transaction_type
 
-    @TLock
     def is_uploading(self):
         return self.__transaction_type == self.TT_UPLOAD
 
-    @TLock
     def is_downloading(self):
         return self.__transaction_type == self.TT_DOWNLOAD
 
-    @TLock
     def is_failed(self):
         return self.__status == self.TS_FAILED
 
-    @TLock
     def get_status(self):
         return self.__status
 
-    @TLock
     def is_local(self):
         return self.__is_local
 
+    def get_priority(self):
+        return self.__priority
+
+    def set_priority(self, priority):
+        """Set transfer priority class (TP_* constant) for data blocks queued after this call"""
+        self.__priority = priority
+
+
+    def set_progress_counters(self, counters):
+        """Account progress of transaction in @counters (TransfersProgress instance).
+        Progress is removed from previous counters (transaction is not accounted if @counters is None)
+        """
+        self.__lock.acquire()
+        try:
+            if self.__progress_counters is not None:
+                contrib = self.__progress_contrib
+                self.__progress_counters.update(self.is_uploading(), -contrib[0], -contrib[1], -contrib[2])
+                self.__progress_contrib = (0, 0, 0)
+            self.__progress_counters = counters
+            self.__update_progress()
+        finally:
+            self.__lock.release()
+
+    def __update_progress(self):
+        """Push progress changes to progress counters. Should be called under transaction lock"""
+        if self.__progress_counters is None:
+            return
+        if self.__status in (self.TS_FINISHED, self.TS_FAILED):
+            contrib = (0, 0, 0)
+        else:
+            contrib = (1, (self.__total_size * self.progress_perc()) / 100., self.__total_size)
+        old_contrib = self.__progress_contrib
+        self.__progress_contrib = contrib
+        self.__progress_counters.update(self.is_uploading(), contrib[0] - old_contrib[0], \
+                contrib[1] - old_contrib[1], contrib[2] - old_contrib[2])
 
-    @TLock
     def total_size(self):
-        t_size = 0
-        for size,_,_,_ in self.__data_blocks_info.values():
-            t_size += size
-        return t_size
+        return self.__total_size
 
-    @TLock
     def progress_perc(self):
         if self.__status == self.TS_FINISHED:
             return 100
 
         start_perc = 0
         max_perc = 100.
+        done_size = self.__done_size
         if self.__transaction_type == self.TT_UPLOAD:
             if self.__status == self.TS_INIT:
                 start_perc = 0
                 max_perc = 40. # user data -> nimbus client cache 
+                done_size = self.__total_size #appended data blocks are saved in cache
             else:
                 start_perc = 40
                 max_perc = 50. # nimbus client cache -> nimbus backend node
 
-        p_size = 0
-        t_size = 0
-        for _,data_block,_,finished in self.__data_blocks_info.values():
-            if finished is None: #no data block transfer
-                seek = exp_s = data_block.get_actual_size()
-            else:
-                seek, exp_s = data_block.get_progress()
-            p_size += seek
-            t_size += exp_s
-
+        t_size = self.__total_size
         if t_size == 0:
             return start_perc
-        return start_perc + ((p_size * max_perc) / t_size)
+        return start_perc + ((done_size * max_perc) / t_size)
 
-    @TLock
     def progress_size(self):
-        p_size = 0
-        for _,data_block,_,finished in self.__data_blocks_info.values():
-            if finished is None: #already finished
-                seek = data_block.get_actual_size()
-            else:
-                seek, exp_s = data_block.get_progress()
-            p_size += seek
-        return p_size
+        return self.__done_size
 
-    @TLock
     def append_data_block(self, seek, size, data_block, foreign_name=None, no_transfer=False):
         if size == 0:
             raise RuntimeError('Data block with size=0 is not supported!')
@@ -160,57 +207,151 @@ class Transaction:
         else:
             finished = False
 
-        self.__data_blocks_info[seek] = [size, data_block, foreign_name, finished]
+        self.__lock.acquire()
+        try:
+            old_dbi = self.__data_blocks_info.get(seek, None)
+            if old_dbi:
+                self.__account_data_block(old_dbi, -1)
+                self.__done_size -= self.__in_flight.pop(seek, 0)
+            dbi = self.__data_blocks_info[seek] = [size, data_block, foreign_name, finished]
+            self.__account_data_block(dbi, 1)
+            self.__update_progress()
+        finally:
+            self.__lock.release()
+
+    def __account_data_block(self, dbi, sign):
+        self.__total_size += sign * dbi[0]
+        if dbi[3] != False:
+            self.__done_size += sign * dbi[0]
 
-    @TLock
     def finish_data_block_transfer(self, seek, foreign_name=None):
-        if not self.__data_blocks_info.has_key(seek):
-            raise Exception('No data block with seek %s found in transaction %s'%(seek, self.__transaction_id))
+        self.__lock.acquire()
+        try:
+            if not self.__data_blocks_info.has_key(seek):
+                raise Exception('No data block with seek %s found in transaction %s'%(seek, self.__transaction_id))
+
+            dbi = self.__data_blocks_info[seek]
+            if foreign_name:
+                dbi[2] = foreign_name
+            if dbi[3] == False:
+                self.__done_size += dbi[0] - self.__in_flight.pop(seek, 0)
+            dbi[3] = True
+            self.__ranges.pop(seek, None)
+            self.__update_progress()
+        finally:
+            self.__lock.release()
+
+    def add_transferred(self, seek, size):
+        """Account @size bytes of data block transferred by worker (called for every chunk)"""
+        self.__lock.acquire()
+        try:
+            self.__set_transferred(seek, self.__in_flight.get(seek, 0) + size)
+        finally:
+            self.__lock.release()
+
+    def set_transferred(self, seek, size):
+        """Set transferred size of data block (transfer is started or continued from @size)"""
+        self.__lock.acquire()
+        try:
+            self.__set_transferred(seek, size)
+        finally:
+            self.__lock.release()
+
+    def __set_transferred(self, seek, size):
+        dbi = self.__data_blocks_info.get(seek, None)
+        if dbi is None or dbi[3] != False:
+            return
+        #transferred size of encrypted data block can be larger than data size
+        size = min(size, dbi[0])
+        self.__done_size += size - self.__in_flight.get(seek, 0)
+        self.__in_flight[seek] = size
+        self.__update_progress()
+
+    def set_transfer_range(self, seek, offset, key=None, node_addr=None):
+        """Save transferred @offset of data block (range is removed if offset is 0 and no key is specified)"""
+        self.__lock.acquire()
+        try:
+            if offset or key:
+                self.__ranges[seek] = (offset, key, node_addr)
+            else:
+                self.__ranges.pop(seek, None)
+            self.__set_transferred(seek, offset)
+        finally:
+            self.__lock.release()
+
+    def get_transfer_range(self, seek):
+        """Return (offset, key, node_addr) of interrupted data block transfer or None"""
+        return self.__ranges.get(seek, None)
+
+    def iter_transfer_ranges(self):
+        self.__lock.acquire()
+        try:
+            ranges = [(seek,) + range_info for seek, range_info in self.__ranges.items()]
+        finally:
+            self.__lock.release()
+        return iter(sorted(ranges))
 
-        if foreign_name:
-            self.__data_blocks_info[seek][2] = foreign_name
-        self.__data_blocks_info[seek][3] = True
-    
-    @TLock
     def change_status(self, new_status):
-        self.__status = new_status
+        self.__lock.acquire()
+        try:
+            self.__status = new_status
+            self.__update_progress()
+        finally:
+            self.__lock.release()
 
-    @TLock
     def finished(self):
-        if self.__status == Transaction.TS_FINISHED:
-            True
-        if self.__status == Transaction.TS_FAILED or \
-                (self.__status == Transaction.TS_INIT and self.__transaction_type == self.TT_UPLOAD):
-            return False
-
-        for _,_,_, is_finished in self.__data_blocks_info.values():
-            if is_finished == False:
+        self.__lock.acquire()
+        try:
+            if self.__status == Transaction.TS_FINISHED:
+                True
+            if self.__status == Transaction.TS_FAILED or \
+                    (self.__status == Transaction.TS_INIT and self.__transaction_type == self.TT_UPLOAD):
                 return False
-        return True
+
+            for _,_,_, is_finished in self.__data_blocks_info.values():
+                if is_finished == False:
+                    return False
+            return True
+        finally:
+            self.__lock.release()
 
     def iter_data_blocks(self):
-        TLock.lock()
+        self.__lock.acquire()
         try:
-            sorted_seeks = sorted(self.__data_blocks_info.keys())
-            for seek in sorted_seeks:
-                dbi = self.__data_blocks_info[seek]
-                yield seek, dbi[0], dbi[1], dbi[2]
+            data_blocks = [(seek, dbi[0], dbi[1], dbi[2]) for seek, dbi in self.__data_blocks_info.items()]
+        finally:
+            self.__lock.release()
+
+        for item in sorted(data_blocks):
+            yield item
+
+    def get_data_block_size(self, seek):
+        self.__lock.acquire()
+        try:
+            dbi = self.__data_blocks_info.get(seek, None)
+            if dbi is None:
+                return 0
+            return dbi[0]
         finally:
-            TLock.unlock()
+            self.__lock.release()
 
-    @TLock
     def get_data_block(self, seek,  noclone=True):
-        sorted_seeks = sorted(self.__data_blocks_info.keys())
-        if seek not in sorted_seeks:
-            return None, None, None
+        self.__lock.acquire()
+        try:
+            sorted_seeks = sorted(self.__data_blocks_info.keys())
+            if seek not in sorted_seeks:
+                return None, None, None
+
+            next_seek_idx = sorted_seeks.index(seek) + 1 
+            if len(sorted_seeks) <= next_seek_idx:
+                next_seek = None
+            else:
+                next_seek = sorted_seeks[next_seek_idx]
+            data_block = self.__data_blocks_info[seek][1]
+            foreign_name = self.__data_blocks_info[seek][2]
+        finally:
+            self.__lock.release()
 
-        next_seek_idx = sorted_seeks.index(seek) + 1 
-        if len(sorted_seeks) <= next_seek_idx:
-            next_seek = None
-        else:
-            next_seek = sorted_seeks[next_seek_idx]
-        data_block = self.__data_blocks_info[seek][1]
-        foreign_name = self.__data_blocks_info[seek][2]
         if noclone is False:
             data_block = data_block.clone()
         return data_block, next_seek, foreign_name
@@ -218,26 +359,38 @@ class Transaction:
 
 
 class TransactionsManager:
-    def __init__(self, metadata, db_cache, transactions_window_len=10, user_id='share'):
+    """Transactions registry, metadata updates and transactions log are guarded by separate locks.
+    Data blocks transfers are accounted by transactions locks only
+    """
+    def __init__(self, metadata, db_cache, transactions_window_len=10, user_id='share', \
+            log_durability=TR_LOG_DURABILITY_OS):
         self.__metadata = metadata
         self.__db_cache = db_cache
-        self.__put_queue = Queue()
-        self.__get_queue = Queue()
+        self.__put_queue = TransfersQueue()
+        self.__get_queue = TransfersQueue()
         self.__delete_queue = Queue()
         self.__trlog_path = db_cache.get_static_cache_path('transactions-%s.log'%user_id)
-        self.__transactions = {}
-        self.__tr_log = open(self.__trlog_path, 'a+')
+        self.__transactions = OrderedDict()
+        self.__progress = TransfersProgress()
+        self.__inprogress_files = {} #file path -> upload transaction saved locally
+        self.__inprogress_dirs = {} #directory path -> {file name: upload transaction saved locally}
+        self.__partial_downloads = {} #data block name -> received offset (restored from log)
+        self.__tr_log = TransactionsLog(self.__trlog_path, log_durability, compact_func=self.__normalize_tr_log)
         self.__tr_log_items_count = 0
         self.__tr_window_len = transactions_window_len
+        self.__lock = threading.RLock()
 
         self.__restore_from_log()
 
     def close(self):
-        if not self.__tr_log.closed:
+        if not self.__tr_log.is_closed():
             self.__tr_log.close()
-            self.__transactions = {}
-            self.__put_queue = Queue()
-            self.__get_queue = Queue()
+            self.__transactions = OrderedDict()
+            self.__progress = TransfersProgress()
+            self.__inprogress_files = {}
+            self.__inprogress_dirs = {}
+            self.__put_queue = TransfersQueue()
+            self.__get_queue = TransfersQueue()
 
     def get_upload_queue(self):
         return self.__put_queue
@@ -258,17 +411,16 @@ class TransactionsManager:
         return data_block
 
     def iterate_transactions(self):
-        GTLock.lock()
+        #transactions are registered in order of start
+        self.__lock.acquire()
         try:
-            tr_list = sorted(self.__transactions.values(), \
-                    cmp=lambda x,y: \
-                    cmp(x.get_start_datetime(), y.get_start_datetime())) 
-
-            for transaction in tr_list:
-                yield transaction.is_uploading(), transaction.get_file_path(), \
-                        transaction.get_status(), transaction.total_size(), transaction.progress_perc()
+            tr_list = self.__transactions.values()
         finally:
-            GTLock.unlock()
+            self.__lock.release()
+
+        for transaction in tr_list:
+            yield transaction.is_uploading(), transaction.get_file_path(), \
+                    transaction.get_status(), transaction.total_size(), transaction.progress_perc()
 
     def __find_file(self, file_path):
         try:
@@ -298,53 +450,97 @@ class TransactionsManager:
             chunk = ChunkMD(size=size, seek=seek, key=d_key, checksum=data_block.checksum())
             file_md.append_chunk(chunk)
 
-    def __find_inprogress_file(self, file_path):
-        for transaction in self.__transactions.values():
-            if (not transaction.is_uploading()) or (transaction.get_file_path() != file_path) \
-                    or (transaction.get_status() != Transaction.TS_LOCAL_SAVED):
-                continue
+    def __find_inprogress_file(self, file_path, with_chunks=True):
+        transaction = self.__inprogress_files.get(file_path, None)
+        if transaction is None:
+            return None, None
 
-            file_md = FileMD(name=os.path.basename(file_path), \
-                    replica_count=transaction.get_replica_count(), size=transaction.total_size())
+        file_md = FileMD(name=os.path.basename(file_path), \
+                replica_count=transaction.get_replica_count(), size=transaction.total_size())
 
+        if with_chunks:
             self.__construct_file_md(transaction, file_md)
 
-            return file_md, transaction.get_id()
-        return None, None
+        return file_md, transaction.get_id()
 
     def __remove_from_inprogress(self, file_path):
-        rem_tr_id = None
-        for tr_id, transaction in self.__transactions.items():
-            if transaction.is_uploading() and (transaction.get_file_path() == file_path):
-                rem_tr_id = tr_id
-                break
+        transaction = self.__inprogress_files.get(file_path, None)
+        if transaction is not None:
+            self.update_transaction_state(transaction.get_id(), Transaction.TS_FAILED)
+
+    def __add_transaction(self, transaction):
+        old_transaction = self.__transactions.get(transaction.get_id(), None)
+        if old_transaction is not None and old_transaction is not transaction:
+            #replaced transaction is not updated anymore, so its progress is removed
+            old_transaction.set_progress_counters(None)
+        self.__transactions[transaction.get_id()] = transaction
+        transaction.set_progress_counters(self.__progress)
+        self.__update_inprogress_index(transaction)
+
+    def __update_inprogress_index(self, transaction):
+        """Index upload transaction by file path and by parent directory while it is saved locally only"""
+        if not transaction.is_uploading():
+            return
 
-        if rem_tr_id is not None:
-            self.update_transaction_state(rem_tr_id, Transaction.TS_FAILED)
+        file_path = transaction.get_file_path()
+        base_path, file_name = os.path.split(file_path)
+        if transaction.get_status() == Transaction.TS_LOCAL_SAVED:
+            self.__inprogress_files[file_path] = transaction
+            self.__inprogress_dirs.setdefault(base_path, {})[file_name] = transaction
+        elif self.__inprogress_files.get(file_path, None) is transaction:
+            del self.__inprogress_files[file_path]
+            dir_files = self.__inprogress_dirs[base_path]
+            del dir_files[file_name]
+            if not dir_files:
+                del self.__inprogress_dirs[base_path]
+
+    def get_transfers_progress(self, is_upload):
+        """Return (active transactions count, transferred bytes, total bytes) of uploads or downloads"""
+        return self.__progress.get(is_upload)
 
-    @GTLock
     def find_inprogress_file(self, file_path):
-        return self.__find_inprogress_file(file_path)[0]
+        return self.__find_inprogress_file(file_path, with_chunks=False)[0]
+
+    def listdir_inprogress(self, dir_path):
+        """Return files (FileMD objects without chunks) in @dir_path that are saved locally but not uploaded yet"""
+        ret_list = []
+        for file_name, transaction in self.__inprogress_dirs.get(dir_path, {}).items():
+            ret_list.append(FileMD(name=file_name, replica_count=transaction.get_replica_count(), \
+                    size=transaction.total_size()))
+        return ret_list
+
+    def start_download_transaction(self, file_path, priority=TP_INTERACTIVE_READ):
+        self.__lock.acquire()
+        try:
+            return self.__start_download_transaction(file_path, priority)
+        finally:
+            self.__lock.release()
 
-    @GTLock
-    def start_download_transaction(self, file_path):
+    def __start_download_transaction(self, file_path, priority):
         file_md, item_id = self.__find_file_from_inprogress(file_path)
 
         if (not file_md) or (not file_md.is_file()):
             raise PathException('No file found at %s'%file_path)
 
         transaction_id = item_id
-        transaction = Transaction(Transaction.TT_DOWNLOAD, file_path, file_md.replica_count, transaction_id)
+        transaction = Transaction(Transaction.TT_DOWNLOAD, file_path, file_md.replica_count, \
+                transaction_id, priority=priority)
         stored_transaction = False
         try:
             for chunk in file_md.chunks:
                 db_path = self.__db_cache.get_cache_path('%s.%s'%(item_id, chunk.seek))
                 if os.path.exists(db_path):
                     data_block = self.new_data_block(item_id, chunk.seek, chunk.size)
+                    offset = self.__partial_downloads.pop(data_block.get_name(), 0)
                     if data_block.full():
                         transaction.append_data_block(chunk.seek, \
                                 chunk.size, data_block, chunk.key, no_transfer=True)
                         continue
+                    elif offset and (not file_md.is_local) and data_block.get_actual_size() >= offset:
+                        logger.info('Continue download of data block %s from offset %s'%(data_block.get_name(), offset))
+                        data_block.truncate_raw(offset)
+                        data_block.close()
+                        transaction.set_transfer_range(chunk.seek, offset)
                     else:
                         logger.error('Removing corrupted data block: %s'% data_block.get_name())
                         data_block.remove()
@@ -354,10 +550,13 @@ class TransactionsManager:
                         (file_md.name, item_id, chunk.seek))
 
                 if not stored_transaction:
-                    self.__transactions[transaction_id] = transaction
+                    self.__add_transaction(transaction)
                     self.__tr_log_start_transaction(transaction)
                     stored_transaction = True
 
+                range_info = transaction.get_transfer_range(chunk.seek)
+                if range_info:
+                    self.__tr_log.update_range(transaction_id, chunk.seek, *range_info)
                 data_block = self.new_data_block(item_id, chunk.seek, chunk.size)
                 self.transfer_data_block(transaction_id, chunk.seek, chunk.size, data_block, chunk.key)
         except Exception, err:
@@ -386,22 +585,40 @@ class TransactionsManager:
                 transaction_id=item_id, is_local=is_local)
         return transaction
 
-    @GTLock
     def start_upload_transaction(self, file_path, is_local=False):
+        self.__lock.acquire()
+        try:
+            return self.__start_upload_transaction(file_path, is_local)
+        finally:
+            self.__lock.release()
+
+    def __start_upload_transaction(self, file_path, is_local=False):
         transaction = self.__create_upload_transaction(file_path, is_local)
         transaction_id = transaction.get_id()
-        self.__transactions[transaction_id] = transaction
+        self.__add_transaction(transaction)
         self.__tr_log_start_transaction(transaction)
 
         return transaction_id
 
-    @GTLock
     def save_empty_file(self, file_path):
+        self.__lock.acquire()
+        try:
+            return self.__save_empty_file(file_path)
+        finally:
+            self.__lock.release()
+
+    def __save_empty_file(self, file_path):
         transaction = self.__create_upload_transaction(file_path)
         self.__save_metadata(transaction)
 
-    @GTLock
     def remove_file(self, file_path):
+        self.__lock.acquire()
+        try:
+            return self.__remove_file(file_path)
+        finally:
+            self.__lock.release()
+
+    def __remove_file(self, file_path):
         file_md, item_id = self.__find_inprogress_file(file_path)
         if file_md:
             self.__remove_from_inprogress(file_path)
@@ -422,8 +639,14 @@ class TransactionsManager:
         except PathException:
             return
 
-    @GTLock
     def update_transaction_state(self, transaction_id, status):
+        self.__lock.acquire()
+        try:
+            return self.__update_transaction_state(transaction_id, status)
+        finally:
+            self.__lock.release()
+
+    def __update_transaction_state(self, transaction_id, status):
         transaction = self.__get_transaction(transaction_id)
         if transaction.get_transaction_type() == Transaction.TT_UPLOAD:
             if status == Transaction.TS_FINISHED:
@@ -448,19 +671,24 @@ class TransactionsManager:
                     logger.warning("Can't cancel item_id=%s reserve"%transaction_id)
                     logger.traceback_info()            
 
-        if transaction.get_status() != status: 
+        if transaction.get_status() != status:
             transaction.change_status(status)
+            self.__update_inprogress_index(transaction)
             self.__tr_log_update_state(transaction.get_id(), status)
 
+        if status == Transaction.TS_LOCAL_SAVED and transaction.finished():
+            #all data blocks are transfered before file is closed
+            self.update_transaction_state(transaction_id, Transaction.TS_FINISHED)
+
 
     def update_transaction(self, transaction_id, seek, is_failed=False, foreign_name=None):
         transaction = self.__get_transaction(transaction_id)
+        range_info = transaction.get_transfer_range(seek)
+        if is_failed and range_info and transaction.is_downloading():
+            #partially downloaded data block is continued on next file open
+            self.__partial_downloads['%s.%s'%(transaction_id, seek)] = range_info[0]
         transaction.finish_data_block_transfer(seek, foreign_name)
-        GTLock.lock()
-        try:
-            self.__tr_log_update(transaction_id, seek, None, None, foreign_name)
-        finally:
-            GTLock.unlock()
+        self.__tr_log_update(transaction_id, seek, None, None, foreign_name)
 
         if is_failed:
             self.update_transaction_state(transaction_id, Transaction.TS_FAILED)
@@ -471,7 +699,14 @@ class TransactionsManager:
         if transaction.finished():
             self.update_transaction_state(transaction_id, Transaction.TS_FINISHED)
 
-    @GTLock
+    def update_transfer_range(self, transaction_id, seek, offset, key=None, node_addr=None):
+        """Save transferred offset of data block (called by workers for every range acknowledged by backend),
+        so interrupted transfer is continued from this offset
+        """
+        transaction = self.__get_transaction(transaction_id)
+        transaction.set_transfer_range(seek, offset, key, node_addr)
+        self.__tr_log.update_range(transaction_id, seek, offset, key, node_addr)
+
     def transfer_data_block(self, transaction_id, seek, size, data_block, foreign_name=None):
         logger.debug('data block %s (seek=%s, size=%s) is ready for transfer'%(data_block.get_name(), seek, size))
         transaction = self.__get_transaction(transaction_id)
@@ -487,7 +722,6 @@ class TransactionsManager:
             self.__get_queue.put((transaction, seek))
 
 
-    @GTLock
     def __get_transaction(self, transaction_id):
         tr = self.__transactions.get(transaction_id, None)
         if tr is None:
@@ -524,12 +758,8 @@ class TransactionsManager:
             self.__metadata.append(save_path, file_md, transaction.get_id())
 
     def __remove_oldest_stransaction(self):
-        oldest_tr_list = sorted(self.__transactions.values(), \
-                cmp=lambda x,y: \
-                cmp(x.get_start_datetime(), y.get_start_datetime())) 
-
         tr_for_del = None
-        for oldest_tr in oldest_tr_list:
+        for oldest_tr in self.__transactions.values():
             if oldest_tr.get_status() not in (Transaction.TS_FAILED, Transaction.TS_FINISHED):
                 continue
             tr_for_del = oldest_tr.get_id()
@@ -546,26 +776,33 @@ class TransactionsManager:
             if not self.__remove_oldest_stransaction():
                 break
 
-        self.__tr_log.write('%s ST %s %s %s\n'%(transaction.get_id(), transaction.get_transaction_type(),\
-                    base64.b64encode(transaction.get_file_path()), transaction.get_replica_count()))
-        self.__tr_log.flush()
+        self.__tr_log.start_transaction(transaction.get_id(), transaction.get_transaction_type(),\
+                    transaction.get_file_path(), transaction.get_replica_count())
         self.__tr_log_items_count += 1
         if (self.__tr_log_items_count >= MAX_TR_LOG_ITEMS) \
                 and (len(self.__transactions) <= self.__tr_window_len):
             self.__tr_log_items_count = 0
-            self.__normalize_tr_log()
+            self.__tr_log.request_compaction()
 
     def __tr_log_update_state(self, transaction_id, status):
-        self.__tr_log.write('%s US %s\n'%(transaction_id, status))
-        self.__tr_log.flush()
+        self.__tr_log.update_state(transaction_id, status)
 
     def __tr_log_update(self, transaction_id, seek, size, local_name, foreign_name):
-        self.__tr_log.write('%s UT %s %s %s %s\n'%(transaction_id, seek, size, local_name, foreign_name))
-        self.__tr_log.flush()
+        self.__tr_log.update_transfer(transaction_id, seek, size, local_name, foreign_name)
+
+    def __drop_finished_ranges(self, transaction, progress_info):
+        """Remove transfer ranges of data blocks that are uploaded already (or of finished transaction)"""
+        for seek, offset, key, node_addr in transaction.iter_transfer_ranges():
+            foreign_name = progress_info.get(seek, (None, None, None))[2]
+            if transaction.get_status() == Transaction.TS_FINISHED or \
+                    (transaction.is_uploading() and foreign_name and foreign_name != 'None'):
+                transaction.set_transfer_range(seek, 0)
 
     def __resume_transaction(self, transaction, progress_info):
         file_path = transaction.get_file_path()
         transaction_id = transaction.get_id()
+        #nobody waits for restored transactions
+        transaction.set_priority(TP_BACKGROUND_SYNC)
         if transaction.is_downloading():
             file_md = self.__find_file(file_path)
             if (not file_md) or (not file_md.is_file()):
@@ -591,40 +828,22 @@ class TransactionsManager:
                     self.transfer_data_block(transaction_id, seek, size, \
                             self.new_data_block(transaction_id, seek, size))
 
-    def __parse_tr_log(self):
-        def parse_int(val):
-            if val in [None, 'None']:
-                return None
-            return int(val)
-
-        def parse_str(val):
-            if val in [None, 'None']:
-                return None
-            return val
-
-        transactions = {}
-        tr_log = open(self.__trlog_path, 'r')
-        for line in tr_log.readlines():
-            if not line:
-                break
-
-            logger.debug('processing "%s"'%line.strip())
-            parts = line.split()
-            transaction_id = int(parts[0])
-            r_type = parts[1]
-            if r_type == 'ST':
-                transaction = Transaction(int(parts[2]), base64.b64decode(parts[3]), int(parts[4]), transaction_id)
+    def __parse_tr_log(self, records):
+        transactions = OrderedDict()
+        for record in records:
+            logger.debug('processing %s'%(record,))
+            r_type, transaction_id = record[:2]
+            if r_type == RT_START:
+                transaction_type, file_path, replica_count = record[2:]
+                transaction = Transaction(transaction_type, file_path, replica_count, transaction_id)
                 transactions[transaction_id] = [transaction, {}] 
-            elif r_type == 'US':
-                transactions[transaction_id][0].change_status(int(parts[2]))
-            elif r_type == 'UT':
-                seek = int(parts[2])
-                size = parse_int(parts[3])
-                local_name = parse_str(parts[4])
-                try:
-                    foreign_name = parse_str(parts[5])
-                except IndexError:
-                    foreign_name = None
+            elif transaction_id not in transactions:
+                #transaction is removed from log by compaction
+                logger.debug('skipping record of unknown transaction %s'%transaction_id)
+            elif r_type == RT_STATUS:
+                transactions[transaction_id][0].change_status(record[2])
+            elif r_type == RT_TRANSFER:
+                seek, size, local_name, foreign_name = record[2:]
                 cur_vals = transactions[transaction_id][1].get(seek, [None, None, None])
                 if size:
                     cur_vals[0] = size
@@ -633,15 +852,19 @@ class TransactionsManager:
                 if foreign_name:
                     cur_vals[2] = foreign_name
                 transactions[transaction_id][1][seek] = cur_vals
+            elif r_type == RT_RANGE:
+                seek, offset, key, node_addr = record[2:]
+                transactions[transaction_id][0].set_transfer_range(seek, offset, key, node_addr)
 
-        tr_log.close()
-        return sorted(transactions.values(), cmp=lambda x,y: cmp(x[0].get_start_datetime(), y[0].get_start_datetime())) 
+        return transactions.values()
 
-    def __normalize_tr_log(self):
-        transactions = self.__parse_tr_log() 
+    def __normalize_tr_log(self, records):
+        """Return records of transactions log without oldest finished transactions.
+        Called by transactions log compaction thread
+        """
+        transactions = self.__parse_tr_log(records)
         rest = len(transactions) - self.__tr_window_len
-        self.close()
-        self.__tr_log = open(self.__trlog_path, 'w')
+        n_records = []
 
         for transaction, progress_info in transactions:
             status = transaction.get_status()
@@ -650,36 +873,53 @@ class TransactionsManager:
                     rest -= 1
                     continue  
 
-            self.__tr_log_start_transaction(transaction)
+            transaction_id = transaction.get_id()
+            n_records.append((RT_START, transaction_id, transaction.get_transaction_type(), \
+                    transaction.get_file_path(), transaction.get_replica_count()))
 
             for seek, (size, local_name, foreign_name) in progress_info.items():
-                self.__tr_log_update(transaction.get_id(), seek, size, local_name, foreign_name)
+                n_records.append((RT_TRANSFER, transaction_id, seek, size, local_name, foreign_name))
 
-            self.__tr_log_update_state(transaction.get_id(), transaction.get_status())
+            self.__drop_finished_ranges(transaction, progress_info)
+            for seek, offset, key, node_addr in transaction.iter_transfer_ranges():
+                n_records.append((RT_RANGE, transaction_id, seek, offset, key, node_addr))
+
+            n_records.append((RT_STATUS, transaction_id, status))
+        return n_records
 
     
     def __restore_from_log(self):
-        transactions = self.__parse_tr_log() 
+        transactions = self.__parse_tr_log(self.__tr_log.iter_records())
         rest = len(transactions) - self.__tr_window_len
-        self.close()
-        self.__tr_log = open(self.__trlog_path, 'w')
+        #legacy text log is converted to binary format here
+        self.__tr_log.truncate()
 
         for transaction, progress_info in transactions:
             status = transaction.get_status()
+            if transaction.is_downloading() and status != transaction.TS_FINISHED:
+                #partially downloaded data blocks are continued on next file open
+                for seek, offset, key, node_addr in transaction.iter_transfer_ranges():
+                    self.__partial_downloads['%s.%s'%(transaction.get_id(), seek)] = offset
+
             if status != transaction.TS_LOCAL_SAVED:
                 if status == transaction.TS_INIT:
                     transaction.change_status(transaction.TS_FAILED)
                     for seek, (size, local_name, foreign_name) in progress_info.items():
                         db_name = '%s.%s'%(transaction.get_id(), seek)
+                        if db_name in self.__partial_downloads:
+                            continue
                         self.__db_cache.remove_data_block(db_name)
 
                 if rest > 0:
                     rest -= 1
                     continue  
 
-            self.__transactions[transaction.get_id()] = transaction
+            self.__add_transaction(transaction)
             self.__tr_log_start_transaction(transaction)
 
+            self.__drop_finished_ranges(transaction, progress_info)
+            for seek, offset, key, node_addr in transaction.iter_transfer_ranges():
+                self.__tr_log.update_range(transaction.get_id(), seek, offset, key, node_addr)
             self.__tr_log_update_state(transaction.get_id(), transaction.get_status())
 
             if status == transaction.TS_LOCAL_SAVED:
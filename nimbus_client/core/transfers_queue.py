@@ -0,0 +1,54 @@
+#!/usr/bin/python
+"""
+Copyright (C) 2013 Konstantin Andrusenko
+    See the documentation for further information on copyrights,
+    or contact the author. All Rights Reserved.
+
+@package nimbus_client.core.transfers_queue
+@author Konstantin Andrusenko
+@date June 26, 2013
+
+This module contains the implementation of TransfersQueue class
+"""
+import time
+import heapq
+import itertools
+from Queue import Queue
+
+from nimbus_client.core.constants import TRANSFER_CLASS_DELAY, TRANSFER_SIZE_RATE
+
+
+class TransfersQueue(Queue):
+    """Priority queue of (transaction, seek) jobs for upload and download workers.
+    Every job gets virtual deadline on put:
+        put time + priority class * @class_delay + min(block size / @size_rate, @class_delay)
+    so jobs are ordered by transaction priority class and by block size inside a class,
+    and a job waiting longer than @class_delay per class is served before newly queued
+    jobs of higher classes (no starvation). Jobs with equal deadlines are FIFO.
+    QUIT jobs (None or (None, None)) are served after all other jobs.
+    """
+    def __init__(self, maxsize=0, class_delay=TRANSFER_CLASS_DELAY, size_rate=TRANSFER_SIZE_RATE):
+        self.__class_delay = class_delay
+        self.__size_rate = float(size_rate)
+        self.__counter = itertools.count()
+        Queue.__init__(self, maxsize)
+
+    def job_deadline(self, job):
+        if job is None or job[0] is None:
+            return float('inf')
+
+        transaction, seek = job
+        size_delay = min(transaction.get_data_block_size(seek) / self.__size_rate, self.__class_delay)
+        return time.time() + transaction.get_priority() * self.__class_delay + size_delay
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (self.job_deadline(item), self.__counter.next(), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
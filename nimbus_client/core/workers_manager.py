@@ -8,23 +8,323 @@ Copyright (C) 2012 Konstantin Andrusenko
 @author Konstantin Andrusenko
 @date October 24, 2012
 
-This module contains the implementation of PutWorker, GetWorker and WorkersManager classes
+This module contains the implementation of PutWorker, GetWorker, WorkersManager
+and AsyncWorkersManager classes
 """
 import time
+import heapq
 import threading
-from Queue import Queue
-
-from nimbus_client.core.constants import FG_ERROR_TIMEOUT
+from Queue import Queue, Empty
+
+from nimbus_client.core.constants import ASYNC_MAX_IN_FLIGHT, DELETE_BATCH_SIZE, DELETE_FLUSH_INTERVAL, \
+            GET_MAX_RETRIES, NODE_MAX_CONCURRENCY
+from nimbus_client.core.fabnet_gateway import AsyncFabnetGateway, complete
+from nimbus_client.core.fri.event_loop import EventLoop
+from nimbus_client.core.nodes_health import backoff_delay
+from nimbus_client.core.exceptions import NodeUnavailableException
 from nimbus_client.core.logger import logger
 from nimbus_client.core.events import events_provider
 
 QUIT_JOB = None
 
+
+def get_jobs_batch(queue, batch_size, flush_interval):
+    """Wait for job and collect jobs received during @flush_interval seconds
+    (up to @batch_size jobs). Returns (jobs, is_quit), QUIT_JOB is not included into jobs
+    """
+    jobs = []
+    job = queue.get()
+    deadline = time.time() + flush_interval
+    while job != QUIT_JOB:
+        jobs.append(job)
+        if len(jobs) >= batch_size:
+            return jobs, False
+
+        remaining = deadline - time.time()
+        try:
+            if remaining > 0:
+                job = queue.get(timeout=remaining)
+            else:
+                job = queue.get_nowait()
+        except Empty:
+            return jobs, False
+    return jobs, True
+
+
+def group_by_replica_count(jobs):
+    """Return {replica_count: [db_key, ...]} for delete jobs"""
+    keys_map = {}
+    for db_key, replica_count in jobs:
+        keys_map.setdefault(replica_count, []).append(db_key)
+    return keys_map
+
+
+def get_job_id(job):
+    transaction, seek = job
+    return transaction.get_id(), seek
+
+
+def get_retry_after(err):
+    if isinstance(err, NodeUnavailableException):
+        return err.retry_after
+    return 0
+
+
+def defer_throttled(bandwidth, retry_scheduler, queue, job):
+    """Defer job if bandwidth limit of its transaction direction and priority class
+    is exhausted now. Returns True if job is deferred.
+    Only start of data block transfer is deferred (see get_chunk_callback for started transfers)
+    """
+    if bandwidth is None:
+        return False
+    transaction, _ = job
+    delay = bandwidth.admit(transaction.is_uploading(), transaction.get_priority())
+    if delay <= 0:
+        return False
+    retry_scheduler.defer(queue, job, delay)
+    return True
+
+
+def get_chunk_callback(bandwidth, transaction, seek, wait_chunks=False):
+    """Return on_chunk callback accounting transaction progress and bandwidth tokens of chunk.
+    If @wait_chunks is True callback returns seconds to wait before chunk transfer (async engine waits it by loop timer).
+    Otherwise started data block is transferred without waits and next data block is deferred
+    by defer_throttled until tokens are returned (worker threads are not blocked by sleeping)
+    """
+    on_bandwidth_chunk = None
+    if bandwidth is not None:
+        on_bandwidth_chunk = bandwidth.chunk_callback(transaction.is_uploading(), transaction.get_priority())
+
+    def on_chunk(size):
+        transaction.add_transferred(seek, size)
+        if not on_bandwidth_chunk:
+            return 0
+        delay = on_bandwidth_chunk(size)
+        if wait_chunks:
+            return delay
+        return 0
+    return on_chunk
+
+
+def get_put_range(transaction, seek):
+    """Return (key, node_addr, offset) of interrupted data block upload or None"""
+    range_info = transaction.get_transfer_range(seek)
+    if not range_info or not range_info[1]:
+        return None
+    offset, key, node_addr = range_info
+    return key, node_addr, offset
+
+
+def get_put_range_callback(transactions_manager, transaction, seek):
+    def on_range(key, node_addr, offset):
+        transactions_manager.update_transfer_range(transaction.get_id(), seek, offset, key, node_addr)
+    return on_range
+
+
+def get_get_range_callback(transactions_manager, transaction, seek):
+    def on_range(offset):
+        transactions_manager.update_transfer_range(transaction.get_id(), seek, offset)
+    return on_range
+
+
+def on_put_error(transactions_manager, transaction, seek, range_info, err):
+    """Interrupted upload is continued on the same node,
+    but if the node is unavailable data block is uploaded from the beginning to other node
+    """
+    if range_info and isinstance(err, NodeUnavailableException):
+        logger.info('Node %s is unavailable, data block will be uploaded to other node'%range_info[1])
+        transactions_manager.update_transfer_range(transaction.get_id(), seek, 0)
+
+
+def put_data_block(worker, queue, job):
+    """Upload data block of job by @worker (PutWorker or AsyncWorkersManager).
+    Coroutine: result of worker gateway put call is yielded
+    (blocking call result is sent back by complete(), gateway coroutine is run by EventLoop)
+    """
+    transaction, seek = job
+    data_block = None
+    try:
+        data_block,_,_ = transaction.get_data_block(seek)
+
+        if not data_block.exists():
+            raise Exception('Data block %s does not found at local cache!'%data_block.get_name())
+
+        range_info = get_put_range(transaction, seek)
+        transaction.set_transferred(seek, range_info[2] if range_info else 0)
+        try:
+            key = yield worker.fabnet_gateway.put(data_block, replica_count=transaction.get_replica_count(), \
+                    allow_rewrite=False, on_chunk=get_chunk_callback(worker.bandwidth, transaction, seek, worker.wait_chunks), \
+                    range_info=range_info, \
+                    on_range=get_put_range_callback(worker.transactions_manager, transaction, seek))
+        except Exception, err:
+            logger.error('Put data block error: %s'%err)
+            on_put_error(worker.transactions_manager, transaction, seek, range_info, err)
+            data_block.reopen()
+            delay = worker.retry_scheduler.retry(queue, job, get_retry_after(err))
+            logger.error('Cant put data block from file %s. Try again after %.2f seconds...'%\
+                    (transaction.get_file_path(), delay))
+            return
+
+        worker.retry_scheduler.done(job)
+        data_block.close()
+        worker.transactions_manager.update_transaction(transaction.get_id(), seek, is_failed=False, foreign_name=key)
+    except Exception, err:
+        events_provider.critical('PutWorker', '%s failed: %s'%(transaction, err))
+        logger.traceback_debug()
+        try:
+            worker.transactions_manager.update_transaction(transaction.get_id(), seek, is_failed=True)
+        except Exception, err:
+            logger.error('[put_data_block] %s'%err)
+            logger.traceback_debug()
+    finally:
+        if data_block:
+            data_block.close()
+
+
+def get_data_block(worker, queue, job):
+    """Download data block of job by @worker (GetWorker or AsyncWorkersManager).
+    Coroutine analog of put_data_block. Retried download is continued from received data
+    """
+    transaction, seek = job
+    data_block = None
+    try:
+        data_block,_,foreign_name = transaction.get_data_block(seek, noclone=False)
+        if not foreign_name:
+            raise Exception('foreign name does not found for seek=%s'%seek)
+
+        if transaction.is_failed():
+            logger.debug('Transaction {%s} is failed! Skipping data block downloading...'%transaction.get_id())
+            data_block.remove()
+            return
+
+        transaction.set_transferred(seek, data_block.get_actual_size())
+        try:
+            yield worker.fabnet_gateway.get(foreign_name, transaction.get_replica_count(), data_block, \
+                    get_chunk_callback(worker.bandwidth, transaction, seek, worker.wait_chunks), \
+                    get_get_range_callback(worker.transactions_manager, transaction, seek))
+        except Exception, err:
+            delay = worker.retry_scheduler.retry(queue, job, get_retry_after(err), GET_MAX_RETRIES)
+            if delay is None:
+                raise err
+            logger.error('Get data block error: %s. Try again after %.2f seconds...'%(err, delay))
+            data_block.close()
+            return
+
+        worker.retry_scheduler.done(job)
+        data_block.close()
+
+        worker.transactions_manager.update_transaction(transaction.get_id(), seek, \
+                    is_failed=False, foreign_name=data_block.get_name())
+    except Exception, err:
+        events_provider.error('GetWorker','%s failed: %s'%(transaction, err))
+        logger.traceback_debug()
+        try:
+            if data_block:
+                is_partial = transaction.get_transfer_range(seek) is not None
+                worker.transactions_manager.update_transaction(transaction.get_id(), seek, \
+                            is_failed=True, foreign_name=data_block.get_name())
+                if not is_partial:
+                    data_block.remove()
+        except Exception, err:
+            logger.error('[get_data_block] %s'%err)
+            logger.traceback_debug()
+
+
+class RetryScheduler(threading.Thread):
+    """Failed jobs are put back to their queues after exponential backoff delay,
+    so workers are not blocked while job is waiting for retry
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.__attempts = {}
+        self.__delayed = []
+        self.__seq = 0
+        self.__cond = threading.Condition()
+        self.__stopped = False
+        self.setName('RetryScheduler')
+        self.setDaemon(True)
+
+    def retry(self, queue, job, retry_after=0, max_retries=None):
+        """Schedule job retry. Returns retry delay in seconds
+        or None if job is failed @max_retries times already
+        """
+        job_id = get_job_id(job)
+        self.__cond.acquire()
+        try:
+            attempt = self.__attempts.get(job_id, 0)
+            if max_retries is not None and attempt >= max_retries:
+                del self.__attempts[job_id]
+                return None
+            self.__attempts[job_id] = attempt + 1
+
+            delay = max(backoff_delay(attempt), retry_after)
+            self.__schedule(queue, job, delay)
+            return delay
+        finally:
+            self.__cond.release()
+
+    def defer(self, queue, job, delay):
+        """Put job back to queue after @delay seconds without retry attempt accounting
+        (used for jobs throttled by bandwidth limiter)
+        """
+        self.__cond.acquire()
+        try:
+            self.__schedule(queue, job, delay)
+        finally:
+            self.__cond.release()
+
+    def __schedule(self, queue, job, delay):
+        self.__seq += 1
+        heapq.heappush(self.__delayed, (time.time() + delay, self.__seq, queue, job))
+        self.__cond.notify()
+
+    def done(self, job):
+        self.__cond.acquire()
+        try:
+            self.__attempts.pop(get_job_id(job), None)
+        finally:
+            self.__cond.release()
+
+    def delayed_count(self):
+        return len(self.__delayed)
+
+    def stop(self):
+        self.__cond.acquire()
+        try:
+            self.__stopped = True
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        self.__cond.acquire()
+        try:
+            while not self.__stopped:
+                if not self.__delayed:
+                    self.__cond.wait()
+                    continue
+
+                wait_time = self.__delayed[0][0] - time.time()
+                if wait_time > 0:
+                    self.__cond.wait(wait_time)
+                    continue
+
+                _, _, queue, job = heapq.heappop(self.__delayed)
+                queue.put(job)
+        finally:
+            self.__cond.release()
+
+
 class PutWorker(threading.Thread):
-    def __init__(self, fabnet_gateway, transactions_manager):
+    def __init__(self, fabnet_gateway, transactions_manager, retry_scheduler, bandwidth=None):
         threading.Thread.__init__(self)
         self.fabnet_gateway = fabnet_gateway
         self.transactions_manager = transactions_manager
+        self.retry_scheduler = retry_scheduler
+        self.bandwidth = bandwidth
+        self.wait_chunks = False
         self.queue = transactions_manager.get_upload_queue()
         self.stop_flag = threading.Event()
 
@@ -35,55 +335,28 @@ class PutWorker(threading.Thread):
     def run(self):
         while True:
             job = self.queue.get()
-            transaction = None
-            data_block = None
-            key = None
             try:
                 if job == QUIT_JOB or self.stop_flag.is_set():
                     break
-                
-                transaction, seek = job
-                data_block,_,_ = transaction.get_data_block(seek)
-
-                if not data_block.exists():
-                    raise Exception('Data block %s does not found at local cache!'%data_block.get_name())
 
-                try:
-                    key = self.fabnet_gateway.put(data_block, replica_count=transaction.get_replica_count(), \
-                            allow_rewrite=False)
-                except Exception, err:
-                    logger.error('Put data block error: %s'%err)
-                    logger.error('Cant put data block from file %s. Wait %s seconds and try again...'%\
-                            (transaction.get_file_path(), FG_ERROR_TIMEOUT))
-                    time.sleep(FG_ERROR_TIMEOUT)
-                    data_block.reopen()
-                    self.queue.put(job)
+                if defer_throttled(self.bandwidth, self.retry_scheduler, self.queue, job):
                     continue
-
-                data_block.close()
-                self.transactions_manager.update_transaction(transaction.get_id(), seek, is_failed=False, foreign_name=key)
+                complete(put_data_block(self, self.queue, job))
             except Exception, err:
-                events_provider.critical('PutWorker', '%s failed: %s'%(transaction, err))
-                logger.traceback_debug()            
-                try:
-                    if transaction:
-                        self.transactions_manager.update_transaction(transaction.get_id(), seek, \
-                                    is_failed=True)
-
-                except Exception, err:
-                    logger.error('[PutWorker.__on_error] %s'%err)
-                    logger.traceback_debug()            
+                logger.error('[PutWorker] %s'%err)
+                logger.traceback_debug()
             finally:
-                if data_block:
-                    data_block.close()
                 self.queue.task_done()
 
 
 class GetWorker(threading.Thread):
-    def __init__(self, fabnet_gateway, transactions_manager):
+    def __init__(self, fabnet_gateway, transactions_manager, retry_scheduler, bandwidth=None):
         threading.Thread.__init__(self)
         self.fabnet_gateway = fabnet_gateway
         self.transactions_manager = transactions_manager
+        self.retry_scheduler = retry_scheduler
+        self.bandwidth = bandwidth
+        self.wait_chunks = False
         self.queue = transactions_manager.get_download_queue()
         self.stop_flag = threading.Event()
 
@@ -93,52 +366,29 @@ class GetWorker(threading.Thread):
 
     def run(self):
         while True:
-            out_streem = data = None
             job = self.queue.get()
-            data_block = None
-            transaction = None
-            seek = None
             try:
                 if job == QUIT_JOB or self.stop_flag.is_set():
                     break
 
-                transaction, seek = job
-
-                data_block,_,foreign_name = transaction.get_data_block(seek, noclone=False)
-                if not foreign_name:
-                    raise Exception('foreign name does not found for seek=%s'%seek)
-
-                if transaction.is_failed():
-                    logger.debug('Transaction {%s} is failed! Skipping data block downloading...'%transaction.get_id())
-                    data_block.remove()
+                if defer_throttled(self.bandwidth, self.retry_scheduler, self.queue, job):
                     continue
-
-                self.fabnet_gateway.get(foreign_name, transaction.get_replica_count(), data_block)
-                data_block.close()
-
-                self.transactions_manager.update_transaction(transaction.get_id(), seek, \
-                            is_failed=False, foreign_name=data_block.get_name())
+                complete(get_data_block(self, self.queue, job))
             except Exception, err:
-                events_provider.error('GetWorker','%s failed: %s'%(transaction, err))
-                logger.traceback_debug()            
-                try:
-                    if transaction and data_block:
-                        self.transactions_manager.update_transaction(transaction.get_id(), seek, \
-                                    is_failed=True, foreign_name=data_block.get_name())
-
-                        data_block.remove()
-                except Exception, err:
-                    logger.error('[GetWorker.__on_error] %s'%err)
-                    logger.traceback_debug()            
+                logger.error('[GetWorker] %s'%err)
+                logger.traceback_debug()
             finally:
                 self.queue.task_done()
 
 
 class DeleteWorker(threading.Thread):
-    def __init__(self, fabnet_gateway, transactions_manager):
+    def __init__(self, fabnet_gateway, transactions_manager, batch_size=DELETE_BATCH_SIZE, \
+            flush_interval=DELETE_FLUSH_INTERVAL):
         threading.Thread.__init__(self)
         self.fabnet_gateway = fabnet_gateway
         self.queue = transactions_manager.get_delete_queue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         self.stop_flag = threading.Event()
 
     def stop(self):
@@ -147,27 +397,30 @@ class DeleteWorker(threading.Thread):
 
     def run(self):
         while True:
-            job = self.queue.get()
+            jobs, is_quit = get_jobs_batch(self.queue, self.batch_size, self.flush_interval)
             try:
-                if job == QUIT_JOB or self.stop_flag.is_set():
+                if self.stop_flag.is_set():
                     break
 
-                db_key, replica_count = job
-
-                self.fabnet_gateway.remove(db_key, replica_count)
+                for replica_count, keys in group_by_replica_count(jobs).items():
+                    self.fabnet_gateway.remove_keys(keys, replica_count)
             except Exception, err:
                 logger.error('DeleteWorker error: %s'%err)
-                logger.traceback_debug()            
+                logger.traceback_debug()
             finally:
-                self.queue.task_done()
+                for i in xrange(len(jobs) + int(is_quit)):
+                    self.queue.task_done()
+
+            if is_quit:
+                break
 
 
 class WorkersManager:
-    def __init__(self, worker_class, fabnet_gateway, transactions_manager, workers_count):
+    def __init__(self, worker_class, fabnet_gateway, transactions_manager, workers_count, **worker_args):
         self.__workers = []
 
         for i in xrange(workers_count):
-            worker = worker_class(fabnet_gateway, transactions_manager)
+            worker = worker_class(fabnet_gateway, transactions_manager, **worker_args)
             worker.setName('%s#%i'%(worker_class.__name__, i))
             self.__workers.append(worker)
 
@@ -183,3 +436,141 @@ class WorkersManager:
             if worker.is_alive():
                 worker.join()
 
+
+class AsyncWorkersManager(threading.Thread):
+    """Processes upload, download and delete queues by coroutines of single EventLoop thread.
+    Jobs are moved from queues to loop by feeder threads (one per queue),
+    at most @max_in_flight jobs are processed concurrently.
+    """
+    def __init__(self, fabnet_hostname, security_manager, transactions_manager, max_in_flight=ASYNC_MAX_IN_FLIGHT, \
+            delete_batch_size=DELETE_BATCH_SIZE, delete_flush_interval=DELETE_FLUSH_INTERVAL, bandwidth=None, \
+            max_node_calls=NODE_MAX_CONCURRENCY):
+        threading.Thread.__init__(self)
+        self.loop = EventLoop()
+        self.fabnet_gateway = AsyncFabnetGateway(self.loop, fabnet_hostname, security_manager, \
+                max_node_calls=max_node_calls)
+        self.transactions_manager = transactions_manager
+        self.retry_scheduler = RetryScheduler()
+        self.bandwidth = bandwidth
+        self.wait_chunks = True
+        self.stop_flag = threading.Event()
+        self.__max_in_flight = max_in_flight
+        self.__delete_batch_size = delete_batch_size
+        self.__delete_flush_interval = delete_flush_interval
+        self.__in_flight = 0
+        self.__slots = threading.Condition()
+
+        self.__feeders = []
+        for queue, feed_func, job_func in ((transactions_manager.get_upload_queue(), self.__feed, self.__put), \
+                                (transactions_manager.get_download_queue(), self.__feed, self.__get), \
+                                (transactions_manager.get_delete_queue(), self.__feed_batches, self.__delete)):
+            feeder = threading.Thread(target=feed_func, args=(queue, job_func))
+            feeder.setName('AsyncFeeder-%s'%job_func.__name__.strip('_'))
+            self.__feeders.append((feeder, queue))
+        self.setName('AsyncWorkersManager')
+
+    def start(self):
+        threading.Thread.start(self)
+        self.retry_scheduler.start()
+        for feeder, _ in self.__feeders:
+            feeder.start()
+
+    def stop(self):
+        self.stop_flag.set()
+        self.retry_scheduler.stop()
+        self.__slots.acquire()
+        self.__slots.notify_all()
+        self.__slots.release()
+
+        for feeder, queue in self.__feeders:
+            queue.put(QUIT_JOB)
+        for feeder, _ in self.__feeders:
+            if feeder.is_alive():
+                feeder.join()
+
+        self.loop.stop()
+        if self.is_alive():
+            self.join()
+        self.fabnet_gateway.close()
+
+    def in_flight_count(self):
+        return self.__in_flight
+
+    def run(self):
+        """Loop is restarted if some callback failed (otherwise feeders pass jobs to stopped loop)"""
+        try:
+            while not self.stop_flag.is_set():
+                try:
+                    self.loop.run_forever()
+                    break
+                except Exception, err:
+                    logger.error('[AsyncWorkersManager] event loop error: %s'%err)
+                    logger.traceback_debug()
+        finally:
+            self.loop.close()
+
+    def __acquire_slot(self):
+        self.__slots.acquire()
+        try:
+            while self.__in_flight >= self.__max_in_flight and not self.stop_flag.is_set():
+                self.__slots.wait()
+            self.__in_flight += 1
+        finally:
+            self.__slots.release()
+
+    def __feed(self, queue, job_func):
+        while True:
+            job = queue.get()
+            if job == QUIT_JOB or self.stop_flag.is_set():
+                queue.task_done()
+                break
+
+            if defer_throttled(self.bandwidth, self.retry_scheduler, queue, job):
+                queue.task_done()
+                continue
+
+            self.__acquire_slot()
+            self.loop.call_soon_threadsafe(self.__spawn, queue, job_func, job, 1)
+
+    def __feed_batches(self, queue, job_func):
+        while True:
+            jobs, is_quit = get_jobs_batch(queue, self.__delete_batch_size, self.__delete_flush_interval)
+            if is_quit:
+                queue.task_done()
+            if self.stop_flag.is_set():
+                for job in jobs:
+                    queue.task_done()
+                break
+
+            if jobs:
+                self.__acquire_slot()
+                self.loop.call_soon_threadsafe(self.__spawn, queue, job_func, jobs, len(jobs))
+            if is_quit:
+                break
+
+    def __spawn(self, queue, job_func, job, jobs_count):
+        self.loop.spawn(job_func(queue, job)).add_done_callback(lambda f: self.__job_done(queue, jobs_count))
+
+    def __job_done(self, queue, jobs_count):
+        self.__slots.acquire()
+        try:
+            self.__in_flight -= 1
+            self.__slots.notify()
+        finally:
+            self.__slots.release()
+        for i in xrange(jobs_count):
+            queue.task_done()
+
+    def __put(self, queue, job):
+        return put_data_block(self, queue, job)
+
+    def __get(self, queue, job):
+        return get_data_block(self, queue, job)
+
+    def __delete(self, queue, jobs):
+        try:
+            for replica_count, keys in group_by_replica_count(jobs).items():
+                yield self.fabnet_gateway.remove_keys(keys, replica_count)
+        except Exception, err:
+            logger.error('DeleteWorker error: %s'%err)
+            logger.traceback_debug()
@@ -0,0 +1,163 @@
+import unittest
+import os
+import time
+import random
+import string
+import logging
+import threading
+
+from nimbus_client.core.logger import logger
+logger.setLevel(logging.INFO)
+from nimbus_client.core import constants
+constants.MAX_DATA_BLOCK_SIZE = 100000
+constants.READ_TRY_COUNT = 10
+constants.READ_SLEEP_TIME = 0.2
+constants.FG_ERROR_TIMEOUT = 0.2
+
+from nimbus_client.core.nibbler import Nibbler
+from nimbus_client.core.security_manager import FileBasedSecurityManager
+from nimbus_client.core.fri.fri_base import FabnetPacketRequest, RamBasedBinaryData
+from nimbus_client.core.fri.connections_pool import FriConnectionsPool
+from nimbus_client.core.fri.event_loop import EventLoop, Return
+from nimbus_client.core.fri.async_client import AsyncFriClient
+from util_init_test_env import *
+from util_fri_node import FriNodeStandIn
+
+CLIENT_KS_PATH = './tests/cert/test_cl_1024.ks'
+PASSWD = 'qwerty123'
+
+
+def random_data(size):
+    return ''.join(random.choice(string.letters) for i in xrange(size))
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def test01_event_loop(self):
+        loop = EventLoop()
+        def sub(val):
+            yield loop.sleep(0.01)
+            raise Return(val * 2)
+
+        def failed():
+            yield loop.sleep(0)
+            raise ValueError('test error')
+
+        def main():
+            vals = yield sub(2)
+            try:
+                yield failed()
+            except ValueError, err:
+                vals = (vals, str(err))
+            raise Return(vals)
+
+        thrd = threading.Thread(target=loop.run_forever)
+        thrd.start()
+        try:
+            self.assertEqual(loop.submit(main()).wait(5), (4, 'test error'))
+            t0 = time.time()
+            tasks = [loop.submit(sub(i)) for i in xrange(100)]
+            self.assertEqual([t.wait(5) for t in tasks], [i*2 for i in xrange(100)])
+            self.assertTrue(time.time() - t0 < 1)
+        finally:
+            loop.stop()
+            thrd.join()
+            loop.close()
+
+    def test02_concurrent_calls(self):
+        node = FriNodeStandIn(chunk_size=16*1024)
+        node.start()
+        loop = EventLoop()
+        try:
+            client = AsyncFriClient(loop, connections_pool=FriConnectionsPool())
+            def transfer(i):
+                data = random_data(50*1024)
+                packet = FabnetPacketRequest(method='ClientPutData', parameters={'key': 'key%s'%i}, \
+                        binary_data=RamBasedBinaryData(data, 16*1024))
+                resp = yield client.call_sync(node.address, packet)
+                self.assertEqual(resp.ret_code, 0, resp.ret_message)
+
+                packet = FabnetPacketRequest(method='GetDataBlock', parameters={'key': 'key%s'%i})
+                resp = yield client.call_sync(node.address, packet)
+                self.assertEqual(resp.ret_code, 0, resp.ret_message)
+                chunks = []
+                while True:
+                    chunk = yield resp.binary_data.get_next_chunk()
+                    if chunk is None:
+                        break
+                    chunks.append(chunk.tobytes())
+                raise Return(''.join(chunks) == data)
+
+            def main():
+                tasks = [loop.spawn(transfer(i)) for i in xrange(200)]
+                results = []
+                for task in tasks:
+                    result = yield task
+                    results.append(result)
+                raise Return(results)
+
+            self.assertEqual(loop.run_until_complete(main()), [True]*200)
+            self.assertEqual(len(node.data_map), 200)
+            #all transfers are in flight at the same time
+            self.assertTrue(node.conn_count > 100, node.conn_count)
+
+            resp = loop.run_until_complete(client.call_sync(node.address, \
+                    FabnetPacketRequest(method='GetDataBlock', parameters={'key': 'key0'})))
+            self.assertEqual(resp.ret_code, 0)
+            resp.binary_data.close()
+            resp = loop.run_until_complete(client.call_sync('127.0.0.1:1', \
+                    FabnetPacketRequest(method='GetDataBlock', parameters={'key': 'key0'})))
+            self.assertEqual(resp.ret_code, 1)
+        finally:
+            node.stop()
+            loop.close()
+
+    def test03_nibbler_async_engine(self):
+        node = FriNodeStandIn()
+        node.start()
+        remove_dir(tmp('async_engine_test'))
+        os.makedirs(tmp('async_engine_test'))
+        nibbler = None
+        try:
+            security_manager = FileBasedSecurityManager(CLIENT_KS_PATH, PASSWD)
+            nibbler = Nibbler(node.address, security_manager, cache_dir=tmp('async_engine_test'), \
+                    transfer_engine=constants.TE_ASYNC)
+            nibbler.fabnet_gateway.fri_client.is_ssl = False
+            nibbler.register_user()
+            nibbler.start()
+            nibbler.async_manager.fabnet_gateway.fri_client.is_ssl = False
+            nibbler.async_manager.fabnet_gateway.keys_fri_client.is_ssl = False
+            def failed_callback():
+                raise Exception('callback error')
+            #loop is not stopped by failed callback
+            nibbler.async_manager.loop.call_soon_threadsafe(failed_callback)
+
+            files = {}
+            for i in xrange(20):
+                data = random_data(random.randint(1000, 250000))
+                f_obj = nibbler.open_file('/file%s.dat'%i, for_write=True)
+                f_obj.write(data)
+                f_obj.close()
+                files['/file%s.dat'%i] = data
+
+            for i in xrange(300):
+                if not nibbler.has_incomlete_operations():
+                    break
+                time.sleep(.1)
+            self.assertFalse(nibbler.has_incomlete_operations())
+            self.assertTrue('ClientPutData' in node.calls)
+
+            nibbler.db_cache.clear_all()
+            for path, data in files.items():
+                f_obj = nibbler.open_file(path)
+                self.assertEqual(f_obj.read(), data)
+                f_obj.close()
+            self.assertTrue('GetDataBlock' in node.calls)
+        finally:
+            if nibbler:
+                nibbler.stop()
+            node.stop()
+            remove_dir(tmp('async_engine_test'))
+
+
+if __name__ == '__main__':
+    unittest.main()
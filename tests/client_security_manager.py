@@ -17,7 +17,8 @@ from nimbus_client.core.security_manager import FileBasedSecurityManager
 from nimbus_client.core import constants
 constants.READ_TRY_COUNT = 100
 constants.READ_SLEEP_TIME = 0.2
-from nimbus_client.core.data_block import DataBlock
+from nimbus_client.core import data_block
+from nimbus_client.core.data_block import DataBlock, DBLocksManager
 from util_init_test_env import *
 
 CLIENT_KS_1024_PATH = './tests/cert/test_cl_1024.ks'
@@ -178,6 +179,201 @@ class TestSecManager(unittest.TestCase):
         self.assertEqual(ret_data+'The end!', raw)
         db.close()
 
+    def test_data_block_read_buffers(self):
+        ks = FileBasedSecurityManager(CLIENT_KS_1024_PATH, PASSWD)
+        DataBlock.SECURITY_MANAGER = ks
+        DB_PATH = tmp('test_data_block_buffers.kst')
+        data = ''.join(random.choice(string.letters) for i in xrange(1000)) * 300
+        if os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+        db = DataBlock(DB_PATH, len(data), force_create=True)
+        db.write(data)
+        db.close()
+
+        read_buf_len = DataBlock.READ_BUF_LEN
+        try:
+            for buf_len in (16*1024, 64*1024+16, read_buf_len):
+                DataBlock.READ_BUF_LEN = buf_len
+                db = DataBlock(DB_PATH, len(data))
+                parts = []
+                while True:
+                    part = db.read(10000)
+                    if not part:
+                        break
+                    parts.append(part)
+                db.close()
+                self.assertEqual(''.join(parts), data)
+
+            for buf_len in (70000, 1000, 33):
+                db = DataBlock(DB_PATH, len(data))
+                buf = bytearray(buf_len)
+                view = memoryview(buf)
+                parts = []
+                while True:
+                    read_len = db.readinto(view)
+                    if not read_len:
+                        break
+                    parts.append(str(buf[:read_len]))
+                db.close()
+                self.assertEqual(''.join(parts), data)
+        finally:
+            DataBlock.READ_BUF_LEN = read_buf_len
+            os.remove(DB_PATH)
+
+    def test_data_block_mmap(self):
+        ks = FileBasedSecurityManager(CLIENT_KS_1024_PATH, PASSWD)
+        DataBlock.SECURITY_MANAGER = ks
+        DB_PATH = tmp('test_data_block_mmap.kst')
+        data = ''.join(random.choice(string.letters) for i in xrange(1000)) * 100
+        if os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+        db = DataBlock(DB_PATH, len(data), force_create=True)
+        db.write(data)
+        enc_checksum = db.checksum()
+        db.close()
+
+        try:
+            db = DataBlock(DB_PATH, len(data))
+            chunk = db.read_raw(30000, as_view=True)
+            self.assertTrue(isinstance(chunk, buffer))
+            chunks = [str(chunk)]
+            while True:
+                chunk = db.read_raw(30000, as_view=True)
+                if not chunk:
+                    break
+                chunks.append(str(chunk))
+            db.close()
+            self.assertEqual(db.checksum(), enc_checksum)
+            self.assertEqual(''.join(chunks), open(DB_PATH, 'rb').read())
+
+            db = DataBlock(DB_PATH, len(data))
+            self.assertEqual(db.read(5000), data[:5000])
+            self.assertEqual(db.read(), data[5000:])
+            db.close()
+
+            #not completed data block is read from file
+            db = DataBlock(DB_PATH, len(data)+100)
+            self.assertTrue(isinstance(db.read_raw(100, as_view=True), str))
+            db.close()
+
+            #file is unmapped when data block is closed, so it can be removed while buffer is referenced
+            db = DataBlock(DB_PATH, len(data))
+            chunk = db.read_raw(100, as_view=True)
+            self.assertEqual(str(chunk), open(DB_PATH, 'rb').read(100))
+            db.remove()
+            self.assertFalse(os.path.exists(DB_PATH))
+            self.assertRaises(TypeError, str, chunk)
+        finally:
+            if os.path.exists(DB_PATH):
+                os.remove(DB_PATH)
+
+    def test_data_block_append(self):
+        ks = FileBasedSecurityManager(CLIENT_KS_1024_PATH, PASSWD)
+        DataBlock.SECURITY_MANAGER = ks
+        DB_PATH = tmp('test_data_block_append.kst')
+        if os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+        open(DB_PATH, 'wb').close()
+
+        data = ''
+        header = None
+        for i, part_len in enumerate([1, 15, 16, 17, 31, 13, 32, 33, 1000]):
+            part = ''.join(random.choice(string.letters) for j in xrange(part_len))
+            db = DataBlock(DB_PATH)
+            db.write(part)
+            data += part
+            if i % 2:
+                db.finalize()
+            else:
+                #not padded data is encrypted by next writes
+                db.write('\x00'*(16 - len(data) % 16))
+                data += '\x00'*(16 - len(data) % 16)
+                db.flush()
+                self.assertEqual(db.checksum(), hashlib.sha1(open(DB_PATH, 'rb').read()).hexdigest())
+            db.close()
+
+            #data block is not encrypted again with new key
+            if header is None:
+                header = open(DB_PATH, 'rb').read(130)
+            self.assertEqual(open(DB_PATH, 'rb').read(130), header)
+
+            db = DataBlock(DB_PATH, actsize=True)
+            self.assertEqual(db.read(), data)
+            db.close()
+        os.remove(DB_PATH)
+
+    def test_data_block_wait_written(self):
+        ks = FileBasedSecurityManager(CLIENT_KS_1024_PATH, PASSWD)
+        DataBlock.SECURITY_MANAGER = ks
+        DB_PATH = tmp('test_data_block_wait_written.kst')
+        open(DB_PATH, 'wb').close()
+        data = ''.join(random.choice(string.letters) for i in xrange(10000))
+
+        def read_db(results):
+            db = DataBlock(DB_PATH, len(data))
+            try:
+                results.append(db.read())
+            except Exception, err:
+                results.append(err)
+            results.append(time.time())
+            db.close()
+
+        read_sleep_time = data_block.READ_SLEEP_TIME
+        data_block.READ_SLEEP_TIME = 2
+        try:
+            #reader is woken up by writer instead of sleeping between read tries
+            results = []
+            reader = threading.Thread(target=read_db, args=(results,))
+            db = DataBlock(DB_PATH)
+            db.write(data[:5000])
+            reader.start()
+            time.sleep(0.3)
+            db.write(data[5000:])
+            db.finalize()
+            t0 = time.time()
+            db.close()
+            reader.join()
+            self.assertEqual(results[0], data)
+            self.assertTrue(results[1] - t0 < 1, results[1] - t0)
+
+            #removed data block is not waited
+            open(DB_PATH, 'wb').close()
+            results = []
+            reader = threading.Thread(target=read_db, args=(results,))
+            db = DataBlock(DB_PATH)
+            db.write(data[:5000])
+            reader.start()
+            time.sleep(0.3)
+            t0 = time.time()
+            db.remove()
+            reader.join()
+            self.assertTrue(isinstance(results[0], Exception), results[0])
+            self.assertTrue(results[1] - t0 < 1, results[1] - t0)
+        finally:
+            data_block.READ_SLEEP_TIME = read_sleep_time
+            if os.path.exists(DB_PATH):
+                os.remove(DB_PATH)
+
+    def test_db_locks_manager(self):
+        locks = DBLocksManager(shards_count=4)
+        paths = ['/path/to/db.%s'%i for i in xrange(10)]
+        for path in paths:
+            locks.set(path)
+        locks.set(paths[0])
+        self.assertEqual(sorted(locks.locks()), sorted(paths))
+
+        removed = []
+        self.assertTrue(locks.call_on_unlock(paths[0], removed.append))
+        self.assertFalse(locks.call_on_unlock('/unlocked/db', removed.append))
+        locks.release(paths[0])
+        self.assertTrue(locks.locked(paths[0]))
+        locks.release(paths[0])
+        self.assertFalse(locks.locked(paths[0]))
+        self.assertEqual(removed, [paths[0]])
+        for path in paths[1:]:
+            locks.release(path)
+        self.assertEqual(locks.locks(), [])
+
     def test_parallel_read_write(self):
         ks = FileBasedSecurityManager(CLIENT_KS_1024_PATH, PASSWD)
         DataBlock.SECURITY_MANAGER = ks
@@ -0,0 +1,471 @@
+import unittest
+import time
+import random
+import string
+import hashlib
+import logging
+from Queue import Queue
+
+from nimbus_client.core.logger import logger
+logger.setLevel(logging.INFO)
+
+from nimbus_client.core.fabnet_gateway import FabnetGateway, HedgedRead, ChunkedBinaryData
+from nimbus_client.core.keys_reservation import KeysReservationPool
+from nimbus_client.core.keys_info_cache import KeysInfoCache
+from nimbus_client.core.nodes_health import NodesHealth
+from nimbus_client.core.bandwidth import BandwidthLimiter, parse_schedule, parse_class_shares
+from nimbus_client.core.constants import NODE_BREAKER_ERRORS, TP_INTERACTIVE_WRITE, TP_BACKGROUND_SYNC
+from nimbus_client.core.exceptions import NodeUnavailableException
+from nimbus_client.core.security_manager import FileBasedSecurityManager
+from nimbus_client.core.data_block import DataBlock
+from nimbus_client.core.workers_manager import DeleteWorker, RetryScheduler, defer_throttled, get_chunk_callback
+from util_init_test_env import *
+from util_fri_node import FriNodeStandIn
+
+CLIENT_KS_PATH = './tests/cert/test_cl_1024.ks'
+PASSWD = 'qwerty123'
+
+
+def random_data(size):
+    return ''.join(random.choice(string.letters) for i in xrange(size))
+
+
+class TestFabnetGateway(unittest.TestCase):
+    def util_gateway(self, node, **params):
+        gateway = FabnetGateway(node.address, FileBasedSecurityManager(CLIENT_KS_PATH, PASSWD), **params)
+        gateway.fri_client.is_ssl = False
+        return gateway
+
+    def util_get(self, gateway, key, data):
+        path = tmp('fabnet_gateway_test.db')
+        open(path, 'wb').close()
+        data_block = DataBlock(path)
+        try:
+            t0 = time.time()
+            self.assertEqual(gateway.get(key, 2, data_block), data_block)
+            elapsed = time.time() - t0
+            data_block.close()
+            self.assertEqual(open(path, 'rb').read(), data)
+            return elapsed
+        finally:
+            data_block.remove()
+
+    def util_put_blocks(self, node, count):
+        gateway = self.util_gateway(node)
+        try:
+            for i in xrange(count):
+                data = random_data(1000)
+                key = gateway.put(data)
+                self.assertEqual(node.data_map[key], data)
+        finally:
+            gateway.close()
+        self.assertEqual(len(set(node.data_map.keys())), count)
+
+    def test01_batched_keys_reservation(self):
+        node = FriNodeStandIn()
+        node.start()
+        try:
+            self.util_put_blocks(node, 100)
+            self.assertEqual(node.calls.count('ClientPutData'), 100)
+            #keys are reserved by batches (in background while pool is not empty)
+            self.assertTrue(node.calls.count('PutKeysInfo') <= 6, node.calls.count('PutKeysInfo'))
+        finally:
+            node.stop()
+
+    def test02_legacy_keys_reservation(self):
+        node = FriNodeStandIn(batch_keys=False)
+        node.start()
+        try:
+            self.util_put_blocks(node, 20)
+        finally:
+            node.stop()
+
+    def test03_reserved_keys_expiration(self):
+        fetched = []
+        def fetch(count):
+            keys = [('key%s'%(len(fetched)+i), 'node') for i in xrange(count)]
+            fetched.extend(keys)
+            return keys
+
+        pool = KeysReservationPool(fetch, batch_size=4, ttl=0.2)
+        try:
+            self.assertEqual(pool.get(), ('key0', 'node'))
+            self.assertEqual(pool.get(), ('key1', 'node'))
+            time.sleep(0.3)
+            key, _ = pool.get()
+            self.assertTrue(key not in ('key2', 'key3'), key)
+
+            #keys of unavailable nodes are kept in pool
+            size = pool.size()
+            self.assertEqual(pool.get(accept=lambda node_address: False), None)
+            self.assertEqual(pool.size(), size)
+            self.assertEqual(pool.get(accept=lambda node_address: True)[1], 'node')
+
+            pool.stop()
+            self.assertEqual(pool.size(), 0)
+            self.assertEqual(pool.get(wait=False), None)
+        finally:
+            pool.stop()
+
+    def test04_hedged_reads(self):
+        slow_node = FriNodeStandIn()
+        fast_node = FriNodeStandIn()
+        slow_node.start()
+        fast_node.start()
+        try:
+            data = random_data(10000)
+            slow_node.data_map['key'] = fast_node.data_map['key'] = data
+            slow_node.replicas = [fast_node.address]
+            slow_node.response_delay = 1.5
+
+            gateway = self.util_gateway(slow_node, hedged_reads=False)
+            try:
+                self.util_get(gateway, 'key', data)
+                self.assertEqual(slow_node.calls.count('GetDataBlock'), 1)
+                self.assertEqual(fast_node.calls.count('GetDataBlock'), 0)
+            finally:
+                gateway.close()
+
+            gateway = self.util_gateway(slow_node)
+            try:
+                #primary replica is slow, so other replica is requested after hedge delay
+                self.util_get(gateway, 'key', data)
+                self.assertEqual(slow_node.calls.count('GetDataBlock'), 2)
+                self.assertEqual(fast_node.calls.count('GetDataBlock'), 1)
+                self.assertTrue(gateway.nodes_monitor.get_stats(fast_node.address)[0] is not None)
+
+                #slow node statistic is collected after its response is cancelled
+                for i in xrange(50):
+                    latency, _, _ = gateway.nodes_monitor.get_stats(slow_node.address)
+                    if latency is not None:
+                        break
+                    time.sleep(0.1)
+                self.assertTrue(latency >= 1.5, latency)
+
+                #fast node is requested first now
+                self.util_get(gateway, 'key', data)
+                self.assertEqual(slow_node.calls.count('GetDataBlock'), 2)
+                self.assertEqual(fast_node.calls.count('GetDataBlock'), 2)
+            finally:
+                gateway.close()
+
+            #stuck cancelled request releases slow node call slot after read timeout
+            slow_node.response_delay = 10
+            gateway = self.util_gateway(slow_node, hedged_read_timeout=1)
+            try:
+                self.util_get(gateway, 'key', data)
+                self.assertEqual(gateway.nodes_health.get_state(slow_node.address)[2], 1)
+                for i in xrange(30):
+                    if gateway.nodes_health.get_state(slow_node.address)[2] == 0:
+                        break
+                    time.sleep(0.1)
+                self.assertEqual(gateway.nodes_health.get_state(slow_node.address)[2], 0)
+            finally:
+                gateway.close()
+        finally:
+            slow_node.stop()
+            fast_node.stop()
+
+        #failed request does not block waiting for other requests
+        def failed_fetch():
+            raise Exception('fetch error')
+        fetches = HedgedRead()
+        fetches.start(failed_fetch)
+        result, err = fetches.wait(5)
+        self.assertEqual(result, None)
+        self.assertEqual(str(err), 'fetch error')
+        self.assertEqual(fetches.in_flight(), 0)
+
+    def test05_keys_info_cache(self):
+        node = FriNodeStandIn()
+        other_node = FriNodeStandIn()
+        node.start()
+        other_node.start()
+        gateway = self.util_gateway(node)
+        try:
+            data = random_data(10000)
+            node.data_map['key'] = data
+            self.util_get(gateway, 'key', data)
+            self.util_get(gateway, 'key', data)
+            self.assertEqual(node.calls.count('GetKeysInfo'), 1)
+
+            #data block is moved to other node, so cached location is outdated
+            other_node.data_map['key'] = node.data_map.pop('key')
+            node.replicas = [other_node.address]
+            self.util_get(gateway, 'key', data)
+            self.assertEqual(node.calls.count('GetKeysInfo'), 2)
+            self.util_get(gateway, 'key', data)
+            self.assertEqual(node.calls.count('GetKeysInfo'), 2)
+
+            gateway.remove('key')
+            self.assertEqual(gateway.keys_info_cache.get('key', 2), None)
+        finally:
+            gateway.close()
+            node.stop()
+            other_node.stop()
+
+        cache = KeysInfoCache(max_size=2, ttl=0.2)
+        cache.put('key1', 2, ['info1'])
+        cache.put('key2', 2, ['info2'])
+        self.assertEqual(cache.get('key1', 2), ['info1'])
+        cache.put('key3', 2, ['info3'])
+        self.assertEqual(cache.get('key2', 2), None)
+        self.assertEqual(cache.get('key1', 3), None)
+        self.assertEqual(cache.get('key3', 1), ['info3'])
+        time.sleep(0.3)
+        self.assertEqual(cache.get('key3', 1), None)
+
+    def test06_batched_deletes(self):
+        class DeleteQueueOwner:
+            def __init__(self):
+                self.queue = Queue()
+            def get_delete_queue(self):
+                return self.queue
+
+        for multi_delete in (True, False):
+            node = FriNodeStandIn(multi_delete=multi_delete)
+            node.start()
+            gateway = self.util_gateway(node)
+            try:
+                for i in xrange(10):
+                    node.data_map['key%s'%i] = 'data'
+                self.assertEqual(gateway.remove_keys(['key0', 'key1', 'unknown']), ['unknown'])
+                self.assertEqual(node.calls.count('ClientDeleteData'), 1 if multi_delete else 4)
+
+                owner = DeleteQueueOwner()
+                worker = DeleteWorker(gateway, owner, batch_size=5, flush_interval=0.2)
+                worker.start()
+                try:
+                    calls = node.calls.count('ClientDeleteData')
+                    for i in xrange(2, 10):
+                        owner.queue.put(('key%s'%i, 2))
+                    owner.queue.join()
+                    self.assertEqual(node.data_map, {})
+                    if multi_delete:
+                        self.assertEqual(node.calls.count('ClientDeleteData') - calls, 2)
+                finally:
+                    worker.stop()
+                    worker.join()
+            finally:
+                gateway.close()
+                node.stop()
+
+    def test07_nodes_health(self):
+        health = NodesHealth(max_errors=3, open_time=0.2, max_concurrency=2)
+        for i in xrange(3):
+            health.acquire('node1')
+            health.release('node1', is_failed=True)
+        self.assertFalse(health.is_available('node1'))
+        with self.assertRaises(NodeUnavailableException):
+            health.acquire('node1')
+        self.assertEqual(health.sort_nodes(['node1', 'node2']), ['node2', 'node1'])
+
+        #single probe call after open time, failed probe opens breaker again
+        time.sleep(0.25)
+        health.acquire('node1')
+        self.assertFalse(health.is_available('node1'))
+        health.release('node1', is_failed=True)
+        self.assertTrue(health.get_state('node1')[0])
+        time.sleep(0.45)
+        health.acquire('node1')
+        health.release('node1', is_failed=False)
+        self.assertEqual(health.get_state('node1'), (False, 0, 0))
+
+        health.acquire('node2')
+        health.acquire('node2')
+        self.assertTrue(health.retry_after('node2') > 0)
+        health.release('node2', is_failed=False)
+        self.assertTrue(health.is_available('node2'))
+
+        #parallel calls are not limited by default
+        health = NodesHealth()
+        for i in xrange(64):
+            health.acquire('node1')
+        self.assertTrue(health.is_available('node1'))
+
+    def test08_unavailable_replicas(self):
+        class Transaction:
+            def get_id(self):
+                return 'tr_id'
+
+        node = FriNodeStandIn()
+        node.start()
+        gateway = self.util_gateway(node)
+        try:
+            data = random_data(1000)
+            node.data_map['key'] = data
+            dead_node = '127.0.0.1:1'
+            node.replicas = [dead_node]
+            for i in xrange(NODE_BREAKER_ERRORS):
+                gateway.nodes_health.acquire(dead_node)
+                gateway.nodes_health.release(dead_node, is_failed=True)
+            self.util_get(gateway, 'key', data)
+            self.assertEqual(node.calls.count('GetDataBlock'), 1)
+            #call slot is released after data block is read
+            self.assertEqual(gateway.nodes_health.get_state(node.address), (False, 0, 0))
+
+            node.replicas = []
+            for i in xrange(NODE_BREAKER_ERRORS):
+                gateway.nodes_health.acquire(node.address)
+                gateway.nodes_health.release(node.address, is_failed=True)
+            with self.assertRaises(NodeUnavailableException):
+                self.util_get(gateway, 'key', data)
+            self.assertEqual(node.calls.count('GetDataBlock'), 1)
+        finally:
+            gateway.close()
+            node.stop()
+
+        scheduler = RetryScheduler()
+        scheduler.start()
+        try:
+            queue = Queue()
+            job = (Transaction(), 0)
+            t0 = time.time()
+            self.assertTrue(scheduler.retry(queue, job, retry_after=0.3) >= 0.3)
+            self.assertEqual(queue.get(timeout=1), job)
+            self.assertTrue(time.time() - t0 >= 0.3)
+            self.assertNotEqual(scheduler.retry(queue, job, max_retries=2), None)
+            self.assertEqual(scheduler.retry(queue, job, max_retries=2), None)
+        finally:
+            scheduler.stop()
+
+    def test09_bandwidth_limits(self):
+        class Transaction:
+            def get_id(self):
+                return 'tr_id'
+            def is_uploading(self):
+                return True
+            def get_priority(self):
+                return TP_BACKGROUND_SYNC
+            def add_transferred(self, seek, size):
+                pass
+
+        limiter = BandwidthLimiter(upload_rate=100*1024, class_shares={TP_BACKGROUND_SYNC: 0.5})
+        self.assertEqual(limiter.admit(True, TP_BACKGROUND_SYNC), 0)
+        self.assertTrue(1.9 < limiter.reserve(True, TP_BACKGROUND_SYNC, 100*1024) <= 2)
+        self.assertTrue(0.9 < limiter.admit(True, TP_INTERACTIVE_WRITE) <= 1, limiter.admit(True, TP_INTERACTIVE_WRITE))
+        self.assertTrue(1.9 < limiter.admit(True, TP_BACKGROUND_SYNC) <= 2)
+        self.assertEqual(limiter.admit(False, TP_BACKGROUND_SYNC), 0)
+
+        #throttled job is deferred, so worker is not blocked
+        scheduler = RetryScheduler()
+        scheduler.start()
+        try:
+            queue = Queue()
+            job = (Transaction(), 0)
+            self.assertTrue(defer_throttled(limiter, scheduler, queue, job))
+            self.assertTrue(queue.empty())
+            limiter.set_limits(0, 0)
+            self.assertFalse(defer_throttled(limiter, scheduler, queue, job))
+            self.assertEqual(limiter.get_limits(), (0, 0))
+        finally:
+            scheduler.stop()
+
+        schedule = parse_schedule('00:00-23:59=1/2; 23:59-00:00 = 1/2')
+        self.assertEqual(schedule, [(0, 1439, 1024, 2048), (1439, 0, 1024, 2048)])
+        limiter.set_limits(0, 0, schedule=schedule)
+        self.assertEqual(limiter.get_limits(), (1024, 2048))
+
+        #started transfer waits for tokens before every chunk
+        class Block:
+            def __init__(self, data):
+                self.data = data
+            def read_raw(self, rlen, as_view=False):
+                chunk, self.data = self.data[:rlen], self.data[rlen:]
+                return chunk
+
+        limiter = BandwidthLimiter(upload_rate=1000)
+        bin_data = ChunkedBinaryData(Block('x'*300), 100, limiter.chunk_callback(True, TP_INTERACTIVE_WRITE), \
+                300, blocking_wait=False)
+        delays = []
+        while bin_data.get_next_chunk():
+            delays.append(bin_data.chunk_delay())
+        self.assertEqual(len(delays), 3)
+        self.assertTrue(0.09 < delays[0] <= 0.1, delays)
+        self.assertTrue(0.29 < delays[2] <= 0.3, delays)
+        self.assertEqual(bin_data.chunk_delay(), 0)
+        self.assertTrue(0.2 < limiter.admit(True, TP_INTERACTIVE_WRITE) <= 0.3)
+
+        #worker threads are not blocked in started transfer, next data block is deferred
+        limiter = BandwidthLimiter(upload_rate=1000)
+        self.assertEqual(get_chunk_callback(limiter, Transaction(), 0)(500), 0)
+        #background sync class share is 50%
+        self.assertTrue(0.9 < limiter.admit(True, TP_BACKGROUND_SYNC) <= 1)
+        self.assertTrue(1.9 < get_chunk_callback(limiter, Transaction(), 0, wait_chunks=True)(500) <= 2)
+
+        t0 = time.time()
+        bin_data = ChunkedBinaryData(Block('x'*100), 100, limiter.chunk_callback(True, TP_INTERACTIVE_WRITE), 100)
+        bin_data.get_next_chunk()
+        self.assertTrue(time.time() - t0 >= 0.35)
+        with self.assertRaises(ValueError):
+            parse_schedule('25:00-26:00=1/1')
+        self.assertEqual(parse_class_shares('100,50')[TP_INTERACTIVE_WRITE], 0.5)
+
+    def test10_resumable_transfers(self):
+        range_size = 64*1024
+        DataBlock.SECURITY_MANAGER = FileBasedSecurityManager(CLIENT_KS_PATH, PASSWD)
+        self.addCleanup(setattr, DataBlock, 'SECURITY_MANAGER', None)
+        path = tmp('fabnet_gateway_test_resume.db')
+        data_len = 300*1024
+        open(path, 'wb').close()
+        data_block = DataBlock(path, data_len)
+        data_block.write(random_data(data_len))
+        data_block.close()
+        raw_data = open(path, 'rb').read()
+
+        node = FriNodeStandIn()
+        node.start()
+        gateway = self.util_gateway(node, range_size=range_size)
+        ranges = []
+        on_range = lambda key, node_addr, offset: ranges.append((key, node_addr, offset))
+        try:
+            #connection is dropped after third range is saved by node (response is lost)
+            node.drop_put_range = 2
+            with self.assertRaises(Exception):
+                gateway.put(DataBlock(path, data_len), on_range=on_range)
+            self.assertEqual([r[2] for r in ranges], [range_size, 2*range_size])
+            self.assertEqual(node.data_map, {})
+
+            node.drop_put_range = None
+            key = gateway.put(DataBlock(path, data_len), range_info=ranges[-1], on_range=on_range)
+            self.assertEqual(key, ranges[0][0])
+            self.assertEqual(node.data_map[key], raw_data)
+            self.assertEqual(node.put_offsets, [0, range_size, 2*range_size, 3*range_size, 4*range_size])
+            self.assertEqual(ranges[-1][2], 4*range_size)
+
+            #interrupted download is continued from received data
+            offsets = []
+            node.chunk_size = 32*1024
+            open(path, 'wb').write(raw_data[:2*range_size])
+            data_block = DataBlock(path, data_len)
+            self.assertEqual(gateway.get(key, 2, data_block, on_range=offsets.append), data_block)
+            data_block.close()
+            self.assertEqual(open(path, 'rb').read(), raw_data)
+            self.assertEqual(node.get_offsets, [2*range_size])
+            self.assertEqual(offsets, [3*range_size, 4*range_size])
+        finally:
+            gateway.close()
+            node.stop()
+
+        #legacy node sends whole data block
+        node = FriNodeStandIn(ranges=False)
+        node.start()
+        gateway = self.util_gateway(node, range_size=range_size)
+        try:
+            key = gateway.put(DataBlock(path, data_len))
+            self.assertEqual(node.data_map[key], raw_data)
+            self.assertTrue(node.address in gateway.no_ranges_nodes)
+
+            open(path, 'wb').write(raw_data[:100*1024])
+            data_block = DataBlock(path, data_len)
+            gateway.get(key, 2, data_block)
+            data_block.close()
+            self.assertEqual(open(path, 'rb').read(), raw_data)
+        finally:
+            gateway.close()
+            node.stop()
+            DataBlock(path, data_len).remove()
+
+
+if __name__ == '__main__':
+    unittest.main()
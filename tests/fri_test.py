@@ -0,0 +1,279 @@
+import unittest
+import time
+import threading
+import hashlib
+import random
+import string
+import socket
+from Queue import Queue
+
+from nimbus_client.core.fri.fri_base import FabnetPacketRequest
+from nimbus_client.core.fri.fri_client import FriClient
+from nimbus_client.core.fri.connections_pool import FriConnectionsPool
+from nimbus_client.core.fri.mux_client import FriMuxClient
+from nimbus_client.core.fri.socket_processor import SocketProcessor
+from nimbus_client.core.fri.fri_base import RamBasedBinaryData, CompactHeaderCodec, FriBinaryProcessor
+from util_init_test_env import *
+from util_fri_node import FriNodeStandIn, LatencyProxy
+
+
+def random_data(size):
+    return ''.join(random.choice(string.letters) for i in xrange(size))
+
+
+class RecordingSocket:
+    """Socket wrapper that saves protocol identifiers of sent packets"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.protocols = []
+
+    def sendall(self, data):
+        if str(data[:3]) == 'FRI':
+            self.protocols.append(str(data[:4]))
+        return self.sock.sendall(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+
+class TestFRI(unittest.TestCase):
+    def setUp(self):
+        self.node = FriNodeStandIn(chunk_size=1000)
+        self.node.start()
+
+    def tearDown(self):
+        self.node.stop()
+
+    def put_data(self, fri_client, key, data):
+        packet = FabnetPacketRequest(method='ClientPutData', parameters={'key': key}, \
+                binary_data=data, sync=True)
+        return fri_client.call_sync(self.node.address, packet)
+
+    def get_data(self, fri_client, key):
+        packet = FabnetPacketRequest(method='GetDataBlock', parameters={'key': key}, sync=True)
+        resp = fri_client.call_sync(self.node.address, packet)
+        self.assertEqual(resp.ret_code, 0, resp.ret_message)
+        return resp.binary_data.data()
+
+    def test01_pooled_connections(self):
+        pool = FriConnectionsPool()
+        fri_client = FriClient(connections_pool=pool)
+        for i in xrange(10):
+            packet = FabnetPacketRequest(method='PutKeysInfo', parameters={'key': None}, sync=True)
+            resp = fri_client.call_sync(self.node.address, packet)
+            self.assertEqual(resp.ret_code, 0, resp.ret_message)
+
+        data = random_data(5500)
+        resp = self.put_data(fri_client, 'test_key', data)
+        self.assertEqual(resp.ret_code, 0, resp.ret_message)
+        self.assertEqual(resp.ret_parameters['checksum'], hashlib.sha1(data).hexdigest())
+        self.assertEqual(self.get_data(fri_client, 'test_key'), data)
+        self.assertEqual(self.get_data(fri_client, 'test_key'), data)
+        self.assertEqual(self.node.conn_count, 1)
+        self.assertEqual(pool.idle_count(self.node.address), 1)
+
+        #partially read binary stream should not return connection to pool
+        packet = FabnetPacketRequest(method='GetDataBlock', parameters={'key': 'test_key'}, sync=True)
+        resp = fri_client.call_sync(self.node.address, packet)
+        resp.binary_data.get_next_chunk()
+        resp.binary_data.close()
+        self.assertEqual(pool.idle_count(), 0)
+        self.assertEqual(self.get_data(fri_client, 'test_key'), data)
+        self.assertEqual(self.node.conn_count, 2)
+
+        #closed by node connections should be reopened
+        self.node.drop_connections()
+        time.sleep(0.1)
+        self.assertEqual(self.get_data(fri_client, 'test_key'), data)
+        self.assertEqual(self.node.conn_count, 3)
+
+        #only idempotent request is resent if response is not received over reused connection
+        self.node.drop_calls = 1
+        self.assertEqual(self.get_data(fri_client, 'test_key'), data)
+        self.assertEqual(self.node.calls.count('GetDataBlock'), 7)
+        self.node.drop_calls = 1
+        self.assertNotEqual(self.put_data(fri_client, 'test_key', data).ret_code, 0)
+        self.assertEqual(self.node.calls.count('ClientPutData'), 2)
+
+        pool.close_all()
+        self.assertEqual(pool.idle_count(), 0)
+
+    def test02_parallel_pooled_calls(self):
+        pool = FriConnectionsPool(max_idle=8)
+        fri_client = FriClient(connections_pool=pool)
+        data = random_data(3000)
+        errors = Queue()
+
+        def worker(idx):
+            try:
+                for i in xrange(20):
+                    key = 'key_%s_%s'%(idx, i)
+                    resp = self.put_data(fri_client, key, data)
+                    if resp.ret_code != 0:
+                        raise Exception(resp.ret_message)
+                    if self.get_data(fri_client, key) != data:
+                        raise Exception('invalid data for %s'%key)
+            except Exception, err:
+                errors.put(err)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(errors.empty(), errors.queue)
+        self.assertTrue(self.node.conn_count <= 8, self.node.conn_count)
+        pool.close_all()
+
+    def test03_binary_window(self):
+        data = random_data(20500)
+        host, port = self.node.address.split(':')
+        #new/old client and node combinations
+        for client_window, node_window in ((8, 8), (8, 0), (0, 8), (4, 16), (16, 3)):
+            self.node.binary_window = node_window
+            proc = SocketProcessor(socket.create_connection((host, int(port))), binary_window=client_window)
+            try:
+                key = 'key_%s_%s'%(client_window, node_window)
+                packet = FabnetPacketRequest(method='ClientPutData', parameters={'key': key}, \
+                        binary_data=RamBasedBinaryData(data, 1000), sync=True)
+                resp = proc.send_packet(packet, wait_response=True)
+                self.assertEqual(resp.ret_code, 0, resp.ret_message)
+                self.assertEqual(resp.ret_parameters['checksum'], hashlib.sha1(data).hexdigest())
+
+                packet = FabnetPacketRequest(method='GetDataBlock', parameters={'key': key}, sync=True)
+                resp = proc.send_packet(packet, wait_response=True)
+                self.assertEqual(resp.ret_code, 0, resp.ret_message)
+                self.assertEqual(resp.binary_data.chunks_count(), 21)
+                self.assertEqual(resp.binary_data.data(), data)
+
+                #connection is in consistent state after windowed transfer
+                packet = FabnetPacketRequest(method='GetKeysInfo', parameters={'key': key}, sync=True)
+                resp = proc.send_packet(packet, wait_response=True)
+                self.assertEqual(resp.ret_code, 0, resp.ret_message)
+            finally:
+                proc.close_socket(force=True)
+
+    def test04_binary_window_with_latency(self):
+        proxy = LatencyProxy(self.node.address, 0.02)
+        proxy.start()
+        self.node.address = proxy.address
+        try:
+            fri_client = FriClient()
+            data = random_data(50000)
+            t0 = time.time()
+            resp = self.put_data(fri_client, 'test_key', data)
+            self.assertEqual(resp.ret_code, 0, resp.ret_message)
+            self.assertEqual(self.get_data(fri_client, 'test_key'), data)
+            #50 chunks per direction, stop-and-wait transfer would take >2s
+            self.assertTrue(time.time() - t0 < 1.5, time.time() - t0)
+        finally:
+            proxy.stop()
+
+    def test05_compact_header(self):
+        header = FabnetPacketRequest(method='ClientPutData', session_id=u'sid', sync=True, is_multicast=True, \
+                parameters={'key': u'k\u0416', 'replica_count': 2, 'info': [1.5, None, {'a': False}]}).to_dict()
+        decoded = CompactHeaderCodec.decode(CompactHeaderCodec.encode(header))
+        self.assertEqual(decoded.pop('sender', None), None)
+        header.pop('sender')
+        self.assertEqual(decoded, header)
+
+        #headers that can not be packed are sent with JSON header
+        packet = FabnetPacketRequest(method='M'*300, parameters={'key': 'test'})
+        data = ''.join(packet.dump_buffers(compact=True))
+        self.assertEqual(data[:4], 'FRI0')
+        packet_len, header_len = FriBinaryProcessor.get_expected_len(data)
+        raw_packet, _ = FriBinaryProcessor.from_binary(data, packet_len, header_len)
+        self.assertEqual(raw_packet['method'], 'M'*300)
+
+        host, port = self.node.address.split(':')
+        data = random_data(3500)
+        for client_compact, node_compact, protocols in ((True, True, ['FRI0', 'FRI1', 'FRI1']), \
+                                                        (True, False, ['FRI0']*3), \
+                                                        (False, True, ['FRI0']*3)):
+            self.node.compact_header = node_compact
+            sock = RecordingSocket(socket.create_connection((host, int(port))))
+            proc = SocketProcessor(sock, compact_header=client_compact)
+            try:
+                for i in xrange(3):
+                    packet = FabnetPacketRequest(method='ClientPutData', parameters={'key': 'key%s'%i}, \
+                            binary_data=RamBasedBinaryData(data, 1000), sync=True)
+                    resp = proc.send_packet(packet, wait_response=True)
+                    self.assertEqual(resp.ret_code, 0, resp.ret_message)
+                    self.assertEqual(resp.ret_parameters['checksum'], hashlib.sha1(data).hexdigest())
+                self.assertEqual(sock.protocols[::5], protocols)
+            finally:
+                proc.close_socket(force=True)
+
+    def test06_multiplexed_calls(self):
+        fri_client = FriMuxClient(connections_pool=FriConnectionsPool())
+        data = random_data(5500)
+        errors = Queue()
+
+        def worker(idx):
+            try:
+                for i in xrange(5):
+                    key = 'key_%s_%s'%(idx, i)
+                    resp = self.put_data(fri_client, key, data)
+                    if resp.ret_code != 0:
+                        raise Exception(resp.ret_message)
+                    if self.get_data(fri_client, key) != data:
+                        raise Exception('invalid data for %s'%key)
+            except Exception, err:
+                errors.put(err)
+
+        def run_workers():
+            threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(32)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        #calls made while connection is negotiated do not wait for it
+        t0 = time.time()
+        run_workers()
+        self.assertTrue(errors.empty(), errors.queue)
+        self.assertTrue(time.time() - t0 < 5)
+        conn_count = self.node.conn_count
+        self.assertTrue(conn_count <= 33, conn_count)
+
+        #negotiated connection is used by all calls
+        run_workers()
+        self.assertTrue(errors.empty(), errors.queue)
+        self.assertEqual(self.node.conn_count, conn_count)
+        self.assertTrue(self.node.max_parallel_calls > 1)
+
+        #cancelled binary stream does not break multiplexed connection
+        packet = FabnetPacketRequest(method='GetDataBlock', parameters={'key': 'key_0_0'}, sync=True)
+        resp = fri_client.call_sync(self.node.address, packet)
+        resp.binary_data.get_next_chunk()
+        resp.binary_data.close()
+        self.assertEqual(self.get_data(fri_client, 'key_0_1'), data)
+        self.assertEqual(self.node.conn_count, conn_count)
+
+        #closed by node connection should be negotiated again
+        self.node.drop_connections()
+        time.sleep(0.1)
+        self.assertEqual(self.get_data(fri_client, 'key_0_2'), data)
+        self.assertEqual(self.node.conn_count, conn_count + 1)
+        fri_client.close()
+
+    def test07_multiplex_fallback(self):
+        self.node.multiplex = False
+        pool = FriConnectionsPool()
+        fri_client = FriMuxClient(connections_pool=pool)
+        data = random_data(2500)
+        for i in xrange(3):
+            resp = self.put_data(fri_client, 'key%s'%i, data)
+            self.assertEqual(resp.ret_code, 0, resp.ret_message)
+            self.assertEqual(self.get_data(fri_client, 'key%s'%i), data)
+        self.assertEqual(fri_client.call(self.node.address, \
+                FabnetPacketRequest(method='GetKeysInfo', parameters={'key': 'key0'}))[0], 0)
+        #legacy node is called by FriClient via pooled connection
+        self.assertEqual(self.node.conn_count, 1)
+        self.assertEqual(pool.idle_count(self.node.address), 1)
+        pool.close_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+DataBlock locks contention micro-benchmark.
+
+N parallel threads write and read back their own data blocks by small chunks
+(with progress polling like transactions manager does).
+Single locked DBLocksManager (as before sharding) is compared with sharded one.
+Usage: OPENSSL_EXEC=... PYTHONPATH=. python tests/perf/data_block_contention_bench.py [threads] [blocks_per_thread]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+from nimbus_client.core.constants import DB_LOCKS_SHARDS
+from nimbus_client.core.security_manager import FileBasedSecurityManager
+from nimbus_client.core.data_block import DataBlock, DBLocksManager
+
+CLIENT_KS_PATH = './tests/cert/test_cl_1024.ks'
+PASSWD = 'qwerty123'
+BLOCK_SIZE = 256*1024
+CHUNK_SIZE = 1024
+
+
+def transfer(tmp_dir, thread_idx, blocks_count, data):
+    chunks = [data[i:i+CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE)]
+    for i in xrange(blocks_count):
+        path = os.path.join(tmp_dir, 'db.%s.%s'%(thread_idx, i))
+        db = DataBlock(path, len(data), force_create=True)
+        for chunk in chunks:
+            db.write(chunk)
+            db.get_progress()
+            DataBlock.is_locked(path)
+        db.finalize()
+        db.close()
+
+        db = DataBlock(path, len(data))
+        while db.read(CHUNK_SIZE):
+            db.get_progress()
+            DataBlock.is_locked(path)
+        db.close()
+        os.remove(path)
+
+
+def bench(threads_count, blocks_count, data):
+    tmp_dir = tempfile.mkdtemp(prefix='db_contention_bench')
+    try:
+        threads = [threading.Thread(target=transfer, args=(tmp_dir, i, blocks_count, data)) \
+                for i in xrange(threads_count)]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        dt = time.time() - t0
+    finally:
+        shutil.rmtree(tmp_dir)
+    return (2 * len(data) * blocks_count * threads_count) / dt / (1024*1024)
+
+
+if __name__ == '__main__':
+    max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    blocks_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    DataBlock.SECURITY_MANAGER = FileBasedSecurityManager(CLIENT_KS_PATH, PASSWD)
+    data = os.urandom(BLOCK_SIZE)
+
+    print 'DataBlock write+read: %sKB blocks, %sB chunks, %s blocks per thread'%\
+            (BLOCK_SIZE/1024, CHUNK_SIZE, blocks_count)
+    threads_count = 1
+    while threads_count <= max_threads:
+        results = []
+        for shards_count in (1, DB_LOCKS_SHARDS):
+            DataBlock.LOCK_MANAGER = DBLocksManager(shards_count)
+            results.append((shards_count, bench(threads_count, blocks_count, data)))
+        print '  %3s threads: %s'%(threads_count, \
+                ', '.join('%2s shards %8.1f MB/s'%item for item in results))
+        threads_count *= 4
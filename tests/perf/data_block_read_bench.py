@@ -0,0 +1,93 @@
+"""
+DataBlock read path micro-benchmark.
+
+Compares legacy DataBlock.read (1KB read_raw + decrypt + string concatenation)
+with large buffers reader on encrypted data blocks (with and without mmap).
+Usage: OPENSSL_EXEC=... PYTHONPATH=. python tests/perf/data_block_read_bench.py [block_size_mb] [read_len_kb]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from nimbus_client.core.constants import BUF_LEN
+from nimbus_client.core.security_manager import FileBasedSecurityManager
+from nimbus_client.core.data_block import DataBlock
+
+CLIENT_KS_PATH = './tests/cert/test_cl_1024.ks'
+PASSWD = 'qwerty123'
+
+
+class LegacyDataBlock(DataBlock):
+    """DataBlock with read algorithm used before large buffers implementation"""
+    def read(self, rlen=None):
+        ret_str = self.legacy_rest
+        self.legacy_rest = ''
+        while True:
+            if rlen and len(ret_str) >= rlen:
+                self.legacy_rest = ret_str[rlen:]
+                ret_str = ret_str[:rlen]
+                break
+
+            data = ''
+            while True:
+                buf = self.read_raw(BUF_LEN)
+                data += buf or ''
+                if not buf or len(data) >= BUF_LEN:
+                    break
+            if not data:
+                break
+
+            data = self._DataBlock__encdec.decrypt(data)
+            ret_str += data
+
+        return ret_str
+
+
+def create_block(path, data):
+    db = DataBlock(path, len(data), force_create=True)
+    db.write(data)
+    db.close()
+
+
+def bench(db_class, path, data_len, read_len, count, use_readinto=False):
+    t0 = time.time()
+    buf = memoryview(bytearray(read_len))
+    for i in xrange(count):
+        db = db_class(path, data_len)
+        db.legacy_rest = ''
+        while True:
+            if use_readinto:
+                if not db.readinto(buf):
+                    break
+            elif not db.read(read_len):
+                break
+        db.close()
+    dt = time.time() - t0
+    return (data_len * count) / dt / (1024*1024)
+
+
+if __name__ == '__main__':
+    block_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    read_len = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    DataBlock.SECURITY_MANAGER = FileBasedSecurityManager(CLIENT_KS_PATH, PASSWD)
+
+    data = os.urandom(block_size*1024*1024)
+    path = os.path.join(tempfile.gettempdir(), 'data_block_read_bench.db')
+    create_block(path, data)
+    count = max(1, 128 / block_size)
+    try:
+        print 'DataBlock.read: %sMB encrypted block, %sKB reads, %s blocks'%(block_size, read_len, count)
+        legacy = bench(LegacyDataBlock, path, len(data), read_len*1024, count)
+        print '  %-22s read():     %8.1f MB/s'%('legacy 1KB buffers', legacy)
+        for use_mmap in (False, True):
+            DataBlock.USE_MMAP = use_mmap
+            for buf_len in (1024*1024, 4*1024*1024):
+                DataBlock.READ_BUF_LEN = buf_len
+                name = '%sMB buffers%s'%(buf_len/(1024*1024), ' (mmap)' if use_mmap else '')
+                current = bench(DataBlock, path, len(data), read_len*1024, count)
+                print '  %-22s read():     %8.1f MB/s (x%.2f)'%(name, current, current/legacy)
+                current = bench(DataBlock, path, len(data), read_len*1024, count, use_readinto=True)
+                print '  %-22s readinto(): %8.1f MB/s (x%.2f)'%(name, current, current/legacy)
+    finally:
+        os.remove(path)
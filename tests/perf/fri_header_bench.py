@@ -0,0 +1,104 @@
+"""
+FRI packet header codecs benchmark.
+
+Measures packets/sec for small control messages (PutKeysInfo, GetKeysInfo)
+encoded with JSON header (FRI0) and compact binary header (FRI1):
+dump + parse of packets and request/response round-trips via socketpair.
+Usage: PYTHONPATH=. python tests/perf/fri_header_bench.py [packets_count]
+"""
+import sys
+import time
+import socket
+import threading
+
+from nimbus_client.core.fri.fri_base import FabnetPacketRequest, FabnetPacketResponse, \
+        FriBinaryProcessor, FabnetPacket, RamBasedBinaryData
+from nimbus_client.core.fri.socket_processor import SocketProcessor
+
+SESSION_ID = 'a7f3c2d1e4b5a6f7c8d9e0f1a2b3c4d5e6f7a8b9'
+KEY = '4f2e1d0c9b8a7f6e5d4c3b2a1f0e9d8c7b6a5f4e'
+
+
+def control_packets():
+    put_req = FabnetPacketRequest(method='PutKeysInfo', session_id=SESSION_ID, sync=True, \
+            parameters={'key': None, 'replica_count': 2})
+    put_resp = FabnetPacketResponse(message_id=put_req.message_id, \
+            ret_parameters={'key_info': (KEY, '192.168.1.10:1987')})
+    get_req = FabnetPacketRequest(method='GetKeysInfo', session_id=SESSION_ID, sync=True, \
+            parameters={'key': KEY, 'replica_count': 2})
+    get_resp = FabnetPacketResponse(message_id=get_req.message_id, \
+            ret_parameters={'keys_info': [(KEY, False, '192.168.1.10:1987'), \
+                                            (KEY, True, '192.168.1.11:1987')]})
+    return [('PutKeysInfo', put_req, put_resp), ('GetKeysInfo', get_req, get_resp)]
+
+
+def bench_codec(packet, compact, count):
+    t0 = time.time()
+    for i in xrange(count):
+        data = ''.join(packet.dump_buffers(compact=compact))
+        packet_len, header_len = FriBinaryProcessor.get_expected_len(data)
+        raw_packet, _ = FriBinaryProcessor.from_binary(data, packet_len, header_len)
+        FabnetPacket.create(raw_packet)
+    return count / (time.time() - t0)
+
+
+def bench_chunks(compact, count):
+    """Binary chunk packets of GetDataBlock response (header overhead only, 1 byte chunks)"""
+    packet = FabnetPacketResponse(ret_parameters={'checksum': KEY}, \
+            binary_data=RamBasedBinaryData('x'*count, 1))
+    packet.binary_chunk_cnt = count
+    t0 = time.time()
+    for i in xrange(count):
+        packet.binary_chunk_idx = i+1
+        header, bin_data = packet.dump_next_chunk_buffers(compact)
+        data = header + bin_data.tobytes()
+        packet_len, header_len = FriBinaryProcessor.get_expected_len(data)
+        raw_packet, _ = FriBinaryProcessor.from_binary(data, packet_len, header_len)
+        FabnetPacket.create(raw_packet)
+    return count / (time.time() - t0)
+
+
+def serve(sock, resp, compact, count):
+    proc = SocketProcessor(sock, compact_header=compact)
+    for i in xrange(count):
+        proc.recv_packet()
+        proc.send_packet(resp)
+
+
+def bench_roundtrip(req, resp, compact, count):
+    srv_sock, cli_sock = socket.socketpair()
+    thrd = threading.Thread(target=serve, args=(srv_sock, resp, compact, count+1))
+    thrd.start()
+
+    proc = SocketProcessor(cli_sock, compact_header=compact)
+    proc.send_packet(req, wait_response=True) #header codec negotiation
+    t0 = time.time()
+    for i in xrange(count):
+        proc.send_packet(req, wait_response=True)
+    dt = time.time() - t0
+    thrd.join()
+    srv_sock.close()
+    cli_sock.close()
+    return count / dt
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for name, req, resp in control_packets():
+        print '%s (header size: JSON req %s/resp %s, compact req %s/resp %s bytes)'%(name, \
+                len(req.dump_buffers()[0]), len(resp.dump_buffers()[0]), \
+                len(req.dump_buffers(compact=True)[0]), len(resp.dump_buffers(compact=True)[0]))
+        for title, func in (('dump+parse request', lambda c: bench_codec(req, c, count)), \
+                            ('dump+parse response', lambda c: bench_codec(resp, c, count)), \
+                            ('round-trip', lambda c: bench_roundtrip(req, resp, c, count/4))):
+            json_speed = func(False)
+            compact_speed = func(True)
+            print '  %-20s JSON %9.0f pkt/s, compact %9.0f pkt/s (x%.2f)'%(title, \
+                    json_speed, compact_speed, compact_speed/json_speed)
+
+    json_speed = bench_chunks(False, count)
+    compact_speed = bench_chunks(True, count)
+    print 'GetDataBlock binary chunks'
+    print '  %-20s JSON %9.0f pkt/s, compact %9.0f pkt/s (x%.2f)'%('dump+parse chunk', \
+            json_speed, compact_speed, compact_speed/json_speed)
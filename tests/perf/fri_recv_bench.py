@@ -0,0 +1,118 @@
+"""
+GetDataBlock receive path micro-benchmark.
+
+Compares legacy read_next_packet (growing string + slicing) with
+recv_into based implementation of SocketProcessor.
+Usage: PYTHONPATH=. python tests/perf/fri_recv_bench.py [block_size_mb] [chunk_size_kb]
+"""
+import sys
+import time
+import socket
+import hashlib
+import threading
+
+from nimbus_client.core.fri.constants import BUF_SIZE, FRI_PACKET_INFO_LEN
+from nimbus_client.core.fri.fri_base import FabnetPacketResponse, RamBasedBinaryData, \
+        FriBinaryProcessor, FabnetPacket, FriException
+from nimbus_client.core.fri.socket_processor import SocketProcessor
+
+
+class LegacySocketProcessor(SocketProcessor):
+    """SocketProcessor with receive algorithm used before recv_into implementation"""
+    def __init__(self, sock, cert=None):
+        SocketProcessor.__init__(self, sock, cert)
+        self.legacy_sock = sock
+        self.legacy_rest = ''
+
+    def read_next_packet(self):
+        data = ''
+        exp_len = None
+        header_len = 0
+        has_rest = len(self.legacy_rest) > 0
+        while True:
+            if self.legacy_rest:
+                data = self.legacy_rest
+                self.legacy_rest = ''
+            else:
+                received = self.legacy_sock.recv(BUF_SIZE)
+                if not received:
+                    break
+                data += received
+
+            if exp_len is None:
+                if has_rest and len(data) < FRI_PACKET_INFO_LEN:
+                    continue
+                exp_len, header_len = FriBinaryProcessor.get_expected_len(data)
+            if exp_len and len(data) >= exp_len:
+                break
+
+        if not data:
+            raise FriException('empty data block')
+
+        if len(data) > exp_len:
+            self.legacy_rest = data[exp_len:]
+            data = data[:exp_len]
+
+        packet, bin_data = FriBinaryProcessor.from_binary(data, exp_len, header_len)
+        return FabnetPacket.create(packet), bin_data
+
+
+def dump_response(data, chunk_size):
+    """Serialize GetDataBlock response packets once, so sender does not affect measurement"""
+    packet = FabnetPacketResponse(binary_data=RamBasedBinaryData(data, chunk_size), \
+            ret_parameters={'checksum': ''})
+    packet.binary_chunk_cnt = packet.binary_data.chunks_count()
+    packets = [packet.dump(with_bin=False)]
+    for i in xrange(packet.binary_chunk_cnt):
+        packet.binary_chunk_idx = i+1
+        packets.append(packet.dump_next_chunk())
+    return packets
+
+
+def serve(sock, packets, count):
+    proc = SocketProcessor(sock)
+    for i in xrange(count):
+        sock.sendall(packets[0])
+        for chunk_packet in packets[1:]:
+            proc.read_next_packet() #RC_REQ_BINARY_CHUNK
+            sock.sendall(chunk_packet)
+
+
+def bench(proc_class, packets, data_len, count, with_checksum):
+    srv_sock, cli_sock = socket.socketpair()
+    thrd = threading.Thread(target=serve, args=(srv_sock, packets, count))
+    thrd.start()
+
+    proc = proc_class(cli_sock)
+    t0 = time.time()
+    for i in xrange(count):
+        resp = proc.recv_packet()
+        checksum = hashlib.sha1()
+        while True:
+            chunk = resp.binary_data.get_next_chunk()
+            if not chunk:
+                break
+            if with_checksum:
+                checksum.update(chunk)
+    dt = time.time() - t0
+    thrd.join()
+    srv_sock.close()
+    cli_sock.close()
+    return (data_len * count) / dt / (1024*1024)
+
+
+if __name__ == '__main__':
+    block_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    data = 'x' * (block_size*1024*1024)
+    count = max(1, 256 / block_size)
+
+    packets = dump_response(data, chunk_size*1024)
+
+    print 'GetDataBlock: %sMB block, %sKB chunks, %s blocks'%(block_size, chunk_size, count)
+    for with_checksum in (False, True):
+        print ' %s'%('receive + sha1 (DataBlock.write)' if with_checksum else 'receive only')
+        legacy = bench(LegacySocketProcessor, packets, len(data), count, with_checksum)
+        print '  legacy read_next_packet:    %8.1f MB/s'%legacy
+        current = bench(SocketProcessor, packets, len(data), count, with_checksum)
+        print '  recv_into read_next_packet: %8.1f MB/s (x%.2f)'%(current, current/legacy)
@@ -0,0 +1,61 @@
+"""
+Windowed binary chunks transfer benchmark.
+
+Measures ClientPutData/GetDataBlock throughput via latency emulating proxy
+for different binary window sizes (0 - stop-and-wait transfer).
+Usage: PYTHONPATH=.:./tests python tests/perf/fri_window_bench.py [rtt_ms] [block_size_mb] [chunk_size_kb]
+"""
+import sys
+import time
+import socket
+
+from nimbus_client.core.fri.fri_base import FabnetPacketRequest, RamBasedBinaryData
+from nimbus_client.core.fri.socket_processor import SocketProcessor
+from util_fri_node import FriNodeStandIn, LatencyProxy
+
+
+def bench(address, window, data, chunk_size):
+    host, port = address.split(':')
+    proc = SocketProcessor(socket.create_connection((host, int(port))), binary_window=window)
+    try:
+        t0 = time.time()
+        packet = FabnetPacketRequest(method='ClientPutData', parameters={'key': 'bench'}, \
+                binary_data=RamBasedBinaryData(data, chunk_size), sync=True)
+        resp = proc.send_packet(packet, wait_response=True)
+        if resp.ret_code:
+            raise Exception(resp.ret_message)
+        t1 = time.time()
+
+        packet = FabnetPacketRequest(method='GetDataBlock', parameters={'key': 'bench'}, sync=True)
+        resp = proc.send_packet(packet, wait_response=True)
+        if resp.ret_code:
+            raise Exception(resp.ret_message)
+        while resp.binary_data.get_next_chunk():
+            pass
+        t2 = time.time()
+    finally:
+        proc.close_socket(force=True)
+
+    mb = len(data) / (1024.*1024)
+    return mb / (t1-t0), mb / (t2-t1)
+
+
+if __name__ == '__main__':
+    rtt = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+    data = 'x' * (block_size*1024*1024)
+
+    node = FriNodeStandIn(chunk_size*1024)
+    node.start()
+    proxy = LatencyProxy(node.address, rtt/1000.)
+    proxy.start()
+    try:
+        print 'RTT %sms, %sMB block, %sKB chunks'%(rtt, block_size, chunk_size)
+        for window in (0, 2, 4, 8, 16, 32):
+            node.binary_window = window
+            put_speed, get_speed = bench(proxy.address, window, data, chunk_size*1024)
+            print '  window %2s: put %8.1f MB/s, get %8.1f MB/s'%(window, put_speed, get_speed)
+    finally:
+        proxy.stop()
+        node.stop()
@@ -11,6 +11,7 @@ import signal
 import string
 import hashlib
 import logging
+import base64
 from hashlib import sha1
 from Queue import Queue, Empty
 
@@ -19,6 +20,10 @@ transactions_manager.MAX_TR_LOG_ITEMS = 10
 
 from nimbus_client.core.smart_file_object import SmartFileObject
 from nimbus_client.core.transactions_manager import *
+from nimbus_client.core.transactions_log import TransactionsLog, RT_START, RT_STATUS, RT_TRANSFER, RT_RANGE
+from nimbus_client.core.constants import TR_LOG_DURABILITY_LAZY, TR_LOG_DURABILITY_FSYNC, \
+                            TP_INTERACTIVE_READ, TP_BACKGROUND_SYNC, TP_PREFETCH
+from nimbus_client.core.transfers_queue import TransfersQueue
 from nimbus_client.core.data_block_cache import DataBlockCache
 from nimbus_client.core.metadata_file import MetadataFile
 from nimbus_client.core.data_block import DataBlock, DBLocksManager
@@ -144,6 +149,10 @@ class TestSmartFileObject(unittest.TestCase):
             tr_manager.transfer_data_block(transaction_id, 1000, 2000, DataBlock(db_cache.get_cache_path('fake1')))
             tr_manager.update_transaction_state(transaction_id, Transaction.TS_LOCAL_SAVED)
             tr_manager.transfer_data_block(transaction_id, 0, 1000, DataBlock(db_cache.get_cache_path('fake2')), '%040x'%123456)
+            self.assertEqual(tr_manager.find_inprogress_file('/my_second_test.file').size, 3000)
+            self.assertEqual(tr_manager.find_inprogress_file('/not_cached_test.file'), None)
+            self.assertEqual([f.name for f in tr_manager.listdir_inprogress('/')], ['my_second_test.file'])
+            self.assertEqual(tr_manager.listdir_inprogress('/other'), [])
 
             transaction = tr_manager.start_download_transaction('/test.file')
             db,_,_ = transaction.get_data_block(0)
@@ -196,6 +205,198 @@ class TestSmartFileObject(unittest.TestCase):
         finally:
             db_cache.stop()
 
+    def test02_transactions_progress(self):
+        class SlowDataBlock:
+            def __init__(self):
+                self.event = threading.Event()
+            def get_progress(self):
+                self.event.wait(5)
+                return 0, 100
+
+        slow_db = SlowDataBlock()
+        counters = TransfersProgress()
+        slow_tr = Transaction(Transaction.TT_DOWNLOAD, '/slow.file', 2)
+        slow_tr.set_progress_counters(counters)
+        slow_tr.append_data_block(0, 100, slow_db)
+        try:
+            #progress is accounted on data blocks events, data blocks are not polled
+            t0 = time.time()
+            slow_tr.append_data_block(100, 300, slow_db)
+            self.assertEqual(slow_tr.progress_perc(), 0)
+            slow_tr.finish_data_block_transfer(100)
+            self.assertEqual(slow_tr.progress_perc(), 75)
+            self.assertEqual(counters.get(False), (1, 300, 400))
+            self.assertTrue(time.time() - t0 < 1)
+        finally:
+            slow_db.event.set()
+
+        transaction = Transaction(Transaction.TT_UPLOAD, '/other.file', 2)
+        transaction.set_progress_counters(counters)
+        transaction.append_data_block(0, 100, slow_db)
+        transaction.change_status(Transaction.TS_LOCAL_SAVED)
+        self.assertEqual(counters.get(True), (1, 40, 100))
+        transaction.finish_data_block_transfer(0)
+        self.assertEqual(counters.get(True), (1, 90, 100))
+        transaction.change_status(Transaction.TS_FINISHED)
+        slow_tr.change_status(Transaction.TS_FAILED)
+        self.assertEqual(counters.get(True), (0, 0, 0))
+        self.assertEqual(counters.get(False), (0, 0, 0))
+
+        #transferred chunks are accounted before data block is finished
+        transaction = Transaction(Transaction.TT_DOWNLOAD, '/chunked.file', 2)
+        transaction.set_progress_counters(counters)
+        transaction.append_data_block(0, 100, slow_db)
+        transaction.add_transferred(0, 30)
+        self.assertEqual(transaction.progress_perc(), 30)
+        self.assertEqual(counters.get(False), (1, 30, 100))
+        transaction.set_transferred(0, 10)
+        transaction.add_transferred(0, 200)
+        self.assertEqual(transaction.progress_size(), 100)
+        transaction.finish_data_block_transfer(0)
+        self.assertEqual(transaction.progress_size(), 100)
+        self.assertEqual(counters.get(False), (1, 100, 100))
+        #replaced transaction is removed from counters
+        transaction.set_progress_counters(None)
+        self.assertEqual(counters.get(False), (0, 0, 0))
+
+        #data blocks uploaded while file is written are not accounted in cache saving phase
+        transaction = Transaction(Transaction.TT_UPLOAD, '/written.file', 2)
+        transaction.append_data_block(0, 100, slow_db)
+        transaction.add_transferred(0, 50)
+        self.assertEqual(transaction.progress_perc(), 40)
+        transaction.change_status(Transaction.TS_LOCAL_SAVED)
+        self.assertEqual(transaction.progress_perc(), 65)
+
+    def test03_transactions_log(self):
+        log_path = tmp('smart_file_test/transactions_log_test.log')
+        open(log_path, 'w').write('1 ST 1 %s 2\n1 UT 0 100 1.0 None\n1 US 1\n2 ST 2 %s 2\n'%\
+                (base64.b64encode('/legacy file'), base64.b64encode('/other')))
+
+        tr_log = TransactionsLog(log_path)
+        legacy_records = list(tr_log.iter_records())
+        self.assertEqual(legacy_records, [(RT_START, 1, 1, '/legacy file', 2), \
+                (RT_TRANSFER, 1, 0, 100, '1.0', None), (RT_STATUS, 1, 1), (RT_START, 2, 2, '/other', 2)])
+
+        #legacy log is converted to binary log
+        tr_log.truncate()
+        for record in legacy_records:
+            if record[0] == RT_START:
+                tr_log.start_transaction(*record[1:])
+            elif record[0] == RT_STATUS:
+                tr_log.update_state(*record[1:])
+            else:
+                tr_log.update_transfer(*record[1:])
+        tr_log.close()
+        self.assertEqual(open(log_path, 'rb').read(len(TransactionsLog.MAGIC)), TransactionsLog.MAGIC)
+        self.assertEqual(list(tr_log.iter_records()), legacy_records)
+
+        #records of concurrent appenders are written by batches
+        compacted = []
+        def compact_func(records):
+            compacted.append(len(records))
+            return [r for r in records if r[1] == 1]
+        tr_log = TransactionsLog(log_path, TR_LOG_DURABILITY_FSYNC, compact_func)
+        def append_records(thrd_idx):
+            for i in xrange(50):
+                tr_log.update_transfer(thrd_idx, i, 100, None, 'key%s'%i)
+        threads = [threading.Thread(target=append_records, args=(i+10,)) for i in xrange(8)]
+        for thrd in threads:
+            thrd.start()
+        for thrd in threads:
+            thrd.join()
+        records = list(tr_log.iter_records())
+        self.assertEqual(records[:4], legacy_records)
+        self.assertEqual(len(records), 4 + 8*50)
+        self.assertEqual(sorted(records[4:]), sorted((RT_TRANSFER, t, i, 100, None, 'key%s'%i) \
+                for t in xrange(10, 18) for i in xrange(50)))
+
+        #sealed segments are compacted in background, appends go to new segment
+        tr_log.request_compaction()
+        tr_log.update_state(1, 2)
+        for i in xrange(50):
+            if compacted:
+                break
+            time.sleep(0.1)
+        tr_log.compact()
+        self.assertEqual(compacted, [4 + 8*50])
+        self.assertEqual(list(tr_log.iter_records()), legacy_records[:3] + [(RT_STATUS, 1, 2)])
+        log_files = [f_name for f_name in os.listdir(os.path.dirname(log_path)) \
+                if f_name.startswith(os.path.basename(log_path))]
+        self.assertEqual(sorted(log_files), ['transactions_log_test.log', 'transactions_log_test.log.000002'])
+        tr_log.close()
+
+        #not fully written record is skipped
+        open(log_path + '.000002', 'ab').write('\x10\x00\x00\x00\x01')
+        self.assertEqual(list(tr_log.iter_records()), legacy_records[:3] + [(RT_STATUS, 1, 2)])
+
+        #segments are not used without snapshot
+        open(log_path, 'w').close()
+        self.assertEqual(list(tr_log.iter_records()), [])
+
+        tr_log = TransactionsLog(log_path, TR_LOG_DURABILITY_LAZY)
+        tr_log.truncate()
+        self.assertFalse(os.path.exists(log_path + '.000002'))
+        tr_log.update_state(1, 2)
+        self.assertEqual(list(tr_log.iter_records()), [])
+        tr_log.flush()
+        self.assertEqual(list(tr_log.iter_records()), [(RT_STATUS, 1, 2)])
+        tr_log.update_range(1, 0, 4096, 'key', '127.0.0.1:1987')
+        tr_log.update_range(1, 100, 8192)
+        tr_log.flush()
+        self.assertEqual(list(tr_log.iter_records())[1:], [(RT_RANGE, 1, 0, 4096, 'key', '127.0.0.1:1987'), \
+                (RT_RANGE, 1, 100, 8192, None, None)])
+        tr_log.close()
+
+        #failed write is raised for waiters, records are written by next commit
+        tr_log = TransactionsLog(log_path, TR_LOG_DURABILITY_FSYNC)
+        tr_log.truncate()
+        fsync = os.fsync
+        def failed_fsync(fd):
+            raise OSError(5, 'Input/output error')
+        os.fsync = failed_fsync
+        try:
+            with self.assertRaises(OSError):
+                tr_log.update_state(1, 2)
+        finally:
+            os.fsync = fsync
+        tr_log.update_state(1, 3)
+        self.assertEqual(list(tr_log.iter_records()), [(RT_STATUS, 1, 2), (RT_STATUS, 1, 3)])
+        tr_log.close()
+        os.remove(log_path)
+        os.remove(log_path + '.000001')
+
+    def test04_transfers_queue(self):
+        def transaction(priority, *sizes):
+            tr = Transaction(Transaction.TT_DOWNLOAD, '/file', 2, priority=priority)
+            seek = 0
+            for size in sizes:
+                tr.append_data_block(seek, size, None)
+                seek += size
+            return tr
+
+        bulk_tr = transaction(TP_BACKGROUND_SYNC, 64*1024*1024, 64*1024*1024)
+        prefetch_tr = transaction(TP_PREFETCH, 1024)
+        read_tr = transaction(TP_INTERACTIVE_READ, 2048, 10*1024*1024)
+        self.assertEqual(Transaction(Transaction.TT_UPLOAD, '/file', 2).get_priority(), \
+                transactions_manager.TP_INTERACTIVE_WRITE)
+
+        queue = TransfersQueue(class_delay=0.2, size_rate=1024*1024*1024)
+        for job in [(bulk_tr, 0), (bulk_tr, 64*1024*1024), (prefetch_tr, 0), (read_tr, 2048), (read_tr, 0)]:
+            queue.put(job)
+        queue.put(None)
+        #interactive read blocks first (smaller block first), bulk download blocks are FIFO
+        self.assertEqual([queue.get() for i in xrange(5)], [(read_tr, 0), (read_tr, 2048), \
+                (bulk_tr, 0), (bulk_tr, 64*1024*1024), (prefetch_tr, 0)])
+        self.assertEqual(queue.get(), None)
+
+        #long waiting job is not starved by newly queued jobs of higher class
+        queue.put((prefetch_tr, 0))
+        time.sleep(0.7)
+        queue.put((read_tr, 0))
+        self.assertEqual(queue.get(), (prefetch_tr, 0))
+        self.assertEqual(queue.get(), (read_tr, 0))
+        self.assertTrue(queue.empty())
+
     def test99_finally(self):
         remove_dir(tmp('smart_file_test'))
 
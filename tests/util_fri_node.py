@@ -0,0 +1,286 @@
+import time
+import socket
+import threading
+import Queue
+import hashlib
+import random
+from datetime import datetime
+
+from nimbus_client.core.fri.constants import RC_OK, RC_ERROR, FRI_BINARY_WINDOW, FRI_COMPACT_HEADER
+from nimbus_client.core.fri.fri_base import FabnetPacketResponse, RamBasedBinaryData, FriException
+from nimbus_client.core.fri.socket_processor import SocketProcessor
+from nimbus_client.core.fri.mux_client import FriMuxConnection
+
+RC_NO_DATA = 324
+RC_RANGE_MISMATCH = 325
+
+
+class FriNodeStandIn(threading.Thread):
+    """Local fabnet node emulation (single node plays balancer and data node roles)"""
+    def __init__(self, chunk_size=1024*1024, binary_window=FRI_BINARY_WINDOW, \
+            compact_header=FRI_COMPACT_HEADER, multiplex=True, batch_keys=True, multi_delete=True, ranges=True):
+        threading.Thread.__init__(self)
+        self.chunk_size = chunk_size
+        self.batch_keys = batch_keys
+        self.multi_delete = multi_delete
+        self.ranges = ranges
+        self.partial_map = {} #key -> data received by ranges
+        self.put_offsets = [] #offsets of received ranges
+        self.get_offsets = [] #offsets requested by GetDataBlock
+        self.drop_put_range = None #connection is dropped after saving range with this index
+        self.drop_calls = 0 #connection is dropped after processing of next calls (response is lost)
+        self.replicas = [] #addresses of nodes with replicas of all data blocks
+        self.response_delay = 0 #GetDataBlock response delay in seconds
+        self.binary_window = binary_window
+        self.compact_header = compact_header
+        self.multiplex = multiplex
+        self.max_parallel_calls = 0
+        self.__parallel_calls = 0
+        self.data_map = {}
+        self.conn_count = 0
+        self.calls = []
+        self.__conns = []
+        self.__lock = threading.Lock()
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(('127.0.0.1', 0))
+        self.__sock.listen(64)
+        self.address = '127.0.0.1:%s'%self.__sock.getsockname()[1]
+        self.__stopped = threading.Event()
+        self.setDaemon(True)
+
+    def stop(self):
+        self.__stopped.set()
+        try:
+            socket.create_connection(self.__sock.getsockname()).close()
+        except socket.error:
+            pass
+        self.join()
+        self.__sock.close()
+
+    def drop_connections(self):
+        self.__lock.acquire()
+        try:
+            for conn in self.__conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.__conns = []
+        finally:
+            self.__lock.release()
+
+    def run(self):
+        while True:
+            conn, _ = self.__sock.accept()
+            if self.__stopped.is_set():
+                conn.close()
+                break
+            self.__lock.acquire()
+            self.conn_count += 1
+            self.__conns.append(conn)
+            self.__lock.release()
+            thrd = threading.Thread(target=self.serve_connection, args=(conn,))
+            thrd.setDaemon(True)
+            thrd.start()
+
+    def serve_connection(self, conn):
+        proc = SocketProcessor(conn, binary_window=self.binary_window, compact_header=self.compact_header)
+        try:
+            while not self.__stopped.is_set():
+                try:
+                    packet = proc.recv_packet(allow_socket_close=False)
+                except (FriException, socket.error):
+                    break
+
+                if packet.binary_chunk_cnt:
+                    #allow binary chunks transfer
+                    proc.send_packet(FabnetPacketResponse(ret_code=RC_OK))
+
+                resp = self.process(packet)
+                if resp is None or self.drop_calls:
+                    #connection drop emulation
+                    self.drop_calls = max(0, self.drop_calls - 1)
+                    break
+                resp.message_id = packet.message_id
+                resp.multiplex = packet.multiplex and self.multiplex
+                try:
+                    proc.send_packet(resp)
+                except (FriException, socket.error):
+                    #binary stream is cancelled by client
+                    break
+
+                if resp.multiplex:
+                    FriMuxConnection(proc, on_request=self.serve_channel).run()
+                    break
+        finally:
+            proc.close_socket(force=True)
+
+    def serve_channel(self, channel):
+        thrd = threading.Thread(target=self.__process_channel, args=(channel,))
+        thrd.setDaemon(True)
+        thrd.start()
+
+    def __process_channel(self, channel):
+        self.__lock.acquire()
+        self.__parallel_calls += 1
+        self.max_parallel_calls = max(self.max_parallel_calls, self.__parallel_calls)
+        self.__lock.release()
+        try:
+            packet = channel.recv_packet()
+            if packet.binary_chunk_cnt:
+                channel.send_packet(FabnetPacketResponse(ret_code=RC_OK))
+            resp = self.process(packet)
+            if resp is not None:
+                channel.send_packet(resp)
+        except (FriException, socket.error):
+            pass
+        finally:
+            channel.close()
+            self.__lock.acquire()
+            self.__parallel_calls -= 1
+            self.__lock.release()
+
+    def new_key(self):
+        return hashlib.sha1(datetime.utcnow().isoformat()+str(random.randint(0,1000000))).hexdigest()
+
+    def process(self, packet):
+        self.__lock.acquire()
+        try:
+            self.calls.append(packet.method)
+        finally:
+            self.__lock.release()
+
+        params = packet.parameters
+        if packet.method == 'PutKeysInfo':
+            key = params.get('key', None)
+            if key:
+                return FabnetPacketResponse(ret_parameters={'key_info': (key, self.address)})
+            keys = [(self.new_key(), self.address) for i in xrange(params.get('count', 1))]
+            if not self.batch_keys:
+                return FabnetPacketResponse(ret_parameters={'key_info': keys[0]})
+            return FabnetPacketResponse(ret_parameters={'keys_info': keys})
+
+        elif packet.method == 'GetKeysInfo':
+            keys_info = [(params['key'], False, self.address)]
+            keys_info += [(params['key'], True, address) for address in self.replicas]
+            return FabnetPacketResponse(ret_parameters={'keys_info': keys_info})
+
+        elif packet.method == 'ClientPutData':
+            if packet.binary_data is None:
+                return FabnetPacketResponse(ret_code=RC_ERROR, ret_message='No binary data found!')
+            data = packet.binary_data.data()
+            if self.ranges and 'offset' in params:
+                return self.__put_range(params, data)
+            self.data_map[params['key']] = data
+            return FabnetPacketResponse(ret_parameters={'key': params['key'], \
+                    'checksum': hashlib.sha1(data).hexdigest()})
+
+        elif packet.method == 'GetDataBlock':
+            time.sleep(self.response_delay)
+            data = self.data_map.get(params['key'], None)
+            if data is None:
+                return FabnetPacketResponse(ret_code=RC_NO_DATA, ret_message='No data found!')
+            ret_params = {'checksum': hashlib.sha1(data).hexdigest()}
+            if self.ranges and 'offset' in params:
+                self.get_offsets.append(params['offset'])
+                ret_params['offset'] = params['offset']
+                return FabnetPacketResponse(binary_data=RamBasedBinaryData(data[params['offset']:], self.chunk_size), \
+                        ret_parameters=ret_params)
+            return FabnetPacketResponse(binary_data=RamBasedBinaryData(data, self.chunk_size), \
+                    ret_parameters=ret_params)
+
+        elif packet.method == 'ClientDeleteData':
+            if self.multi_delete and 'keys' in params:
+                failed_keys = [key for key in params['keys'] if self.data_map.pop(key, None) is None]
+                return FabnetPacketResponse(ret_parameters={'failed_keys': failed_keys})
+            key = params.get('key', None)
+            if self.data_map.pop(key, None) is None and self.partial_map.pop(key, None) is None:
+                return FabnetPacketResponse(ret_code=RC_ERROR, ret_message='no data block found for delete!')
+            return FabnetPacketResponse()
+
+        return FabnetPacketResponse(ret_code=RC_ERROR, ret_message='Unknown method "%s"'%packet.method)
+
+    def __put_range(self, params, data):
+        key = params['key']
+        saved = self.partial_map.get(key, '')
+        if params['offset'] != len(saved):
+            return FabnetPacketResponse(ret_code=RC_RANGE_MISMATCH, ret_parameters={'offset': len(saved)}, \
+                    ret_message='Range offset %s does not match saved data size'%params['offset'])
+
+        self.put_offsets.append(params['offset'])
+        saved += data
+        self.partial_map[key] = saved
+        if self.drop_put_range == len(self.put_offsets) - 1:
+            return None
+        if not params['is_last']:
+            return FabnetPacketResponse(ret_parameters={'offset': len(saved)})
+
+        self.data_map[key] = self.partial_map.pop(key)
+        return FabnetPacketResponse(ret_parameters={'key': key, 'checksum': hashlib.sha1(saved).hexdigest()})
+
+
+class LatencyProxy(threading.Thread):
+    """TCP proxy emulating network latency (round-trip time is @latency seconds)
+    Clients should be pointed to proxy by setting FriNodeStandIn.address to proxy.address
+    """
+    def __init__(self, target_address, latency):
+        threading.Thread.__init__(self)
+        host, port = target_address.split(':')
+        self.__target = (host, int(port))
+        self.__delay = latency / 2.0
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(('127.0.0.1', 0))
+        self.__sock.listen(64)
+        self.address = '127.0.0.1:%s'%self.__sock.getsockname()[1]
+        self.__stopped = threading.Event()
+        self.setDaemon(True)
+
+    def stop(self):
+        self.__stopped.set()
+        try:
+            socket.create_connection(self.__sock.getsockname()).close()
+        except socket.error:
+            pass
+        self.join()
+        self.__sock.close()
+
+    def run(self):
+        while True:
+            conn, _ = self.__sock.accept()
+            if self.__stopped.is_set():
+                conn.close()
+                break
+            target = socket.create_connection(self.__target)
+            for src, dst in ((conn, target), (target, conn)):
+                src.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                queue = Queue.Queue()
+                for func, args in ((self.__read, (src, queue)), (self.__write, (dst, queue))):
+                    thrd = threading.Thread(target=func, args=args)
+                    thrd.setDaemon(True)
+                    thrd.start()
+
+    def __read(self, src, queue):
+        while True:
+            try:
+                data = src.recv(64*1024)
+            except socket.error:
+                data = ''
+            queue.put((time.time() + self.__delay, data))
+            if not data:
+                break
+
+    def __write(self, dst, queue):
+        while True:
+            deliver_at, data = queue.get()
+            wait = deliver_at - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    break
+                dst.sendall(data)
+            except socket.error:
+                break
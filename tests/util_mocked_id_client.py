@@ -40,7 +40,7 @@ class MockedFriClient:
         finally:
             cls._LOCK.release()
 
-    def __init__(self, is_ssl=None, cert=None, session_id=None):
+    def __init__(self, is_ssl=None, cert=None, session_id=None, connections_pool=None):
         #if not is_ssl:
         #    raise Exception('[MockedFriClient] NimbusFS backend accept SSL based transport only!')
         #if not cert:
@@ -52,7 +52,7 @@ class MockedFriClient:
 
         self.data_map = {}
 
-    def call_sync(self, node_addr, packet, FRI_CLIENT_TIMEOUT):
+    def call_sync(self, node_addr, packet, FRI_CLIENT_TIMEOUT, read_timeout=None):
         if self.get_mode() == FAIL:
             return FabnetPacketResponse(ret_code=1, ret_message='test exception from backend')
         elif self.get_mode() == WAIT: